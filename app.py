@@ -6,26 +6,36 @@ Maintainer: Tyler Puleo
 Status: Production
 Summary: This is the main application code for my api. It contains
          all of the api routes as well as all of the controllers.
+         create_app builds the app for a config.
 """
 
-from flask import Flask, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from flask_restful import Resource, Api
+from flask import Flask, current_app, request, jsonify
+from flask_restful import Resource
 from flask_api import status
-from sqlalchemy import or_
+from sqlalchemy import and_, or_, orm
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm.exc import StaleDataError
 from werkzeug.exceptions import BadRequestKeyError
+from datetime import datetime
+import heapq
+from cache import customer_key, accounts_key, account_key
+from config import get_config
+from extensions import api, db, shards, replicas, cache, keyring, metrics
+from serializers import RowSerializer, json_response
+from models import Customers, Accounts, Ledger, TransferRequests, blind_index, blind_index_normalizers
+from helpers import (truthy, page_args, fields_arg, include_arg, time_arg, paginated, streamed, etag_for,
+                     etag_matches, not_modified, tagged, admin_only)
+from transfers import transfer, transfer_batch, TransferError
+from transfer_queue import enqueue_transfer
+from group_commit import group_transfer
+from idempotency import idempotent
+from includes import INCLUDES, embed_accounts
+from imports import run_import
+from balances import balance_at
+from rollups import activity, GRANULARITIES
+from exports import export_status, start_export, ExportInProgress
 
-app = Flask(__name__)
-api = Api(app)
 
-app.config.from_object("config.ProductionConfig")
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
-
-from models import Customers, Accounts, Ledger
-
-
-@app.route("/")
 def hello():
     """
     get:
@@ -38,29 +48,169 @@ def hello():
     return "Welcome to Tyler's Banking API"
 
 
+def cache_stats():
+    """
+    get:
+        summary: Endpoint to show the read through cache hit and miss counters.
+        parameters:
+        responses:
+            200:
+                Returns JSON object of the counters.
+    """
+    return jsonify(cache.stats())
+
+
+@metrics.collector
+def cache_metrics():
+    return [("cache_events_total", "counter", "Read through cache hits, misses and invalidations.",
+             dict(((("event", name),), value) for name, value in cache.stats().items()))]
+
+
+@metrics.collector
+def replica_metrics():
+    if not replicas.enabled:
+        return []
+
+    return [("replica_lag_seconds", "gauge", "Seconds each PostgreSQL replica is behind its primary.",
+             dict(((("replica", name),), lag) for name, lag in replicas.lag().items())),
+            ("replica_routing_total", "counter", "Primaries read from a replica, from a replica that caught up "
+                                                 "with the client's last write, or from the primary.",
+             dict(((("target", name),), value) for name, value in replicas.stats().items()))]
+
+
+def metrics_endpoint():
+    """
+    get:
+        summary: Endpoint to show request latency, SQL, commit, connection pool,
+                 encryption and cache metrics in the Prometheus text format.
+        parameters:
+        responses:
+            200:
+                Returns the metrics as text.
+    """
+    return metrics.render(), status.HTTP_200_OK, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+def shard_page(query, shard, limit):
+    """
+    Returns the first limit customer rows of query that live on shard, the
+    current one. Rows of customers moved off it are skipped and more are read
+    in their place, so every shard contributes a full page when it can and
+    none of its customers fall between pages.
+    """
+    rows = []
+    after_id = None
+
+    while len(rows) < limit:
+        batch = (query if after_id is None else query.filter(Customers.id > after_id)).limit(limit).all()
+        rows.extend(row for row in batch if shards.shard_for(row[0]) == shard)
+
+        if len(batch) < limit:
+            break
+
+        after_id = batch[-1][0]
+
+    return rows[:limit]
+
+
 class CustomersIndexController(Resource):
     def get(self):
         """
         get:
-            summary: Index controller for customers. Returns all customers
+            summary: Index controller for customers. Returns a page of customers
+                     ordered by id.
             parameters:
+                OPTIONAL: "after_id": <int> Only return customers with a greater id
+                OPTIONAL: "limit": <int> Page size, capped at MAX_PAGE_SIZE
+                OPTIONAL: "stream": <bool> Stream every customer after after_id
+                OPTIONAL: "fields": <string> Comma separated fields to return.
+                          Defaults to every field but ssn
+                OPTIONAL: "email", "phone_number", "ssn": <string> Only return
+                          customers with this exact value
+                OPTIONAL: "include": <string> accounts to embed each customer's
+                          accounts, accounts.recent_ledger to also embed each
+                          account's latest ledger entries. Not with stream
             responses:
                 200:
-                    Returns array of customer object JSON.
+                    Returns array of customer object JSON. If there may be more
+                    customers the X-Next-After-Id header holds the next cursor.
+                400:
+                    Bad Request: after_id, limit, fields or include is not valid
                 500:
                     Internal Server Error
         """
         try:
-            customers = Customers.query.all()
-
-            # Iterates through each customer returned from the query then
-            # constructs an array of the serialized objects and make it JSON.
-            return jsonify([a_customer.serialize() for a_customer in customers])
+            after_id, limit = page_args()
+            fields = fields_arg(Customers)
+            include = include_arg(INCLUDES)
+
+            # Only the requested columns are selected, as plain rows rather than
+            # ORM objects, so only those get decrypted. The id always comes
+            # first for the next page cursor.
+            serializer = RowSerializer(Customers, fields)
+            query = db.session.query(Customers.id, *serializer.columns) \
+                .filter(Customers.id > after_id).order_by(Customers.id)
+
+            # Exact match lookups on encrypted fields go through their blind
+            # index so they are an index scan instead of decrypting every row
+            for field in blind_index_normalizers:
+                if field in request.args:
+                    query = query.filter(getattr(Customers, field + '_bidx') == blind_index(field, request.args[field]))
+
+            # Streaming mode reads through a server side cursor one batch at a
+            # time instead of materializing every customer up front. Each shard
+            # gets its own cursor and they are merged in id order.
+            if truthy(request.args.get('stream')):
+                if include:
+                    raise ValueError("include can't be used with stream")
+
+                def from_shard(rows, shard):
+                    return ((row[0], shard, row) for row in rows)
+
+                cursors = []
+                for shard in shards.names():
+                    # The cursor is opened on the shard when iter() runs the query
+                    with shards.use(shard):
+                        cursor = iter(query.yield_per(current_app.config['STREAM_BATCH_SIZE']))
+                        cursors.append(from_shard(cursor, shard))
+
+                rows = (row for customer_id, shard, row in heapq.merge(*cursors, key=lambda item: item[0])
+                        if shards.shard_for(customer_id) == shard)
+                return streamed(rows, lambda row: serializer.serialize(row[1:]))
+
+            # The page is the lowest ids of each shard's page. A customer being
+            # moved is only taken from the shard they are read from.
+            customers = []
+            for shard in shards.names():
+                with shards.use(shard):
+                    customers.extend((row, shard) for row in shard_page(query, shard, limit))
+
+            customers = sorted(customers, key=lambda customer: customer[0][0])[:limit]
+
+            # Iterates through each customer row returned from the query then
+            # constructs an array of the serialized rows and make it JSON.
+            serialized = [(row[0], serializer.serialize(row[1:])) for row, _ in customers]
+
+            # Related resources are loaded for the whole page at once, one
+            # batch per shard
+            if "accounts" in include:
+                for shard in shards.names():
+                    with shards.use(shard):
+                        embed_accounts([customer for customer, (_, customer_shard) in zip(serialized, customers)
+                                        if customer_shard == shard], "accounts.recent_ledger" in include)
+
+            return paginated([customer for _, customer in serialized],
+                             limit, customers[-1][0][0] if customers else None)
+
+        except ValueError as e:
+            current_app.logger.error(str(e))
+            return {"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
 
         except Exception as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
             return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
 
+    @idempotent
     def post(self):
         """
         post:
@@ -90,17 +240,19 @@ class CustomersIndexController(Resource):
                 active=bool(request.values['active']),
             )
 
-            db.session.add(customer)
-            db.session.commit()
+            # The shard's id sequence gives the customer an id that routes back to it
+            with shards.use(shards.place()):
+                db.session.add(customer)
+                db.session.commit()
 
-            return jsonify(customer.serialize())
+                return jsonify(customer.serialize())
 
         except BadRequestKeyError as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
             return {"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
 
         except Exception as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
             return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
 
 
@@ -110,24 +262,69 @@ class CustomersController(Resource):
         get:
             summary: Get a single customer by id.
             parameters:
+                OPTIONAL: "fields": <string> Comma separated fields to return.
+                          Defaults to every field but ssn
+                OPTIONAL: "include": <string> accounts to embed the customer's
+                          accounts, accounts.recent_ledger to also embed each
+                          account's latest ledger entries
             responses:
                 200:
                     Returns JSON object of the customer object with given id.
+                304:
+                    Not Modified: The If-None-Match header matches the ETag.
+                    Responses with include have no ETag
+                400:
+                    Bad Request: fields or include names an unknown field
                 404:
                     Not Found: Customer with given array not found
                 500:
                     Internal Server Error
         """
         try:
-            customer = Customers.query.filter_by(id=customer_id).first()
-            return jsonify(customer.serialize())
+            fields = fields_arg(Customers)
+            include = include_arg(INCLUDES)
+
+            # The version is one primary key lookup with nothing to decrypt,
+            # so an unchanged customer costs no more than that
+            version = db.session.query(Customers.version).filter_by(id=customer_id).scalar()
+
+            if version is None:
+                raise AttributeError("Customer with id {} does not exist".format(customer_id))
+
+            etag = etag_for("customer", customer_id, version)
+
+            if not include and etag_matches(etag):
+                return not_modified(etag)
+
+            def load():
+                customer = Customers.query.options(load_only(*fields)).filter_by(id=customer_id).first()
+                return customer.serialize(fields)
+
+            # Decrypted PII is only cached in process, never in the shared cache
+            pii = bool(set(fields) & set(Customers.encrypted_fields))
+
+            customer = cache.read(customer_key(customer_id), replicas.on_primary(load, cache.enabled),
+                                  "{}:{}".format(version, ",".join(fields)), pii=pii)
+
+            # Embedded resources change without the customer's version
+            # changing, so they go on a copy and the response gets no ETag
+            if "accounts" in include:
+                customer = dict(customer)
+                embed_accounts([(int(customer_id), customer)], "accounts.recent_ledger" in include)
+                return jsonify(customer)
+
+            return tagged(jsonify(customer), etag)
+
+        except ValueError as e:
+            current_app.logger.error(str(e))
+            return {"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
 
         except AttributeError as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
             return {"error": "Customer with id {} does not exist".format(customer_id)}, status.HTTP_404_NOT_FOUND
 
         except Exception as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
             return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
 
     def put(self, customer_id):
@@ -146,6 +343,8 @@ class CustomersController(Resource):
                     Returns JSON object of the customer that was updated.
                 404:
                     Not Found: Customer with given array not found
+                409:
+                    Conflict: The customer was updated by another request at the same time
                 500:
                     Internal Server Error
         """
@@ -160,15 +359,22 @@ class CustomersController(Resource):
             customer.active = bool(request.values['active']) if "active" in request.values else customer.active
 
             db.session.commit()
+            cache.invalidate(customer_key(customer.id))
 
             return jsonify(customer.serialize())
 
+        except StaleDataError as e:
+            db.session.rollback()
+            current_app.logger.error(str(e))
+            return {"error": "Customer with id {} was changed by another request".format(customer_id)}, \
+                status.HTTP_409_CONFLICT
+
         except AttributeError as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
             return {"error": "Customer with id {} does not exist".format(customer_id)}, status.HTTP_404_NOT_FOUND
 
         except Exception as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
             return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
 
 
@@ -178,21 +384,38 @@ class AccountsIndexController(Resource):
         get:
             summary: Return all accounts for given customer id.
             parameters:
+                OPTIONAL: "fields": <string> Comma separated fields to return
             responses:
                 200:
                     Returns array of JSON object accounts for given customer id.
+                400:
+                    Bad Request: fields names an unknown field
                 500:
                     Internal Server Error
         """
         try:
-            accounts = db.session.query(Accounts).filter(Accounts.customer_id == customer_id).all()
+            fields = fields_arg(Accounts)
 
-            return jsonify([account.serialize() for account in accounts])
+            serializer = RowSerializer(Accounts, fields)
+
+            def load():
+                accounts = db.session.query(*serializer.columns) \
+                    .filter(Accounts.customer_id == customer_id).all()
+
+                return [serializer.serialize(account) for account in accounts]
+
+            return json_response(cache.read(accounts_key(customer_id), replicas.on_primary(load, cache.enabled),
+                                            ",".join(fields)))
+
+        except ValueError as e:
+            current_app.logger.error(str(e))
+            return {"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
 
         except Exception as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
             return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
 
+    @idempotent
     def post(self, customer_id):
         """
         post:
@@ -213,7 +436,8 @@ class AccountsIndexController(Resource):
                     Internal Server Error
         """
         try:
-            customer = Customers.query.filter_by(id=customer_id).first()
+            # Only the id is needed so skip loading and decrypting the PII
+            customer = Customers.query.options(load_only('id')).filter_by(id=customer_id).first()
 
             account = Accounts(
                 customer=customer,
@@ -227,15 +451,16 @@ class AccountsIndexController(Resource):
             )
             db.session.add(account)
             db.session.commit()
+            cache.invalidate(accounts_key(customer.id))
 
             return jsonify(account.serialize())
 
         except BadRequestKeyError as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
             return{"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
 
         except Exception as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
             return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
 
 
@@ -245,28 +470,55 @@ class AccountsController(Resource):
         get:
             summary: Show account for given customer id and account id.
             parameters:
+                OPTIONAL: "fields": <string> Comma separated fields to return
             responses:
                 200:
                     Returns JSON object of the account for given customer id and account id.
+                304:
+                    Not Modified: The If-None-Match header matches the ETag
+                400:
+                    Bad Request: fields names an unknown field
                 404:
                     Not Found: Either customer id or account id not found
                 500:
                     Internal Server Error
         """
         try:
-            account = db.session.query(Accounts).filter(Accounts.customer_id == customer_id, Accounts.id == account_id).first()
+            fields = fields_arg(Accounts)
 
-            if not account:
-                app.logger.error("Customer with id {} or account with id {} does not exist"
+            # Checking the version first means an unchanged account costs one
+            # primary key lookup
+            version = db.session.query(Accounts.version) \
+                .filter(Accounts.customer_id == customer_id, Accounts.id == account_id).scalar()
+
+            if version is None:
+                current_app.logger.error("Customer with id {} or account with id {} does not exist"
                                  .format(customer_id, account_id))
 
                 return {"error": "Customer with id {} or account with id {} does not exist"
                         .format(customer_id, account_id)}, status.HTTP_404_NOT_FOUND
 
-            return jsonify(account.serialize())
+            etag = etag_for("account", account_id, version)
+
+            if etag_matches(etag):
+                return not_modified(etag)
+
+            def load():
+                account = db.session.query(Accounts).options(load_only(*fields)) \
+                    .filter(Accounts.customer_id == customer_id, Accounts.id == account_id).first()
+
+                return account.serialize(fields)
+
+            return tagged(jsonify(cache.read(account_key(customer_id, account_id),
+                                             replicas.on_primary(load, cache.enabled),
+                                             "{}:{}".format(version, ",".join(fields)))), etag)
+
+        except ValueError as e:
+            current_app.logger.error(str(e))
+            return {"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
 
         except Exception as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
             return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
 
     def put(self, customer_id, account_id):
@@ -285,6 +537,8 @@ class AccountsController(Resource):
                     Returns JSON object of the account that was updated.
                 404:
                     Not Found: Account id or customer id not found.
+                409:
+                    Conflict: The account was updated by another request at the same time
                 500:
                     Internal Server Error
         """
@@ -300,64 +554,219 @@ class AccountsController(Resource):
             account.active = bool(request.values['active']) if "active" in request.values else account.active
 
             db.session.commit()
+            cache.invalidate(account_key(account.customer_id, account.id), accounts_key(account.customer_id))
 
             return jsonify(account.serialize())
 
+        except StaleDataError as e:
+            db.session.rollback()
+            current_app.logger.error(str(e))
+            return {"error": "Account with id {} was changed by another request".format(account_id)}, \
+                status.HTTP_409_CONFLICT
+
         except AttributeError as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
             return {"error": "Account with id {} or customer with id {} does not exist"
                     .format(account_id, customer_id)}, status.HTTP_404_NOT_FOUND
 
         except Exception as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
             return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
 
 
 class LedgerController(Resource):
     def get(self, customer_id, account_id):
         """
-        put:
-            summary: Show all ledger info for an account.
+        get:
+            summary: Show a page of ledger info for an account ordered by
+                     created_at then id.
+            parameters:
+                OPTIONAL: "since": <datetime> Only entries created at or after
+                OPTIONAL: "until": <datetime> Only entries created before
+                OPTIONAL: "after_id": <int> Id of the last entry of the previous page
+                OPTIONAL: "limit": <int> Page size, capped at MAX_PAGE_SIZE
+            responses:
+                200:
+                    Returns array of JSON objects of the ledger info. If there may
+                    be more entries the X-Next-After-Id header holds the next cursor.
+                304:
+                    Not Modified: The If-None-Match header matches the ETag
+                400:
+                    Bad Request: One of the params is malformed
+                404:
+                    Not Found: Account id or customer id not found.
+                500:
+                    Internal Server Error
+        """
+        try:
+            after_id, limit = page_args()
+            since = time_arg('since')
+            until = time_arg('until')
+
+            # The ETag comes from the account's latest ledger entry, found by
+            # walking the (account_id, created_at, id) index backwards
+            latest_id = db.session.query(Ledger.id).filter(Ledger.account_id == Accounts.id) \
+                .order_by(Ledger.created_at.desc(), Ledger.id.desc()).limit(1) \
+                .correlate(Accounts).as_scalar()
+
+            # One cheap query checks ownership and finds the latest entry, so
+            # a conditional request is answered before building the page
+            account = db.session.query(Accounts.id, latest_id) \
+                .filter(Accounts.customer_id == customer_id, Accounts.id == account_id).first()
+
+            if not account:
+                current_app.logger.error("Customer with id {} or account with id {} does not exist"
+                                 .format(customer_id, account_id))
+
+                return {"error": "Customer with id {} or account with id {} does not exist"
+                        .format(customer_id, account_id)}, status.HTTP_404_NOT_FOUND
+
+            etag = etag_for("ledger", account_id, account[1])
+
+            if etag_matches(etag):
+                return not_modified(etag)
+
+            # On PostgreSQL Ledger is partitioned by month on created_at so
+            # these bounds also limit which partitions get scanned
+            window = []
+
+            if since is not None:
+                window.append(Ledger.created_at >= since)
+
+            if until is not None:
+                window.append(Ledger.created_at < until)
+
+            conditions = [Ledger.account_id == account.id] + window
+
+            if after_id:
+                # The previous page's last entry is inside the same window
+                after = db.session.query(Ledger.created_at).filter(Ledger.id == after_id, *window).as_scalar()
+                conditions.append(or_(Ledger.created_at > after,
+                                      and_(Ledger.created_at == after, Ledger.id > after_id)))
+
+            serializer = RowSerializer(Ledger, Ledger.fields)
+
+            ledger = db.session.query(*serializer.columns).filter(*conditions) \
+                        .order_by(Ledger.created_at, Ledger.id) \
+                        .limit(limit).all()
+
+            entries = [serializer.serialize(l) for l in ledger]
+
+            return tagged(paginated(entries, limit, entries[-1]['id'] if entries else None), etag)
+
+        except ValueError as e:
+            current_app.logger.error(str(e))
+            return {"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
+
+        except Exception as e:
+            current_app.logger.error(str(e))
+            return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+class BalanceController(Resource):
+    def get(self, customer_id, account_id):
+        """
+        get:
+            summary: Show the balance of an account at a point in time, worked
+                     out from the nearest balance checkpoint and the ledger.
             parameters:
+                OPTIONAL: "at": <datetime> Defaults to now
             responses:
                 200:
-                    Returns array of JSON objects of the ledger info.
+                    Returns JSON object of the balance and the time of the
+                    checkpoint it was worked out from.
+                400:
+                    Bad Request: at is not a valid date or datetime
                 404:
                     Not Found: Account id or customer id not found.
                 500:
                     Internal Server Error
         """
         try:
-            ledger = db.session.query(Accounts, Ledger).outerjoin(Ledger) \
-                        .filter(Accounts.customer_id == customer_id) \
-                        .filter(Ledger.account_id == account_id).all()
+            at = time_arg('at') or datetime.now()
+
+            account = Accounts.query.options(load_only('id', 'balance')) \
+                .filter_by(customer_id=customer_id, id=account_id).first()
+
+            if not account:
+                current_app.logger.error("Customer with id {} or account with id {} does not exist"
+                                 .format(customer_id, account_id))
 
-            # If ledger is an empty array it could be that there is no
-            # ledger or it could be that the customer or account don't exist
-            if not ledger:
-                account = Accounts.query.filter_by(customer_id=customer_id, id=account_id).first()
+                return {"error": "Customer with id {} or account with id {} does not exist"
+                        .format(customer_id, account_id)}, status.HTTP_404_NOT_FOUND
 
-                # If account doesn't exist you know either the customer or accounts
-                # don't exist and can return an error
-                if not account:
-                    app.logger.error("Customer with id {} or account with id {} does not exist"
-                                     .format(customer_id, account_id))
+            balance, checkpoint_at = balance_at(account, at)
 
-                    return {"error": "Customer with id {} or account with id {} does not exist"
-                            .format(customer_id, account_id)}, status.HTTP_404_NOT_FOUND
+            return_json = {
+                "account_id": account.id,
+                "at": at,
+                "balance": balance,
+                "checkpoint_at": checkpoint_at
+            }
 
-                # Otherwise ledger is just empty
-                else:
-                    return jsonify([])
+            return jsonify(return_json)
 
-            return jsonify([l[1].serialize() for l in ledger])
+        except ValueError as e:
+            current_app.logger.error(str(e))
+            return {"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
 
         except Exception as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
+            return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+class ActivityController(Resource):
+    def get(self, customer_id, account_id):
+        """
+        get:
+            summary: Show an account's ledger activity rolled up by day or month,
+                     with the count and total of each transaction type and details.
+            parameters:
+                OPTIONAL: "granularity": <string> day (default) or month
+                OPTIONAL: "since": <date> Only periods containing or after this
+                OPTIONAL: "until": <date> Only periods starting before this
+            responses:
+                200:
+                    Returns array of JSON objects of the rollups ordered by period.
+                400:
+                    Bad Request: One of the params is malformed
+                404:
+                    Not Found: Account id or customer id not found.
+                500:
+                    Internal Server Error
+        """
+        try:
+            granularity = request.args.get('granularity', "day")
+
+            if granularity not in GRANULARITIES:
+                raise ValueError("granularity must be one of {}".format(", ".join(GRANULARITIES)))
+
+            since = time_arg('since')
+            until = time_arg('until')
+
+            account = Accounts.query.options(load_only('id')) \
+                .filter_by(customer_id=customer_id, id=account_id).first()
+
+            if not account:
+                current_app.logger.error("Customer with id {} or account with id {} does not exist"
+                                 .format(customer_id, account_id))
+
+                return {"error": "Customer with id {} or account with id {} does not exist"
+                        .format(customer_id, account_id)}, status.HTTP_404_NOT_FOUND
+
+            return jsonify([rollup.serialize() for rollup in activity(account.id, granularity, since, until)])
+
+        except ValueError as e:
+            current_app.logger.error(str(e))
+            return {"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
+
+        except Exception as e:
+            current_app.logger.error(str(e))
             return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
 
 
 class TransferController(Resource):
+    @idempotent
     def post(self, customer_id):
         """
         post:
@@ -366,9 +775,14 @@ class TransferController(Resource):
                 "to_account_id": <int>
                 "from_account_id": <int>
                 "amount": <float>
+                OPTIONAL: "async": <bool> Queue the transfer instead of running
+                          it. Defaults to TRANSFER_ASYNC
             responses:
                 200:
                     Returns JSON info about the transaction that took place.
+                202:
+                    Returns the id of the queued transfer. Its status is at
+                    /customers/<customer_id>/transfers/<transfer_id>
                 400:
                     Bad Request: Most likely a param is missing
                 404:
@@ -377,47 +791,23 @@ class TransferController(Resource):
                     Internal Server Error
         """
         try:
-            to_account_id = request.values['to_account_id']
-            from_account_id = request.values['from_account_id']
-            amount = request.values['amount']
-
-            if amount <= 0:
-                return {"error": "Amount must be greater than 0"}, status.HTTP_400_BAD_REQUEST
-
-            from_account = Accounts.query.filter_by(customer_id=customer_id, id=int(from_account_id)).first()
-
-            if from_account.balance - float(amount) < 0:
-                return {"error": "Insufficient in from account"}, status.HTTP_400_BAD_REQUEST
-
-            to_account = Accounts.query.filter_by(customer_id=customer_id, id=int(to_account_id)).first()
-
-            if not from_account.status == "opened" or not from_account.active \
-                    or not to_account.status == "opened" or not to_account.active:
-
-                return {"error": "Both to and from accounts must be open"}, status.HTTP_400_BAD_REQUEST
-
-            to_account.balance = to_account.balance + float(amount)
-            from_account.balance = from_account.balance - float(amount)
-
-            object_array = [
-                Ledger(
-                    account_id=to_account_id,
-                    account=to_account,
-                    transaction_type="credit",
-                    amount=amount,
-                    details="transfer_in",
-                ),
-                Ledger(
-                    account_id=from_account_id,
-                    account=from_account,
-                    transaction_type="debit",
-                    amount=amount,
-                    details="transfer_away",
-                )
-            ]
-
-            db.session.bulk_save_objects(object_array)
-            db.session.commit()
+            to_account_id = int(request.values['to_account_id'])
+            from_account_id = int(request.values['from_account_id'])
+            amount = float(request.values['amount'])
+
+            if truthy(request.values.get('async', current_app.config['TRANSFER_ASYNC'])):
+                queued = enqueue_transfer(int(customer_id), from_account_id, to_account_id, amount)
+
+                return {"transfer_id": queued.id, "status": "queued"}, status.HTTP_202_ACCEPTED, \
+                    {"Location": "/customers/{}/transfers/{}".format(customer_id, queued.id)}
+
+            if current_app.config['TRANSFER_GROUP_COMMIT']:
+                group_transfer(int(customer_id), from_account_id, to_account_id, amount)
+            else:
+                transfer(int(customer_id), from_account_id, to_account_id, amount)
+
+            cache.invalidate(account_key(customer_id, from_account_id), account_key(customer_id, to_account_id),
+                             accounts_key(customer_id))
 
             return_json = {
                 "to_account": to_account_id,
@@ -427,16 +817,240 @@ class TransferController(Resource):
 
             return jsonify(return_json)
 
-        except AttributeError as e:
-            app.logger.error(str(e))
-            return {"error": "Customer with id {} does not exist".format(customer_id)}, status.HTTP_404_NOT_FOUND
+        except TransferError as e:
+            current_app.logger.error(e.message)
+            return {"error": e.message}, e.status_code
 
-        except BadRequestKeyError as e:
-            app.logger.error(str(e))
+        except (BadRequestKeyError, ValueError) as e:
+            current_app.logger.error(str(e))
+            return {"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
+
+        except Exception as e:
+            current_app.logger.error(str(e))
+            return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+class TransferBatchController(Resource):
+    @idempotent
+    def post(self):
+        """
+        post:
+            summary: Applies many transfers at once. Transfers are applied in
+                     order, in chunks of one transaction each.
+            parameters:
+                JSON body: [{"customer_id": <int>, "from_account_id": <int>,
+                             "to_account_id": <int>, "amount": <float>}, ...]
+                OPTIONAL: "chunk_size": <int> Transfers per transaction
+            responses:
+                200:
+                    Returns array of JSON results, one per transfer, each with
+                    its "index" and a "status" of "ok" or "error".
+                400:
+                    Bad Request: Body is not a JSON array or chunk_size is invalid
+                500:
+                    Internal Server Error
+        """
+        try:
+            items = request.get_json(force=True, silent=True)
+
+            if not isinstance(items, list):
+                return {"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
+
+            chunk_size = int(request.args.get('chunk_size', current_app.config['TRANSFER_BATCH_CHUNK_SIZE']))
+
+            if chunk_size <= 0:
+                raise ValueError("chunk_size must be > 0")
+
+            return jsonify(transfer_batch(items, chunk_size))
+
+        except ValueError as e:
+            current_app.logger.error(str(e))
             return {"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
 
         except Exception as e:
-            app.logger.error(str(e))
+            current_app.logger.error(str(e))
+            return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+class TransferStatusController(Resource):
+    def get(self, transfer_id, customer_id=None):
+        """
+        get:
+            summary: Show the status of a queued transfer. When sharded it has
+                     to be read through the customer's url, since transfer ids
+                     are only unique across shards once their sequences have
+                     been configured.
+            parameters:
+            responses:
+                200:
+                    Returns JSON object of the transfer with its status, one of
+                    queued, completed or failed, and the error if it failed.
+                400:
+                    Bad Request: Sharded and no customer id in the url
+                404:
+                    Not Found: Transfer with given id not found for the customer
+                500:
+                    Internal Server Error
+        """
+        try:
+            if customer_id is None and shards.enabled:
+                current_app.logger.error("Transfer with id {} was read without its customer".format(transfer_id))
+                return {"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
+
+            # The customer's shard was made the current one by its url
+            query = TransferRequests.query.filter_by(id=int(transfer_id))
+
+            if customer_id is not None:
+                query = query.filter_by(customer_id=int(customer_id))
+
+            queued = query.first()
+
+            if not queued:
+                raise ValueError("Transfer with id {} does not exist".format(transfer_id))
+
+            return jsonify(queued.serialize())
+
+        except ValueError as e:
+            current_app.logger.error(str(e))
+            return {"error": "Transfer with id {} does not exist".format(transfer_id)}, status.HTTP_404_NOT_FOUND
+
+        except Exception as e:
+            current_app.logger.error(str(e))
+            return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+class ImportController(Resource):
+    @admin_only
+    def post(self, kind):
+        """
+        post:
+            summary: Bulk imports customers or accounts from an NDJSON or CSV
+                     request body. The body is read as a stream and committed in
+                     chunks. Posting the same body again with the same job_id
+                     resumes after the last committed chunk. Needs
+                     ADMIN_TOKEN as a bearer token.
+            parameters:
+                "kind": <string> customers or accounts (in the url)
+                "job_id": <string> Name of the import job
+                OPTIONAL: "format": <string> ndjson (default) or csv
+                OPTIONAL: "chunk_size": <int> Rows committed per transaction
+            responses:
+                200:
+                    Returns JSON summary of the job with the row errors.
+                400:
+                    Bad Request: Most likely a param is missing or invalid
+                401:
+                    Unauthorized: The bearer token is missing or wrong
+                403:
+                    Forbidden: ADMIN_TOKEN isn't set
+                500:
+                    Internal Server Error
+        """
+        try:
+            job_id = request.args['job_id']
+            file_format = request.args.get('format', "csv" if request.mimetype == "text/csv" else "ndjson")
+            chunk_size = int(request.args.get('chunk_size', current_app.config['IMPORT_CHUNK_SIZE']))
+
+            if chunk_size <= 0:
+                raise ValueError("chunk_size must be > 0")
+
+            return jsonify(run_import(job_id, kind, request.stream, file_format, chunk_size))
+
+        except (BadRequestKeyError, ValueError) as e:
+            current_app.logger.error(str(e))
+            return {"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
+
+        except Exception as e:
+            current_app.logger.error(str(e))
+            return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+class LedgerExportController(Resource):
+    @admin_only
+    def get(self):
+        """
+        get:
+            summary: Show whether a ledger export is running and how far the
+                     exports got. Needs ADMIN_TOKEN as a bearer token.
+            parameters:
+            responses:
+                200:
+                    Returns JSON object with running, the high water mark, the
+                    number of files and the last file written, or an array of
+                    them, one per shard, when sharded.
+                401:
+                    Unauthorized: The bearer token is missing or wrong
+                403:
+                    Forbidden: ADMIN_TOKEN isn't set
+                500:
+                    Internal Server Error
+        """
+        try:
+            statuses = export_status(current_app.config['LEDGER_EXPORT_DIR'])
+
+            # One status per shard when sharded
+            if not shards.enabled:
+                del statuses[0]["shard"]
+                return jsonify(statuses[0])
+
+            return jsonify(statuses)
+
+        except Exception as e:
+            current_app.logger.error(str(e))
+            return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+    @admin_only
+    def post(self):
+        """
+        post:
+            summary: Starts exporting ledger entries, with their account's
+                     type, to Parquet, Arrow or gzipped CSV files in
+                     LEDGER_EXPORT_DIR for analytics, on a background thread.
+                     Carries on from the high water mark of the last export
+                     unless after_id is given. Needs ADMIN_TOKEN as a bearer
+                     token.
+            parameters:
+                OPTIONAL: "format": <string> parquet, arrow or csv
+                OPTIONAL: "rows_per_file": <int> Ledger entries per file
+                OPTIONAL: "after_id": <int> Export the entries after this ledger id
+            responses:
+                202:
+                    Accepted: The export started. GET the Location for its
+                    progress.
+                400:
+                    Bad Request: Most likely a param is invalid
+                401:
+                    Unauthorized: The bearer token is missing or wrong
+                403:
+                    Forbidden: ADMIN_TOKEN isn't set
+                409:
+                    Conflict: An export is already running
+                500:
+                    Internal Server Error
+        """
+        try:
+            file_format = request.values.get('format', current_app.config['LEDGER_EXPORT_FORMAT'])
+            rows_per_file = int(request.values.get('rows_per_file', current_app.config['LEDGER_EXPORT_ROWS_PER_FILE']))
+            after_id = request.values.get('after_id')
+
+            if rows_per_file <= 0:
+                raise ValueError("rows_per_file must be > 0")
+
+            start_export(current_app.config['LEDGER_EXPORT_DIR'], file_format, rows_per_file,
+                         None if after_id is None else int(after_id))
+
+            return {"status": "started"}, status.HTTP_202_ACCEPTED, {"Location": "/admin/exports/ledger"}
+
+        except ValueError as e:
+            current_app.logger.error(str(e))
+            return {"error": "Bad Request"}, status.HTTP_400_BAD_REQUEST
+
+        except ExportInProgress as e:
+            current_app.logger.error(str(e))
+            return {"error": "An export is already running"}, status.HTTP_409_CONFLICT
+
+        except Exception as e:
+            current_app.logger.error(str(e))
             return {"error": "Internal Server Error"}, status.HTTP_500_INTERNAL_SERVER_ERROR
 
 
@@ -446,8 +1060,68 @@ api.add_resource(CustomersController, '/customers/<string:customer_id>')
 api.add_resource(AccountsIndexController, '/customers/<string:customer_id>/accounts')
 api.add_resource(AccountsController, '/customers/<string:customer_id>/accounts/<string:account_id>')
 api.add_resource(LedgerController, '/customers/<string:customer_id>/accounts/<string:account_id>/ledger')
+api.add_resource(BalanceController, '/customers/<string:customer_id>/accounts/<string:account_id>/balance')
+api.add_resource(ActivityController, '/customers/<string:customer_id>/accounts/<string:account_id>/activity')
 api.add_resource(TransferController, '/customers/<string:customer_id>/transfer')
+api.add_resource(TransferBatchController, '/transfers/batch')
+api.add_resource(TransferStatusController, '/customers/<string:customer_id>/transfers/<string:transfer_id>',
+                 '/transfers/<string:transfer_id>')
+api.add_resource(ImportController, '/imports/<string:kind>')
+api.add_resource(LedgerExportController, '/admin/exports/ledger')
+
+
+def create_app(config=None):
+    """
+    Creates the app with every extension and route. config is a config class
+    or the name of one in config.CONFIGS, by default the ACORNS_CONFIG
+    environment variable. Migrations and management commands aren't loaded,
+    manage.py adds them.
+    """
+    app = Flask(__name__)
+    app.config.from_object(config if isinstance(config, type) else get_config(config))
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    db.init_app(app)
+    shards.init_app(app, db)
+    replicas.init_app(app, db)
+    cache.init_app(app)
+    keyring.init_app(app)
+    metrics.init_app(app, db)
+    api.init_app(app)
+
+    app.add_url_rule("/", "hello", hello)
+    app.add_url_rule("/cache/stats", "cache_stats", cache_stats)
+    app.add_url_rule("/metrics", "metrics_endpoint", metrics_endpoint)
+
+    return app
+
+
+def engines(app):
+    return [db.get_engine(app, bind=bind) for bind in [None] + list(app.config['SQLALCHEMY_BINDS'])]
+
+
+def warm(app):
+    """
+    Does the one off setup requests would otherwise pay for on first use. A
+    prefork server that preloads the app runs it in the master, so workers
+    are forked with it done in memory they share. No connections are opened.
+    """
+    orm.configure_mappers()
+
+    with app.app_context():
+        engines(app)
+
+
+def after_fork(app):
+    """
+    Drops the connections a forked worker inherited, they can't be shared
+    between processes.
+    """
+    with app.app_context():
+        for engine in engines(app):
+            engine.dispose()
+
 
 # Main app loop
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
@@ -0,0 +1,19 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the entry point for ASGI servers, e.g.
+
+             uvicorn asgi:app --workers 4
+
+         It needs asyncpg, or aiosqlite for SQLite, besides the server. The
+         app is created for the config named by ACORNS_CONFIG.
+"""
+
+from app import warm
+from async_app import create_asgi_app
+
+app = create_asgi_app()
+warm(app.flask_app)
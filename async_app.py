@@ -0,0 +1,326 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the ASGI serving mode. GET /customers,
+         /customers/<id>/accounts and .../ledger are served with the async
+         database, so a worker keeps thousands of requests waiting on the
+         database at once instead of tying up a thread each. Every other
+         request, transfers included, goes to the Flask app on a thread pool
+         so it keeps its row locking, retries, idempotency keys and cache
+         invalidation.
+"""
+
+import asyncio
+import io
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, request
+from flask_api import status
+from sqlalchemy import and_, or_, select
+from werkzeug.http import quote_etag
+
+from app import create_app
+from async_db import AsyncDatabase
+from helpers import page_args, fields_arg, time_arg, etag_for
+from models import Customers, Accounts, Ledger, blind_index, blind_index_normalizers
+from serializers import RowSerializer, dumps
+
+
+def wsgi_environ(scope, body):
+    """
+    Returns the WSGI environ of an ASGI http request.
+    """
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope["http_version"]),
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+
+        environ[name] = environ[name] + "," + value if name in environ else value
+
+    return environ
+
+
+def page(items, limit, next_id, headers=None):
+    # Same as helpers.paginated
+    headers = list(headers or [])
+
+    if len(items) == limit:
+        headers.append(("X-Next-After-Id", str(next_id)))
+
+    return status.HTTP_200_OK, items, headers
+
+
+# Handlers run in the Flask request context, so they can read and validate
+# params like the controllers do, and return the statement to run with a
+# function making (status, body, headers) of its rows, or None to leave the
+# request to the Flask app. The context can't be held while awaiting since
+# every request on the event loop shares the thread it's kept for.
+
+
+def customers_index():
+    """
+    GET /customers without stream or include, the same page as
+    CustomersIndexController.
+    """
+    if "stream" in request.args or "include" in request.args:
+        return None
+
+    after_id, limit = page_args()
+    serializer = RowSerializer(Customers, fields_arg(Customers))
+    # Labelled so it isn't merged with an id in fields
+    statement = select([Customers.id.label("after_id")] + serializer.columns).where(Customers.id > after_id)
+
+    for field in blind_index_normalizers:
+        if field in request.args:
+            statement = statement.where(getattr(Customers, field + '_bidx') == blind_index(field, request.args[field]))
+
+    def respond(rows):
+        return page([serializer.serialize(row[1:]) for row in rows], limit, rows[-1][0] if rows else None)
+
+    return statement.order_by(Customers.id).limit(limit), respond
+
+
+def accounts_index(customer_id):
+    """
+    GET /customers/<id>/accounts, the same accounts as
+    AccountsIndexController.
+    """
+    serializer = RowSerializer(Accounts, fields_arg(Accounts))
+
+    def respond(rows):
+        return status.HTTP_200_OK, [serializer.serialize(row) for row in rows], []
+
+    return select(serializer.columns).where(Accounts.customer_id == customer_id), respond
+
+
+def ledger(customer_id, account_id):
+    """
+    GET /customers/<id>/accounts/<id>/ledger, the same page and ETag as
+    LedgerController in one query.
+    """
+    after_id, limit = page_args()
+    since = time_arg('since')
+    until = time_arg('until')
+    if_none_match = request.if_none_match
+    query_string = request.query_string
+
+    # Not correlated with the page so it runs once, not once per row. The
+    # ownership check still comes from the join below.
+    latest_id = select([Ledger.id]).where(Ledger.account_id == account_id) \
+        .order_by(Ledger.created_at.desc(), Ledger.id.desc()).limit(1) \
+        .correlate(None).as_scalar()
+
+    conditions = [Ledger.account_id == Accounts.id]
+    window = []
+
+    if since is not None:
+        window.append(Ledger.created_at >= since)
+
+    if until is not None:
+        window.append(Ledger.created_at < until)
+
+    conditions.extend(window)
+
+    if after_id:
+        after = select([Ledger.created_at]).where(and_(Ledger.id == after_id, *window)).correlate(None).as_scalar()
+        conditions.append(or_(Ledger.created_at > after, and_(Ledger.created_at == after, Ledger.id > after_id)))
+
+    serializer = RowSerializer(Ledger, Ledger.fields)
+
+    statement = select([Accounts.id, latest_id] + serializer.columns) \
+        .select_from(Accounts.__table__.outerjoin(Ledger.__table__, and_(*conditions))) \
+        .where(and_(Accounts.customer_id == customer_id, Accounts.id == account_id)) \
+        .order_by(Ledger.created_at, Ledger.id) \
+        .limit(limit)
+
+    def respond(rows):
+        if not rows:
+            return status.HTTP_404_NOT_FOUND, {"error": "Customer with id {} or account with id {} does not exist"
+                                               .format(customer_id, account_id)}, []
+
+        etag = etag_for("ledger", account_id, rows[0][1], query_string=query_string)
+
+        if etag in if_none_match:
+            return status.HTTP_304_NOT_MODIFIED, None, [("ETag", quote_etag(etag))]
+
+        entries = [serializer.serialize(row[2:]) for row in rows if row[2] is not None]
+
+        return page(entries, limit, entries[-1]['id'] if entries else None, [("ETag", quote_etag(etag))])
+
+    return statement, respond
+
+
+# Routes served natively, the rest go to the Flask app. Ids that aren't
+# numbers are left to it too, so they get the same response as under WSGI.
+ROUTES = (
+    (re.compile(r"^/customers$"), customers_index),
+    (re.compile(r"^/customers/(?P<customer_id>\d+)/accounts$"), accounts_index),
+    (re.compile(r"^/customers/(?P<customer_id>\d+)/accounts/(?P<account_id>\d+)/ledger$"), ledger),
+)
+
+
+class AsyncApp(object):
+    """
+    ASGI application wrapping a Flask app created by create_app.
+    """
+
+    def __init__(self, flask_app):
+        config = flask_app.config
+        self.flask_app = flask_app
+        self.database = AsyncDatabase(config['SQLALCHEMY_DATABASE_URI'], config['ASYNC_DATABASE_POOL_SIZE'],
+                                      config['ASYNC_CRYPTO_THREADS'])
+        self.threads = ThreadPoolExecutor(config['ASYNC_WSGI_THREADS'], thread_name_prefix="wsgi")
+
+        # Shard and replica routing happen in the Flask app's request hooks
+        self.routes = () if config['SHARDS'] or config['REPLICAS'] else ROUTES
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        if scope["type"] != "http":
+            return None
+
+        if scope["method"] in ("GET", "HEAD"):
+            for pattern, handler in self.routes:
+                match = pattern.match(scope["path"])
+
+                if match:
+                    # Bound as ints, asyncpg won't take strings for integer params
+                    args = dict((name, int(value)) for name, value in match.groupdict().items())
+                    response = await self.call_native(handler, scope, args)
+
+                    if response is not None:
+                        return await self.respond(send, *response)
+
+        body = await read_body(receive)
+        status_code, headers, chunks = await asyncio.get_event_loop().run_in_executor(
+            self.threads, self.call_wsgi, wsgi_environ(scope, body))
+
+        await send({"type": "http.response.start", "status": status_code,
+                    "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers]})
+        await send({"type": "http.response.body", "body": b"".join(chunks)})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.database.connect()
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+
+                await send({"type": "lifespan.startup.complete"})
+
+            elif message["type"] == "lifespan.shutdown":
+                await self.database.disconnect()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def call_native(self, handler, scope, args):
+        """
+        Runs a native handler and its statement. Returns (status, body,
+        headers), or None when the Flask app has to handle the request.
+        """
+        with self.flask_app.request_context(wsgi_environ(scope, b"")):
+            try:
+                prepared = handler(**args)
+
+            except ValueError as e:
+                current_app.logger.error(str(e))
+                return status.HTTP_400_BAD_REQUEST, {"error": "Bad Request"}, []
+
+            except Exception as e:
+                current_app.logger.error(str(e))
+                return status.HTTP_500_INTERNAL_SERVER_ERROR, {"error": "Internal Server Error"}, []
+
+        if prepared is None:
+            return None
+
+        statement, respond = prepared
+
+        try:
+            return respond(await self.database.fetch(statement))
+
+        except Exception as e:
+            self.flask_app.logger.error(str(e))
+            return status.HTTP_500_INTERNAL_SERVER_ERROR, {"error": "Internal Server Error"}, []
+
+    async def respond(self, send, status_code, data, headers):
+        body = b"" if data is None else dumps(data)
+        headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+        if data is not None:
+            headers.append((b"content-type", b"application/json"))
+
+        headers.append((b"content-length", str(len(body)).encode("latin-1")))
+
+        await send({"type": "http.response.start", "status": status_code, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+    def call_wsgi(self, environ):
+        """
+        Runs a request through the Flask app. Returns its status code, headers
+        and body chunks.
+        """
+        response = {}
+
+        def start_response(status_line, headers, exc_info=None):
+            response["status"] = int(status_line.split(" ", 1)[0])
+            response["headers"] = headers
+
+        result = self.flask_app(environ, start_response)
+
+        try:
+            chunks = list(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+        return response["status"], response["headers"], chunks
+
+
+async def read_body(receive):
+    chunks = []
+
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+def create_asgi_app(config=None):
+    """
+    Creates the ASGI app around create_app(config).
+    """
+    return AsyncApp(create_app(config))
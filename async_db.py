@@ -0,0 +1,165 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the database access of the ASGI serving mode. SQLAlchemy 1.3
+         has no asyncio support, so statements are still built with
+         SQLAlchemy Core from the models and compiled by SQLAlchemy, then run
+         on an async driver, asyncpg for PostgreSQL or aiosqlite for SQLite.
+         Rows are converted by the column types like SQLAlchemy would, on a
+         thread pool when that means decrypting.
+"""
+
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy_utils import EncryptedType
+
+# SQLAlchemy writes numbered params as :1, asyncpg wants $1
+NUMBERED_PARAM = re.compile(r"(?<![:\w]):(\d+)")
+
+
+def process_rows(rows, processors):
+    return [tuple(value if process is None else process(value) for process, value in zip(processors, row))
+            for row in rows]
+
+
+class AsyncDatabase(object):
+    """
+    A pool of pool_size async connections to the database at uri, opened by
+    connect(). Decrypting happens on crypto_threads threads so it doesn't
+    hold up the event loop.
+    """
+
+    def __init__(self, uri, pool_size, crypto_threads):
+        self.url = make_url(uri)
+        self.pool_size = pool_size
+        self.crypto = ThreadPoolExecutor(crypto_threads, thread_name_prefix="crypto")
+        self.pool = None
+        self.lock = None
+
+        backend = self.url.get_backend_name()
+
+        if backend == "postgresql":
+            self.dialect = postgresql.dialect(paramstyle="numeric")
+        elif backend == "sqlite":
+            self.dialect = sqlite.dialect()
+        else:
+            raise ValueError("Async serving needs PostgreSQL or SQLite, not {}".format(backend))
+
+    async def connect(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            if self.pool is not None:
+                return
+
+            if self.dialect.name == "postgresql":
+                import asyncpg
+
+                url = make_url(str(self.url))
+                url.drivername = "postgresql"
+                self.pool = await asyncpg.create_pool(str(url), min_size=1, max_size=self.pool_size)
+
+            else:
+                import aiosqlite
+
+                pool = asyncio.Queue()
+                for _ in range(self.pool_size):
+                    pool.put_nowait(await aiosqlite.connect(self.url.database))
+                self.pool = pool
+
+    async def disconnect(self):
+        pool, self.pool = self.pool, None
+
+        if pool is None:
+            return
+
+        if self.dialect.name == "postgresql":
+            await pool.close()
+        else:
+            while not pool.empty():
+                await pool.get_nowait().close()
+
+    def compile(self, statement):
+        """
+        Returns the SQL of a statement for the driver, its params in order and
+        the types of the columns it returns.
+        """
+        compiled = statement.compile(dialect=self.dialect)
+        params = compiled.construct_params()
+
+        if self.dialect.name == "postgresql":
+            processors = dict((bind.key, self.bind_processor(bind.type)) for bind in compiled.binds.values())
+        else:
+            processors = compiled._bind_processors
+
+        args = [processors[name](params[name]) if processors.get(name) else params[name]
+                for name in compiled.positiontup]
+
+        # Columns selected twice come back once, so take them from the SQL
+        types = [column[-1] for column in compiled._result_columns]
+
+        if self.dialect.name == "postgresql":
+            return NUMBERED_PARAM.sub(r"$\1", compiled.string), args, types
+
+        return compiled.string, args, types
+
+    # The dialect's own processors are for its DBAPI driver. asyncpg already
+    # converts PostgreSQL's types to and from Python, so only the types built
+    # on top of them, like EncryptedType and ChoiceType, have anything to do.
+
+    def bind_processor(self, column_type):
+        if self.dialect.name != "postgresql":
+            return column_type.dialect_impl(self.dialect).bind_processor(self.dialect)
+
+        if isinstance(column_type, TypeDecorator):
+            return lambda value: column_type.process_bind_param(value, self.dialect)
+
+        return None
+
+    def result_processor(self, column_type):
+        if self.dialect.name != "postgresql":
+            return column_type.dialect_impl(self.dialect).result_processor(self.dialect, None)
+
+        if isinstance(column_type, TypeDecorator):
+            return lambda value: column_type.process_result_value(value, self.dialect)
+
+        return None
+
+    async def execute(self, sql, args):
+        if self.pool is None:
+            await self.connect()
+
+        if self.dialect.name == "postgresql":
+            async with self.pool.acquire() as connection:
+                return await connection.fetch(sql, *args)
+
+        connection = await self.pool.get()
+
+        try:
+            async with connection.execute(sql, args) as cursor:
+                return await cursor.fetchall()
+
+        finally:
+            self.pool.put_nowait(connection)
+
+    async def fetch(self, statement):
+        """
+        Runs a select and returns its rows as tuples of converted values.
+        """
+        sql, args, types = self.compile(statement)
+        rows = await self.execute(sql, args)
+        processors = [self.result_processor(column_type) for column_type in types]
+
+        if any(isinstance(column_type, EncryptedType) for column_type in types):
+            return await asyncio.get_event_loop().run_in_executor(self.crypto, process_rows, rows, processors)
+
+        return process_rows(rows, processors)
@@ -0,0 +1,141 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the balance checkpoint code. A periodic job records every
+         account's balance as of a point in time and point in time balances
+         are answered from the nearest checkpoint plus the ledger entries
+         between it and the requested time.
+"""
+
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import case, func
+
+from extensions import db
+from models import Accounts, Ledger, BalanceCheckpoints
+
+# Ledger amounts signed by whether they add to or take from the balance
+signed_amount = case([(Ledger.transaction_type == "credit", Ledger.amount)], else_=-Ledger.amount)
+
+
+def ledger_total(account_id, start=None, end=None):
+    """
+    Returns the sum of the signed ledger amounts of an account created in
+    [start, end). Either bound can be None to leave that side open.
+    """
+    query = db.session.query(func.coalesce(func.sum(signed_amount), 0.0)) \
+        .filter(Ledger.account_id == account_id)
+
+    if start is not None:
+        query = query.filter(Ledger.created_at >= start)
+
+    if end is not None:
+        query = query.filter(Ledger.created_at < end)
+
+    return query.scalar()
+
+
+def balance_at(account, at):
+    """
+    Returns (balance, checkpoint time) for the account at the given time. The
+    nearest checkpoint at or before the time is rolled forward through the
+    ledger. Without one the nearest later checkpoint, or failing that the
+    current balance, is rolled back, so the work depends only on the activity
+    between the checkpoint and the requested time.
+    """
+    checkpoints = BalanceCheckpoints.query.filter(BalanceCheckpoints.account_id == account.id)
+
+    before = checkpoints.filter(BalanceCheckpoints.as_of <= at) \
+        .order_by(BalanceCheckpoints.as_of.desc()).first()
+
+    if before is not None:
+        return before.balance + ledger_total(account.id, before.as_of, at), before.as_of
+
+    after = checkpoints.filter(BalanceCheckpoints.as_of > at) \
+        .order_by(BalanceCheckpoints.as_of).first()
+
+    if after is not None:
+        return after.balance - ledger_total(account.id, at, after.as_of), after.as_of
+
+    return account.balance - ledger_total(account.id, at), None
+
+
+def create_checkpoints(as_of, batch_size):
+    """
+    Records a checkpoint as of the given time for every account that doesn't
+    already have one at or after it. Accounts are processed in id order a batch
+    at a time with a few set based queries and one commit per batch. An account
+    with an earlier checkpoint is rolled forward from it through the ledger. An
+    account without one is seeded from its current balance less the ledger
+    entries since as_of. Returns the number of checkpoints created.
+    """
+    created = 0
+    last_id = 0
+
+    while True:
+        account_ids = [account_id for (account_id,) in db.session.query(Accounts.id)
+                       .filter(Accounts.id > last_id).order_by(Accounts.id).limit(batch_size)]
+
+        if not account_ids:
+            return created
+
+        last_id = account_ids[-1]
+
+        latest_as_of = db.session.query(BalanceCheckpoints.account_id,
+                                        func.max(BalanceCheckpoints.as_of).label("as_of")) \
+            .filter(BalanceCheckpoints.account_id.in_(account_ids)) \
+            .group_by(BalanceCheckpoints.account_id).subquery()
+
+        latest = dict(
+            (checkpoint.account_id, checkpoint)
+            for checkpoint in BalanceCheckpoints.query.join(
+                latest_as_of, (BalanceCheckpoints.account_id == latest_as_of.c.account_id)
+                & (BalanceCheckpoints.as_of == latest_as_of.c.as_of))
+        )
+
+        # Ledger totals between each account's latest checkpoint and as_of
+        forward = dict(
+            db.session.query(Ledger.account_id, func.sum(signed_amount))
+            .join(latest_as_of, Ledger.account_id == latest_as_of.c.account_id)
+            .filter(Ledger.created_at >= latest_as_of.c.as_of, Ledger.created_at < as_of)
+            .group_by(Ledger.account_id)
+        )
+
+        # Current balances less the ledger totals since as_of for the rest
+        unseeded = [account_id for account_id in account_ids if account_id not in latest]
+        backward = {}
+
+        if unseeded:
+            backward = dict(
+                db.session.query(Accounts.id, Accounts.balance - func.coalesce(func.sum(signed_amount), 0.0))
+                .outerjoin(Ledger, (Ledger.account_id == Accounts.id) & (Ledger.created_at >= as_of))
+                .filter(Accounts.id.in_(unseeded))
+                .group_by(Accounts.id, Accounts.balance)
+            )
+
+        rows = []
+
+        for account_id in account_ids:
+            checkpoint = latest.get(account_id)
+
+            if checkpoint is None:
+                balance = backward.get(account_id)
+            elif checkpoint.as_of < as_of:
+                balance = checkpoint.balance + (forward.get(account_id) or 0.0)
+            else:
+                continue
+
+            if balance is not None:
+                rows.append({"account_id": account_id, "as_of": as_of, "balance": balance,
+                             "created_at": datetime.now()})
+
+        if rows:
+            db.session.execute(BalanceCheckpoints.__table__.insert().values(rows))
+
+        db.session.commit()
+        created += len(rows)
+        current_app.logger.info("Created {} balance checkpoints through account {}".format(created, last_id))
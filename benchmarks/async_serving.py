@@ -0,0 +1,248 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: Concurrent connection benchmark of the WSGI app on gunicorn against
+         the ASGI app on uvicorn. Seeds a disposable database like the load
+         test, starts both servers on it, then for each concurrency level
+         holds that many keep-alive connections open sending GETs of the
+         customers, accounts and ledger routes, and reports throughput,
+         p50/p99 latency and errors. The capacity of a server is the most
+         connections it served within the p99 latency SLO without errors.
+         Every table in the database is dropped first, e.g.
+
+             python benchmarks/async_serving.py --concurrency 16 64 256 1024
+             python benchmarks/async_serving.py --database-uri postgresql:///acorns_bench --slo-ms 250
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+from argparse import Namespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import percentile, seed, git_commit  # noqa: E402
+
+STARTUP_TIMEOUT = 30
+
+
+def read_paths(owners, count, rng):
+    """
+    Returns count random GET paths of the routes the ASGI app serves natively.
+    """
+    customer_ids = list(owners)
+    paths = []
+
+    for _ in range(count):
+        customer_id = rng.choice(customer_ids)
+        account_id = rng.choice(owners[customer_id])
+        paths.append(rng.choice([
+            "/customers?after_id={}&limit=20".format(customer_id),
+            "/customers/{}/accounts".format(customer_id),
+            "/customers/{}/accounts/{}/ledger?limit=20".format(customer_id, account_id),
+        ]))
+
+    return paths
+
+
+def start_server(name, port, args):
+    env = dict(os.environ, ACORNS_CONFIG="testing", TEST_DATABASE_URI=args.database_uri)
+
+    if name == "wsgi":
+        env.update(GUNICORN_BIND="127.0.0.1:{}".format(port), GUNICORN_WORKERS=str(args.workers),
+                   GUNICORN_THREADS=str(args.threads))
+        command = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--worker-class", "gthread"]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port),
+                   "--workers", str(args.workers), "--no-access-log", "--backlog", "4096"]
+
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + STARTUP_TIMEOUT
+
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise SystemExit("The {} server exited with {}".format(name, server.returncode))
+
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+
+    server.terminate()
+    raise SystemExit("The {} server didn't start in {} seconds".format(name, STARTUP_TIMEOUT))
+
+
+async def get(reader, writer, path):
+    """
+    Sends a GET on a keep-alive connection and reads the response. Returns
+    its status code and whether the server keeps the connection open.
+    """
+    writer.write("GET {} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".format(path).encode("latin-1"))
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    headers = dict((name.strip().lower(), value.strip()) for name, _, value in
+                   (line.partition(":") for line in lines[1:] if line))
+
+    if headers.get("transfer-encoding") == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if not size:
+                break
+    else:
+        await reader.readexactly(int(headers.get("content-length", 0)))
+
+    return int(lines[0].split(" ")[1]), headers.get("connection", "").lower() != "close"
+
+
+async def connection(port, paths, deadline, latencies, errors, rng):
+    reader = writer = None
+
+    while time.time() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+            started = time.time()
+            status_code, keep_alive = await asyncio.wait_for(get(reader, writer, rng.choice(paths)),
+                                                             deadline + 1 - started)
+
+            if status_code == 200:
+                latencies.append(time.time() - started)
+            else:
+                errors.append(str(status_code))
+
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            errors.append(type(e).__name__)
+            keep_alive = False
+
+            # Don't spin on a refused connection
+            await asyncio.sleep(0.01)
+
+        if not keep_alive and writer is not None:
+            writer.close()
+            reader = writer = None
+
+    if writer is not None:
+        writer.close()
+
+
+async def drive(port, paths, concurrency, args):
+    """
+    Holds concurrency connections open sending requests for args.seconds.
+    """
+    latencies = []
+    errors = []
+    rng = random.Random(args.seed)
+
+    # Unmeasured, so the servers have their connections and caches warm
+    warm = time.time() + args.warmup
+    await asyncio.gather(*[connection(port, paths, warm, [], [], rng) for _ in range(min(concurrency, 16))])
+
+    started = time.time()
+    await asyncio.gather(*[connection(port, paths, started + args.seconds, latencies, errors, rng)
+                           for _ in range(concurrency)])
+    elapsed = time.time() - started
+
+    p99 = percentile(latencies, 0.99)
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "latency_p99_ms": round(p99 * 1000, 2) if latencies else None,
+        "errors": len(errors),
+        "sample_errors": sorted(set(errors))[:5],
+        "within_slo": bool(latencies) and not errors and p99 * 1000 <= args.slo_ms,
+    }
+
+
+def run(args):
+    from app import create_app
+    from extensions import db
+
+    app = create_app("testing")
+    if args.database_uri:
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    else:
+        args.database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+
+    with app.app_context():
+        owners, _, _ = seed(db, Namespace(customers=args.customers, accounts=args.accounts, ledger=args.ledger,
+                                          days=args.days, seed=args.seed))
+        db.session.remove()
+        db.get_engine(app).dispose()
+
+    paths = read_paths(owners, 1000, random.Random(args.seed))
+
+    # Every connection is a file descriptor here and in the servers
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    servers = {}
+
+    for port, name in enumerate(("wsgi", "asgi"), args.port):
+        server = start_server(name, port, args)
+
+        try:
+            levels = [asyncio.run(drive(port, paths, concurrency, args)) for concurrency in args.concurrency]
+        finally:
+            server.terminate()
+            server.wait()
+
+        servers[name] = {
+            "levels": levels,
+            "capacity": max([level["concurrency"] for level in levels if level["within_slo"]] or [0]),
+        }
+
+    return {
+        "commit": git_commit(),
+        "database": args.database_uri.split("://")[0],
+        "customers": args.customers,
+        "workers": args.workers,
+        "wsgi_threads": args.threads,
+        "seconds_per_level": args.seconds,
+        "slo_p99_ms": args.slo_ms,
+        "servers": servers,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WSGI vs ASGI concurrent connection benchmark")
+    parser.add_argument("--database-uri", default=None, help="Defaults to TestingConfig's TEST_DATABASE_URI")
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--accounts", type=int, default=2, help="Accounts per customer")
+    parser.add_argument("--ledger", type=int, default=50, help="Ledger entries per account")
+    parser.add_argument("--days", type=int, default=90, help="Days the ledger entries are spread over")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[16, 64, 256, 1024],
+                        help="Open connections at each level")
+    parser.add_argument("--seconds", type=float, default=10, help="Measured seconds per level")
+    parser.add_argument("--warmup", type=float, default=2, help="Unmeasured seconds per level")
+    parser.add_argument("--slo-ms", type=float, default=500, help="p99 latency a level has to stay within")
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes of each server")
+    parser.add_argument("--threads", type=int, default=8, help="Threads of each gunicorn worker")
+    parser.add_argument("--port", type=int, default=8800, help="The WSGI server's port, the ASGI one uses the next")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args), indent=2, sort_keys=True))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
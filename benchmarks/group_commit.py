@@ -0,0 +1,179 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: Group commit benchmark. Workers each move money between their own
+         pair of accounts, first committing every transfer on its own and then
+         with group commit at each --windows value, and the commits, throughput
+         and latency of every run are compared. Point it at a disposable
+         PostgreSQL database with synchronous_commit on, e.g.
+
+             python benchmarks/group_commit.py \\
+                 --database-uri postgresql:///acorns_bench --workers 64 --windows 1 2 5
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+
+STARTING_BALANCE = 1000000.0
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+
+def seed(db, Customers, Accounts, workers):
+    """
+    Creates a customer with two accounts per worker. Returns
+    [(customer_id, account_id, account_id)].
+    """
+    pairs = []
+    suffix = int(time.time() * 1000)
+
+    for worker in range(workers):
+        customer = Customers("Bench", "Mark", "555-555-5555", "bench@mark.com", "000-00-0000", True)
+        db.session.add(customer)
+        db.session.flush()
+
+        accounts = [Accounts(customer, customer.id, "checking", STARTING_BALANCE,
+                             "group-{}-{}-{}".format(suffix, worker, i), "000000000", "opened", True)
+                    for i in range(2)]
+        db.session.add_all(accounts)
+        db.session.flush()
+        pairs.append((customer.id, accounts[0].id, accounts[1].id))
+
+    db.session.commit()
+
+    return pairs
+
+
+def run_mode(app, db, pairs, transfers, send, amount):
+    """
+    Runs transfers transfers per pair through send on a thread per pair.
+    Returns the stats of the run.
+    """
+    latencies = []
+    failures = []
+    commits = [0]
+    lock = threading.Lock()
+    start_gate = threading.Event()
+
+    def count_commit(conn):
+        with lock:
+            commits[0] += 1
+
+    def worker(customer_id, first_id, second_id):
+        with app.app_context():
+            start_gate.wait()
+            for i in range(transfers):
+                from_id, to_id = (first_id, second_id) if i % 2 else (second_id, first_id)
+                started = time.time()
+                try:
+                    send(customer_id, from_id, to_id, amount)
+                    elapsed = time.time() - started
+                    with lock:
+                        latencies.append(elapsed)
+                except Exception as e:
+                    with lock:
+                        failures.append(str(e))
+            db.session.remove()
+
+    threads = [threading.Thread(target=worker, args=pair) for pair in pairs]
+    for thread in threads:
+        thread.start()
+
+    event.listen(db.engine, "commit", count_commit)
+    started = time.time()
+    start_gate.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    event.remove(db.engine, "commit", count_commit)
+
+    return {
+        "transfers_committed": len(latencies),
+        "transfers_failed": len(failures),
+        "commits": commits[0],
+        "transfers_per_commit": round(len(latencies) / commits[0], 2) if commits[0] else None,
+        "seconds": round(elapsed, 3),
+        "transfers_per_second": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "sample_failures": failures[:5],
+    }
+
+
+def run(args):
+    from app import create_app
+    from extensions import db
+
+    app = create_app()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    if not args.database_uri.startswith("sqlite"):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"pool_size": args.workers + 1, "max_overflow": 0}
+
+    from models import Customers, Accounts
+    from transfers import transfer
+    from group_commit import group_transfer
+
+    with app.app_context():
+        db.create_all()
+        pairs = seed(db, Customers, Accounts, args.workers)
+
+        runs = [dict(run_mode(app, db, pairs, args.transfers, transfer, args.amount),
+                     mode="per_transfer", window_ms=None)]
+
+        app.config['TRANSFER_GROUP_COMMIT_MAX_SIZE'] = args.max_size
+
+        for window in args.windows:
+            app.config['TRANSFER_GROUP_COMMIT_WINDOW'] = window / 1000.0
+            runs.append(dict(run_mode(app, db, pairs, args.transfers, group_transfer, args.amount),
+                             mode="group", window_ms=window))
+
+    baseline = runs[0]
+
+    for result in runs[1:]:
+        if baseline["latency_p50_ms"] is not None and result["latency_p50_ms"] is not None:
+            result["added_latency_p50_ms"] = round(result["latency_p50_ms"] - baseline["latency_p50_ms"], 2)
+        if baseline["transfers_per_second"] and result["transfers_per_second"]:
+            result["throughput_ratio"] = round(result["transfers_per_second"] / baseline["transfers_per_second"], 2)
+
+    return {
+        "database": args.database_uri.split("://")[0],
+        "workers": args.workers,
+        "transfers_per_worker": args.transfers,
+        "max_size": args.max_size,
+        "runs": runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Group commit benchmark")
+    parser.add_argument("--database-uri", default=os.environ.get("BENCH_DATABASE_URI", "postgresql:///acorns_bench"))
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--transfers", type=int, default=100, help="Transfers per worker and mode")
+    parser.add_argument("--windows", type=float, nargs="+", default=[0.5, 1, 2, 5], help="Group windows in ms")
+    parser.add_argument("--max-size", type=int, default=100, help="Largest group")
+    parser.add_argument("--amount", type=float, default=1.0)
+    args = parser.parse_args()
+
+    result = run(args)
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+    return 1 if any(run["transfers_failed"] for run in result["runs"]) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
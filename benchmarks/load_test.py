@@ -0,0 +1,410 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: Load test for every route registered with api.add_resource. Seeds a
+         disposable database with customers, accounts and ledger entries,
+         then sends each route a fixed number of requests from concurrent
+         workers and reports throughput, p50/p95/p99 latency and SQL
+         statements per request as JSON, so runs can be diffed across
+         commits. Requests go through the app in process unless --base-url
+         points at a running server using the same database. Every table in
+         the database is dropped first, e.g.
+
+             python benchmarks/load_test.py --customers 1000 --concurrency 16 > before.json
+             TEST_DATABASE_URI=postgresql:///acorns_bench python benchmarks/load_test.py
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SEED_BATCH_SIZE = 1000
+STARTING_BALANCE = 1000000.0
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+
+def seed(db, args):
+    """
+    Recreates every table and fills them with args.customers customers, each
+    with args.accounts accounts of args.ledger ledger entries spread over the
+    last args.days days, plus a completed queued transfer per customer with
+    more than one account. Returns {customer_id: [account_ids]}, the time the
+    ledger starts at and the queued transfer ids.
+    """
+    from models import Customers, Accounts, Ledger, TransferRequests, blind_index, blind_index_normalizers
+    from balances import create_checkpoints
+    from rollups import rebuild_rollups
+
+    db.drop_all()
+    db.create_all()
+
+    rng = random.Random(args.seed)
+    now = datetime.now()
+    start = now - timedelta(days=args.days)
+
+    for first in range(0, args.customers, SEED_BATCH_SIZE):
+        rows = []
+        for i in range(first, min(args.customers, first + SEED_BATCH_SIZE)):
+            row = {"first_name": "First{}".format(i), "last_name": "Last{}".format(i),
+                   "phone_number": "555-{:03d}-{:04d}".format(i // 10000 % 1000, i % 10000),
+                   "email": "customer{}@example.com".format(i), "ssn": "{:03d}-{:02d}-{:04d}".format(
+                       i // 1000000 % 1000, i // 10000 % 100, i % 10000), "active": True, "created_at": now}
+            for field in blind_index_normalizers:
+                row[field + "_bidx"] = blind_index(field, row[field])
+            rows.append(row)
+        db.session.execute(Customers.__table__.insert().values(rows))
+
+    customer_ids = [customer_id for (customer_id,) in db.session.query(Customers.id).order_by(Customers.id)]
+    accounts = [{"customer_id": customer_id, "account_type": "checking" if n % 2 == 0 else "savings",
+                 "balance": STARTING_BALANCE, "account_number": "{}-{}".format(customer_id, n),
+                 "routing_number": "000000000", "status": "opened", "active": True, "created_at": now}
+                for customer_id in customer_ids for n in range(args.accounts)]
+
+    for first in range(0, len(accounts), SEED_BATCH_SIZE):
+        db.session.execute(Accounts.__table__.insert().values(accounts[first:first + SEED_BATCH_SIZE]))
+
+    owners = {}
+    for account_id, customer_id in db.session.query(Accounts.id, Accounts.customer_id).order_by(Accounts.id):
+        owners.setdefault(customer_id, []).append(account_id)
+
+    ledger = []
+    span = (now - start).total_seconds()
+
+    for account_ids in owners.values():
+        for account_id in account_ids:
+            for _ in range(args.ledger):
+                credit = rng.random() < 0.5
+                ledger.append({"account_id": account_id, "transaction_type": "credit" if credit else "debit",
+                               "amount": round(rng.uniform(1, 100), 2),
+                               "details": "transfer_in" if credit else "transfer_away",
+                               "created_at": start + timedelta(seconds=rng.uniform(0, span))})
+
+            if len(ledger) >= SEED_BATCH_SIZE:
+                db.session.execute(Ledger.__table__.insert().values(ledger))
+                ledger = []
+
+    if ledger:
+        db.session.execute(Ledger.__table__.insert().values(ledger))
+
+    queued = [{"customer_id": customer_id, "from_account_id": account_ids[0], "to_account_id": account_ids[1],
+               "amount": 1.0, "partition": 0, "status": "completed", "attempts": 1, "created_at": now,
+               "completed_at": now}
+              for customer_id, account_ids in owners.items() if len(account_ids) > 1]
+
+    for first in range(0, len(queued), SEED_BATCH_SIZE):
+        db.session.execute(TransferRequests.__table__.insert().values(queued[first:first + SEED_BATCH_SIZE]))
+
+    db.session.commit()
+
+    # Balance and activity reads are served from these so build them like production would have
+    create_checkpoints(start + timedelta(days=args.days // 2), SEED_BATCH_SIZE)
+    rebuild_rollups(SEED_BATCH_SIZE)
+
+    transfer_ids = db.session.query(TransferRequests.customer_id, TransferRequests.id).all()
+
+    return owners, start, transfer_ids
+
+
+def scenarios(owners, start, transfer_ids, args, admin_token):
+    """
+    Returns {(rule, method): make_request} where make_request(rng) returns
+    (method, path, body, content type), plus headers for the admin routes,
+    for one request to that route.
+    """
+    customer_ids = sorted(owners)
+    multi = [customer_id for customer_id in customer_ids if len(owners[customer_id]) > 1]
+    counter = iter(range(1, 1 << 62))
+    lock = threading.Lock()
+    admin = {"Authorization": "Bearer {}".format(admin_token)}
+
+    def unique():
+        with lock:
+            return "{}-{}".format(os.getpid(), next(counter))
+
+    def customer(rng):
+        return rng.choice(customer_ids)
+
+    def account(rng):
+        customer_id = customer(rng)
+        return customer_id, rng.choice(owners[customer_id])
+
+    def some_time(rng):
+        return (start + timedelta(days=rng.uniform(0, args.days))).isoformat()
+
+    def new_customer(rng):
+        key = unique()
+        return {"first_name": "Load", "last_name": key, "phone_number": "555-555-5555",
+                "email": "load-{}@example.com".format(key), "ssn": "000-00-0000", "active": "1"}
+
+    def new_account(rng):
+        return {"account_type": rng.choice(["checking", "savings"]), "balance": "100",
+                "account_number": "load-{}".format(unique()), "routing_number": "000000000",
+                "status": "opened", "active": "1"}
+
+    def transfer_item(rng):
+        customer_id = rng.choice(multi)
+        from_id, to_id = rng.sample(owners[customer_id], 2)
+        return {"customer_id": customer_id, "from_account_id": from_id, "to_account_id": to_id, "amount": 0.01}
+
+    def transfer(rng):
+        item = transfer_item(rng)
+        return ("POST", "/customers/{}/transfer".format(item.pop("customer_id")), item, None)
+
+    def transfer_batch(rng):
+        return ("POST", "/transfers/batch", json.dumps([transfer_item(rng) for _ in range(10)]), "application/json")
+
+    def bulk_import(rng):
+        body = "\n".join(json.dumps(new_customer(rng)) for _ in range(10))
+        return ("POST", "/imports/customers?job_id=load-{}".format(uuid.uuid4().hex), body, "application/x-ndjson",
+                admin)
+
+    account_path = "/customers/{}/accounts/{}"
+
+    return {
+        ("/customers", "GET"):
+            lambda rng: ("GET", "/customers?limit=100&after_id={}".format(customer(rng) - 1), None, None),
+        ("/customers", "POST"):
+            lambda rng: ("POST", "/customers", new_customer(rng), None),
+        ("/customers/<string:customer_id>", "GET"):
+            lambda rng: ("GET", "/customers/{}".format(customer(rng)), None, None),
+        ("/customers/<string:customer_id>", "PUT"):
+            lambda rng: ("PUT", "/customers/{}".format(customer(rng)), {"first_name": unique()}, None),
+        ("/customers/<string:customer_id>/accounts", "GET"):
+            lambda rng: ("GET", "/customers/{}/accounts".format(customer(rng)), None, None),
+        ("/customers/<string:customer_id>/accounts", "POST"):
+            lambda rng: ("POST", "/customers/{}/accounts".format(customer(rng)), new_account(rng), None),
+        ("/customers/<string:customer_id>/accounts/<string:account_id>", "GET"):
+            lambda rng: ("GET", account_path.format(*account(rng)), None, None),
+        ("/customers/<string:customer_id>/accounts/<string:account_id>", "PUT"):
+            lambda rng: ("PUT", account_path.format(*account(rng)), {"routing_number": "111111111"}, None),
+        ("/customers/<string:customer_id>/accounts/<string:account_id>/ledger", "GET"):
+            lambda rng: ("GET", (account_path + "/ledger?limit=50&since={}").format(*account(rng) + (some_time(rng),)),
+                         None, None),
+        ("/customers/<string:customer_id>/accounts/<string:account_id>/balance", "GET"):
+            lambda rng: ("GET", (account_path + "/balance?at={}").format(*account(rng) + (some_time(rng),)),
+                         None, None),
+        ("/customers/<string:customer_id>/accounts/<string:account_id>/activity", "GET"):
+            lambda rng: ("GET", (account_path + "/activity?granularity={}").format(
+                *account(rng) + (rng.choice(["day", "month"]),)), None, None),
+        ("/customers/<string:customer_id>/transfer", "POST"): transfer,
+        ("/transfers/batch", "POST"): transfer_batch,
+        ("/customers/<string:customer_id>/transfers/<string:transfer_id>", "GET"):
+            lambda rng: ("GET", "/customers/{}/transfers/{}".format(*rng.choice(transfer_ids)), None, None),
+        ("/transfers/<string:transfer_id>", "GET"):
+            lambda rng: ("GET", "/transfers/{}".format(rng.choice(transfer_ids)[1]), None, None),
+        ("/imports/<string:kind>", "POST"): bulk_import,
+        ("/admin/exports/ledger", "GET"):
+            lambda rng: ("GET", "/admin/exports/ledger", None, None, admin),
+        ("/admin/exports/ledger", "POST"):
+            lambda rng: ("POST", "/admin/exports/ledger?format=csv", None, None, admin),
+    }
+
+
+def registered_routes(app, api):
+    """
+    Returns (rule, method) for every method of every resource added to the api.
+    """
+    return sorted((rule.rule, method) for rule in app.url_map.iter_rules() if rule.endpoint in api.endpoints
+                  for method in rule.methods - {"HEAD", "OPTIONS"})
+
+
+class InProcessClient(object):
+    """
+    Sends requests through the app without a server. Each thread gets its own test client.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, content_type=None, headers=None):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+
+        kwargs = {"data": body, "headers": headers}
+        if content_type:
+            kwargs["content_type"] = content_type
+
+        response = client.open(path, method=method, **kwargs)
+        return response.status_code, response.get_data()
+
+
+class HttpClient(object):
+    """
+    Sends requests to a running server.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+
+    def request(self, method, path, body=None, content_type=None, headers=None):
+        if isinstance(body, dict):
+            body, content_type = urllib.parse.urlencode(body), "application/x-www-form-urlencoded"
+
+        request = urllib.request.Request(self.base_url + path, method=method,
+                                         data=body.encode("utf-8") if body is not None else None)
+        if content_type:
+            request.add_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            request.add_header(name, value)
+
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+STATEMENTS = re.compile(r'^http_request_sql_statements_(sum|count)\{endpoint="([^"]*)",method="([^"]*)"\} (\S+)$')
+
+
+def statement_totals(client):
+    """
+    Returns {(rule, method): [statements, requests]} read from /metrics.
+    """
+    totals = {}
+
+    for line in client.request("GET", "/metrics")[1].decode("utf-8").splitlines():
+        match = STATEMENTS.match(line)
+        if match:
+            kind, rule, method, value = match.groups()
+            totals.setdefault((rule, method), [0.0, 0.0])[kind == "count"] += float(value)
+
+    return totals
+
+
+def drive(client, route, make_request, args, rng):
+    """
+    Sends args.requests requests to one route from args.concurrency workers
+    after args.warmup unmeasured ones. Returns the route's results.
+    """
+    for _ in range(args.warmup):
+        client.request(*make_request(rng))
+
+    # Generate every request up front so the seeded rng gives the same run every time
+    requests = [make_request(rng) for _ in range(args.requests)]
+    before = statement_totals(client).get(route, [0.0, 0.0])
+
+    def send(request):
+        started = time.time()
+        status_code = client.request(*request)[0]
+        return status_code, time.time() - started
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        responses = list(pool.map(send, requests))
+    elapsed = time.time() - started
+
+    after = statement_totals(client).get(route, [0.0, 0.0])
+    latencies = [latency for _, latency in responses]
+    status_codes = {}
+    for status_code, _ in responses:
+        status_codes[str(status_code)] = status_codes.get(str(status_code), 0) + 1
+    measured = after[1] - before[1]
+
+    return {
+        "route": route[0],
+        "method": route[1],
+        "requests": len(responses),
+        "errors": sum(1 for status_code, _ in responses if status_code >= 400),
+        "status_codes": status_codes,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(responses) / elapsed, 1) if elapsed else None,
+        "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "latency_p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "queries_per_request": round((after[0] - before[0]) / measured, 2) if measured else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    from app import create_app
+    from extensions import api, db
+
+    app = create_app("testing")
+    if args.database_uri:
+        app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+
+    with app.app_context():
+        owners, start, transfer_ids = seed(db, args)
+        db.session.remove()
+
+    routes = registered_routes(app, api)
+    requests = scenarios(owners, start, transfer_ids, args, app.config['ADMIN_TOKEN'])
+
+    missing = [route for route in routes if route not in requests]
+    if missing:
+        raise SystemExit("No load test scenario for {}".format(", ".join("{} {}".format(m, r) for r, m in missing)))
+
+    if not [account_ids for account_ids in owners.values() if len(account_ids) > 1]:
+        raise SystemExit("Transfers need customers with at least two accounts, use --accounts 2 or more")
+
+    client = HttpClient(args.base_url) if args.base_url else InProcessClient(app)
+    selected = [route for route in routes if not args.routes or any(r in route[0] for r in args.routes)]
+    rng = random.Random(args.seed)
+
+    return {
+        "commit": git_commit(),
+        "database": app.config['SQLALCHEMY_DATABASE_URI'].split("://")[0],
+        "mode": "http" if args.base_url else "in_process",
+        "customers": args.customers,
+        "accounts_per_customer": args.accounts,
+        "ledger_per_account": args.ledger,
+        "concurrency": args.concurrency,
+        "seed": args.seed,
+        "routes": [drive(client, route, requests[route], args, rng) for route in selected],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test every API route")
+    parser.add_argument("--database-uri", default=None, help="Defaults to TestingConfig's TEST_DATABASE_URI")
+    parser.add_argument("--base-url", default=None, help="Test a running server instead of the app in process")
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--accounts", type=int, default=2, help="Accounts per customer")
+    parser.add_argument("--ledger", type=int, default=50, help="Ledger entries per account")
+    parser.add_argument("--days", type=int, default=90, help="Days the ledger entries are spread over")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500, help="Measured requests per route")
+    parser.add_argument("--warmup", type=int, default=20, help="Unmeasured requests per route")
+    parser.add_argument("--routes", nargs="*", help="Only test routes containing one of these strings")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args), indent=2, sort_keys=True))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
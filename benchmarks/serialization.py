@@ -0,0 +1,149 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: Serialization benchmark for list endpoints. Serializes the same ledger
+         rows through ORM objects, serialize() and jsonify's encoder, then
+         through the selected columns, RowSerializer and the fast encoder, and
+         reports the time and peak memory of each. Point it at a disposable
+         database, e.g.
+
+             python benchmarks/serialization.py \\
+                 --database-uri postgresql:///acorns_bench --sizes 10000 100000 1000000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SEED_BATCH_SIZE = 10000
+
+
+def seed(db, Customers, Accounts, Ledger, rows):
+    """
+    Creates a customer with one account and that many ledger rows.
+    Returns the account id.
+    """
+    customer = Customers("Bench", "Mark", "555-555-5555", "bench@mark.com", "000-00-0000", True)
+    db.session.add(customer)
+    db.session.flush()
+
+    account = Accounts(customer, customer.id, "checking", 0.0, "bench-{}".format(int(time.time() * 1000)),
+                       "000000000", "opened", True)
+    db.session.add(account)
+    db.session.flush()
+
+    now = datetime.now()
+
+    for start in range(0, rows, SEED_BATCH_SIZE):
+        db.session.execute(Ledger.__table__.insert().values([
+            {
+                "account_id": account.id,
+                "transaction_type": "credit" if i % 2 else "debit",
+                "amount": 1.0,
+                "details": "transfer_in" if i % 2 else "transfer_away",
+                "created_at": now,
+            }
+            for i in range(start, min(rows, start + SEED_BATCH_SIZE))
+        ]))
+
+    db.session.commit()
+
+    return account.id
+
+
+def measure(work):
+    """
+    Returns (seconds, peak MiB, bytes of JSON) for one call of work().
+    """
+    tracemalloc.start()
+    started = time.time()
+    body = work()
+    elapsed = time.time() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return elapsed, peak / (1024.0 * 1024.0), len(body)
+
+
+def run(args):
+    from app import create_app
+    from extensions import db
+
+    app = create_app()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+
+    from flask import json as flask_json
+    from models import Customers, Accounts, Ledger
+    from serializers import RowSerializer, dumps
+
+    results = []
+
+    with app.app_context():
+        db.create_all()
+
+        for size in args.sizes:
+            account_id = seed(db, Customers, Accounts, Ledger, size)
+
+            def orm():
+                entries = Ledger.query.filter(Ledger.account_id == account_id).order_by(Ledger.id).all()
+                return flask_json.dumps([entry.serialize() for entry in entries])
+
+            def rows():
+                serializer = RowSerializer(Ledger, Ledger.fields)
+                entries = db.session.query(*serializer.columns) \
+                    .filter(Ledger.account_id == account_id).order_by(Ledger.id).all()
+                return dumps([serializer.serialize(entry) for entry in entries])
+
+            # Both paths have to produce the same JSON to be worth comparing
+            if json.loads(orm()) != json.loads(rows()):
+                raise AssertionError("Serialized rows differ from serialize()")
+
+            db.session.expunge_all()
+            orm_seconds, orm_peak, orm_bytes = measure(orm)
+            db.session.expunge_all()
+            rows_seconds, rows_peak, rows_bytes = measure(rows)
+            db.session.expunge_all()
+
+            results.append({
+                "rows": size,
+                "orm_seconds": round(orm_seconds, 3),
+                "orm_peak_mib": round(orm_peak, 1),
+                "orm_rows_per_second": round(size / orm_seconds, 1) if orm_seconds else None,
+                "fast_seconds": round(rows_seconds, 3),
+                "fast_peak_mib": round(rows_peak, 1),
+                "fast_rows_per_second": round(size / rows_seconds, 1) if rows_seconds else None,
+                "speedup": round(orm_seconds / rows_seconds, 2) if rows_seconds else None,
+                "json_bytes": rows_bytes,
+                "orm_json_bytes": orm_bytes,
+            })
+
+    return {
+        "database": args.database_uri.split("://")[0],
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List endpoint serialization benchmark")
+    parser.add_argument("--database-uri", default=os.environ.get("BENCH_DATABASE_URI", "sqlite:////tmp/acorns_bench.db"))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="Numbers of ledger rows to serialize")
+    args = parser.parse_args()
+
+    print(json.dumps(run(args), indent=2, sort_keys=True))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
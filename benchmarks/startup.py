@@ -0,0 +1,134 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: Startup benchmark. Times importing the app, the app with the
+         management commands and creating it, each in a fresh interpreter,
+         then how long a forked worker takes to answer its first request when
+         it has to import and create the app itself and when the master
+         preloaded it, like gunicorn with and without preload_app, e.g.
+
+             python benchmarks/startup.py --runs 10
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+STATEMENTS = {
+    "import_app": "import app",
+    "import_manage": "import manage",
+    "create_app": "from app import create_app, warm; warm(create_app())",
+}
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+
+def time_statement(statement, runs):
+    """
+    Returns the median seconds statement takes in a fresh interpreter,
+    measured inside it so interpreter startup isn't counted, or None if it
+    fails.
+    """
+    code = "import time; started = time.time(); {}; print(time.time() - started)".format(statement)
+    timings = []
+
+    for _ in range(runs):
+        try:
+            output = subprocess.check_output([sys.executable, "-c", code], cwd=ROOT, stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            return None
+
+        timings.append(float(output.decode().split()[-1]))
+
+    return median(timings)
+
+
+def first_response(load, path):
+    """
+    Forks a worker that calls load() for the app and sends it one request,
+    like a prefork server booting a worker. Returns the seconds from the fork
+    to the response and its status code.
+    """
+    read_end, write_end = os.pipe()
+    started = time.time()
+    pid = os.fork()
+
+    if pid == 0:
+        os.close(read_end)
+        status_code = load().test_client().get(path).status_code
+        os.write(write_end, "{} {}".format(time.time() - started, status_code).encode())
+        os._exit(0)
+
+    os.close(write_end)
+    with os.fdopen(read_end) as reader:
+        elapsed, status_code = reader.read().split()
+    os.waitpid(pid, 0)
+
+    return float(elapsed), int(status_code)
+
+
+def cold_load():
+    from app import create_app, warm
+
+    app = create_app()
+    warm(app)
+
+    return app
+
+
+def run(args):
+    os.environ["ACORNS_CONFIG"] = "testing"
+    if args.database_uri:
+        os.environ["TEST_DATABASE_URI"] = args.database_uri
+
+    # Tables for the request, created without importing the app here
+    subprocess.check_call([sys.executable, "-c", "from app import create_app; from extensions import db; "
+                           "app = create_app(); app.app_context().push(); db.create_all()"], cwd=ROOT)
+
+    result = dict((name, time_statement(statement, args.runs)) for name, statement in STATEMENTS.items())
+
+    # Nothing of the app is imported yet so these workers start from scratch
+    cold = [first_response(cold_load, args.path) for _ in range(args.runs)]
+
+    app = cold_load()
+    preloaded = [first_response(lambda: app, args.path) for _ in range(args.runs)]
+
+    result.update({
+        "path": args.path,
+        "runs": args.runs,
+        "status_codes": sorted(set(status_code for _, status_code in cold + preloaded)),
+        "worker_first_response_cold": median([elapsed for elapsed, _ in cold]),
+        "worker_first_response_preloaded": median([elapsed for elapsed, _ in preloaded]),
+    })
+    result["preload_speedup"] = round(result["worker_first_response_cold"] /
+                                      result["worker_first_response_preloaded"], 1)
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time and worker startup benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="Runs of each measurement, the median is reported")
+    parser.add_argument("--path", default="/customers?limit=1", help="First request each worker serves")
+    parser.add_argument("--database-uri", default=None, help="Defaults to TestingConfig's database")
+    args = parser.parse_args()
+
+    print(json.dumps(run(args), indent=2, sort_keys=True))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: Contention benchmark for the transfer engine. Many workers move money
+         in and out of a single hot account at the same time. Afterwards every
+         balance is checked against its ledger to prove no update was lost.
+         Point it at a disposable PostgreSQL database, e.g.
+
+             python benchmarks/transfer_contention.py \\
+                 --database-uri postgresql:///acorns_bench --workers 64
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import case, func  # noqa: E402
+
+STARTING_BALANCE = 1000000.0
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+
+def case_amount(Ledger, transaction_type):
+    return case([(Ledger.transaction_type == transaction_type, Ledger.amount)], else_=0)
+
+
+def seed(db, Customers, Accounts, peers):
+    """
+    Creates a fresh customer with one hot account and a peer account per worker.
+    Returns (customer_id, hot_account_id, [peer_account_ids]).
+    """
+    customer = Customers("Bench", "Mark", "555-555-5555", "bench@mark.com", "000-00-0000", True)
+    db.session.add(customer)
+    db.session.flush()
+
+    suffix = "{}-{}".format(customer.id, int(time.time() * 1000))
+    accounts = [
+        Accounts(customer, customer.id, "checking", STARTING_BALANCE,
+                 "bench-{}-{}".format(suffix, i), "000000000", "opened", True)
+        for i in range(peers + 1)
+    ]
+    db.session.add_all(accounts)
+    db.session.commit()
+
+    return customer.id, accounts[0].id, [account.id for account in accounts[1:]]
+
+
+def run(args):
+    from app import create_app
+    from extensions import db
+
+    app = create_app()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    if not args.database_uri.startswith("sqlite"):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"pool_size": args.workers, "max_overflow": 0}
+
+    from models import Customers, Accounts, Ledger
+    from transfers import transfer
+
+    with app.app_context():
+        db.create_all()
+        customer_id, hot_id, peer_ids = seed(db, Customers, Accounts, args.workers)
+
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+    start_gate = threading.Event()
+
+    def worker(peer_id):
+        with app.app_context():
+            start_gate.wait()
+            for i in range(args.transfers):
+                # Alternate direction so the hot account is both debited and credited
+                from_id, to_id = (hot_id, peer_id) if i % 2 else (peer_id, hot_id)
+                started = time.time()
+                try:
+                    transfer(customer_id, from_id, to_id, args.amount)
+                    elapsed = time.time() - started
+                    with lock:
+                        latencies.append(elapsed)
+                except Exception as e:
+                    with lock:
+                        failures.append(str(e))
+            db.session.remove()
+
+    threads = [threading.Thread(target=worker, args=(peer_id,)) for peer_id in peer_ids]
+    for thread in threads:
+        thread.start()
+
+    started = time.time()
+    start_gate.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    with app.app_context():
+        # Any balance that disagrees with the sum of its ledger lost an update
+        credits = func.sum(case_amount(Ledger, "credit"))
+        debits = func.sum(case_amount(Ledger, "debit"))
+        ledger_totals = dict(
+            (row[0], (row[1] or 0) - (row[2] or 0))
+            for row in db.session.query(Ledger.account_id, credits, debits)
+            .filter(Ledger.account_id.in_([hot_id] + peer_ids))
+            .group_by(Ledger.account_id)
+        )
+        balances = db.session.query(Accounts.id, Accounts.balance) \
+            .filter(Accounts.id.in_([hot_id] + peer_ids)).all()
+
+        lost_updates = sum(
+            1 for account_id, balance in balances
+            if abs(balance - (STARTING_BALANCE + ledger_totals.get(account_id, 0))) > 1e-6
+        )
+        money_created = sum(balance for _, balance in balances) - STARTING_BALANCE * len(balances)
+
+    return {
+        "database": args.database_uri.split("://")[0],
+        "workers": args.workers,
+        "transfers_attempted": args.workers * args.transfers,
+        "transfers_committed": len(latencies),
+        "transfers_failed": len(failures),
+        "seconds": round(elapsed, 3),
+        "transfers_per_second": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        "lost_updates": lost_updates,
+        "money_created": round(money_created, 6),
+        "sample_failures": failures[:5],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transfer engine contention benchmark")
+    parser.add_argument("--database-uri", default=os.environ.get("BENCH_DATABASE_URI", "postgresql:///acorns_bench"))
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--transfers", type=int, default=100, help="Transfers per worker")
+    parser.add_argument("--amount", type=float, default=1.0)
+    args = parser.parse_args()
+
+    result = run(args)
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+    return 1 if result["lost_updates"] or result["money_created"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
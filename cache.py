@@ -0,0 +1,248 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the read through cache for customer and account reads.
+         Entries live in an in process LRU or, when CACHE_SHARED_URL is set,
+         in a shared cache server. Entries holding decrypted PII only ever go
+         in the in process LRU.
+
+         Every cached resource has a generation token. Entries are stored with
+         the token that was current when their data was loaded and writers
+         invalidate a resource by replacing its token, which makes every
+         cached variant of it stale at once. With a shared server the tokens
+         live there, so a write in one process also invalidates the PII
+         entries cached in every other process.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import json
+
+
+class LRUBackend(object):
+    """
+    In process cache with a per entry TTL that evicts the least recently used
+    entry once it holds max_entries.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return None
+
+            if entry[0] is not None and entry[0] < time.time():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        """
+        Sets the key only if it isn't already set. Returns the value now stored.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and (entry[0] is None or entry[0] >= time.time()):
+                return entry[1]
+
+            self._set(key, value, ttl)
+            return value
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def _set(self, key, value, ttl):
+        self.entries[key] = (time.time() + ttl if ttl else None, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class SharedBackend(object):
+    """
+    Cache on a shared server. client is anything with the get, set (with ex
+    and nx) and delete methods of a redis client. Values are stored as JSON.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key):
+        value = self.client.get(key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, json.dumps(value), ex=ttl)
+
+    def add(self, key, value, ttl=None):
+        if self.client.set(key, json.dumps(value), ex=ttl, nx=True):
+            return value
+
+        return self.get(key)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+class FakeSharedClient(object):
+    """
+    In process stand in for a shared cache server client. Values round trip
+    through bytes like they would over the network. Set CACHE_SHARED_URL to
+    fake:// to use it.
+    """
+
+    def __init__(self):
+        self.backend = LRUBackend(max_entries=float("inf"))
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        value = value.encode("utf-8") if not isinstance(value, bytes) else value
+
+        if nx:
+            return self.backend.add(key, value, ex) is value
+
+        self.backend.set(key, value, ex)
+        return True
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+
+def shared_client(url):
+    """
+    Makes a client for the shared cache server at url.
+    """
+    if url.startswith("fake://"):
+        return FakeSharedClient()
+
+    # Only needed when a shared cache server is configured
+    import redis
+    return redis.StrictRedis.from_url(url)
+
+
+class Cache(object):
+    """
+    Read through cache with hit and miss counters. Configured from CACHE_*
+    in the app config, following the Flask extension pattern.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.local = None
+        self.shared = None
+        self.lock = threading.Lock()
+        self.counters = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['CACHE_ENABLED']
+        self.local_ttl = app.config['CACHE_LOCAL_TTL']
+        self.shared_ttl = app.config['CACHE_SHARED_TTL']
+        self.local = LRUBackend(app.config['CACHE_LOCAL_MAX_ENTRIES'])
+        self.shared = SharedBackend(shared_client(app.config['CACHE_SHARED_URL'])) \
+            if app.config['CACHE_SHARED_URL'] else None
+        self.reset_stats()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def reset_stats(self):
+        with self.lock:
+            self.counters = {"local_hits": 0, "local_misses": 0, "shared_hits": 0, "shared_misses": 0,
+                             "invalidations": 0}
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def generation(self, key):
+        """
+        Returns the current generation token of a resource, creating one if it
+        doesn't have one. A token that was evicted comes back as a new one so
+        entries stored under the old token can never be mistaken as current.
+        """
+        backend = self.shared or self.local
+        return backend.add("generation:" + key, uuid.uuid4().hex)
+
+    def read(self, key, load, variant="", pii=False):
+        """
+        Returns the cached value of a variant of the resource key, calling
+        load() to get it on a miss. Values holding PII are only cached in
+        process. None is never cached, and exceptions from load() propagate
+        without caching anything.
+        """
+        if not self.enabled:
+            return load()
+
+        generation = self.generation(key)
+        backend, name, ttl = (self.local, "local", self.local_ttl) if pii or self.shared is None \
+            else (self.shared, "shared", self.shared_ttl)
+
+        entry_key = "{}|{}".format(key, variant)
+        entry = backend.get(entry_key)
+
+        if entry is not None and entry[0] == generation:
+            self.count(name + "_hits")
+            return entry[1]
+
+        self.count(name + "_misses")
+        value = load()
+
+        if value is not None:
+            backend.set(entry_key, [generation, value], ttl)
+
+        return value
+
+    def invalidate(self, *keys):
+        """
+        Makes every cached variant of the given resources stale. Call it after
+        the write that changed them has been committed.
+        """
+        if not self.enabled:
+            return
+
+        backend = self.shared or self.local
+
+        for key in set(keys):
+            backend.set("generation:" + key, uuid.uuid4().hex)
+            self.count("invalidations")
+
+
+# Keys of the cached resources. Ids are normalized to ints so "01" and "1"
+# name the same resource. Raises ValueError for ids that aren't integers.
+def customer_key(customer_id):
+    return "customer:{}".format(int(customer_id))
+
+
+def accounts_key(customer_id):
+    return "accounts:{}".format(int(customer_id))
+
+
+def account_key(customer_id, account_id):
+    return "account:{}:{}".format(int(customer_id), int(account_id))
@@ -8,6 +8,7 @@ Summary: This is the configuration file for flask.
 """
 
 import os
+import tempfile
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -19,6 +20,158 @@ class Config(object):
     SECRET_KEY = 'AyLjQJ$!}mP2Em.'
     SQLALCHEMY_DATABASE_URI = "postgresql:///acorns_take_home"
 
+    # Bearer token for the /admin endpoints, which are turned off while it's None
+    ADMIN_TOKEN = None
+
+    # Key for the HMAC blind indexes that let encrypted customer fields be
+    # looked up by exact match. Changing it requires rebuilding the indexes.
+    BLIND_INDEX_KEY = '9c3Fq!7tVx#2LmR8'
+
+    # AES keys of the encrypted customer fields by id. Values are written with
+    # ENCRYPTION_KEY_ID's key and record its id, values from before key ids
+    # were recorded are read with LEGACY_ENCRYPTION_KEY_ID's. To rotate, add a
+    # key, make it ENCRYPTION_KEY_ID everywhere, run manage.py rotate_keys and
+    # then remove the old key.
+    ENCRYPTION_KEYS = {"1": "F21998729FE5D4BCCE8A4FAADE659"}
+    ENCRYPTION_KEY_ID = "1"
+    LEGACY_ENCRYPTION_KEY_ID = "1"
+
+    # Key rotation re-encrypts customers in id ranges of
+    # KEY_ROTATION_CHUNK_SIZE, one transaction each, on KEY_ROTATION_WORKERS
+    # processes that together rewrite at most KEY_ROTATION_ROWS_PER_SECOND
+    # rows a second. None means no limit.
+    KEY_ROTATION_CHUNK_SIZE = 1000
+    KEY_ROTATION_WORKERS = 4
+    KEY_ROTATION_ROWS_PER_SECOND = 2000
+
+    # Customer sharding. SHARDS lists the SQLALCHEMY_BINDS keys of the shard
+    # databases, None for the default database, which also keeps the tables
+    # that aren't sharded. Empty means no sharding. Run manage.py
+    # configure_shards once the shards exist so each one hands out ids in its
+    # own residue class modulo SHARD_ID_STRIDE, and set SHARD_LEGACY_MAX_ID to
+    # the highest customer id from before sharding, which stay on the first
+    # shard. Moved customers are looked up every SHARD_DIRECTORY_TTL seconds.
+    SHARDS = []
+    SQLALCHEMY_BINDS = {}
+    SHARD_ID_STRIDE = 64
+    SHARD_LEGACY_MAX_ID = 0
+    SHARD_DIRECTORY_TTL = 5
+    SHARD_REBALANCE_BATCH_SIZE = 5000
+
+    # Read replicas. REPLICAS maps the bind key of a primary, None for the
+    # default database, to the SQLALCHEMY_BINDS keys of its replicas, e.g.
+    # {None: ["replica"]}. GET requests read from a random replica of each
+    # primary. After a write the client gets a read-after token and its reads
+    # wait up to REPLICA_WAIT_TIMEOUT seconds for the replica to replay the
+    # write, polling every REPLICA_POLL_INTERVAL, and go to the primary if it
+    # doesn't. Databases other than PostgreSQL can't report replay positions,
+    # so reads go to the primary for REPLICA_PIN_SECONDS after a write.
+    REPLICAS = {}
+    REPLICA_WAIT_TIMEOUT = 0.05
+    REPLICA_POLL_INTERVAL = 0.01
+    REPLICA_PIN_SECONDS = 5
+    REPLICA_TOKEN_MAX_AGE = 300
+
+    # Read through cache for customer and account reads. Without a shared
+    # cache server entries are only invalidated in the process that made the
+    # write, so keep CACHE_LOCAL_TTL short when running several processes.
+    # PII is only ever cached in process.
+    CACHE_ENABLED = True
+    CACHE_LOCAL_MAX_ENTRIES = 10000
+    CACHE_LOCAL_TTL = 5
+    CACHE_SHARED_URL = None  # e.g. redis://localhost:6379/0, or fake:// for an in process fake
+    CACHE_SHARED_TTL = 300
+
+    # ASGI serving mode (asgi.py). Async connections per worker, threads
+    # decrypting customer fields and threads running the requests that go
+    # through the Flask app.
+    ASYNC_DATABASE_POOL_SIZE = 20
+    ASYNC_CRYPTO_THREADS = 4
+    ASYNC_WSGI_THREADS = 16
+
+    # Request, SQL and encryption timings served from /metrics
+    METRICS_ENABLED = True
+
+    # Keyset pagination for list endpoints
+    DEFAULT_PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+
+    # Number of rows fetched per round trip when streaming a response
+    STREAM_BATCH_SIZE = 1000
+
+    # Ledger entries per account embedded by ?include=accounts.recent_ledger
+    RECENT_LEDGER_SIZE = 5
+
+    # Retries for transfers that hit a serialization failure or deadlock.
+    # Backoff is in seconds and grows with each attempt.
+    TRANSFER_MAX_RETRIES = 5
+    TRANSFER_RETRY_BACKOFF = 0.01
+
+    # With TRANSFER_GROUP_COMMIT, transfers from POST /transfer that arrive
+    # within the window in seconds, up to MAX_SIZE of them, are committed
+    # together in one transaction with a savepoint each. Each request waits up
+    # to the window longer in exchange for far fewer commits. A transfer that
+    # isn't committed within the timeout is committed on its own if its group
+    # hadn't started, and answered with a 503 if it had.
+    TRANSFER_GROUP_COMMIT = False
+    TRANSFER_GROUP_COMMIT_WINDOW = 0.002
+    TRANSFER_GROUP_COMMIT_MAX_SIZE = 100
+    TRANSFER_GROUP_COMMIT_TIMEOUT = 5
+
+    # Transfers applied per transaction by POST /transfers/batch
+    TRANSFER_BATCH_CHUNK_SIZE = 1000
+
+    # With TRANSFER_ASYNC (or ?async=true) POST /transfer queues transfers for
+    # the workers started by manage.py transfer_workers. Transfers are
+    # partitioned by from account. Only change the number of partitions while
+    # the queue is empty.
+    TRANSFER_ASYNC = False
+    TRANSFER_QUEUE_PARTITIONS = 64
+    TRANSFER_QUEUE_WORKERS = 4
+    TRANSFER_QUEUE_BATCH_SIZE = 100
+    TRANSFER_QUEUE_POLL_INTERVAL = 0.5
+
+    # Idempotency-Key support for POST endpoints. Keys are kept for the TTL in
+    # seconds. A retry that arrives while the first request is running waits
+    # up to IDEMPOTENCY_WAIT_TIMEOUT seconds for its response. A claim that
+    # hasn't completed after IDEMPOTENCY_CLAIM_LEASE seconds, e.g. because its
+    # process died, is taken over by the next request with the key, so keep
+    # it longer than any request runs.
+    IDEMPOTENCY_KEY_TTL = 86400
+    IDEMPOTENCY_CLAIM_LEASE = 60
+    IDEMPOTENCY_WAIT_TIMEOUT = 30
+    IDEMPOTENCY_POLL_INTERVAL = 0.05
+    IDEMPOTENCY_EXPIRE_BATCH_SIZE = 1000
+
+    # Bulk imports commit this many rows per chunk and report at most this many
+    # row errors back to the caller
+    IMPORT_CHUNK_SIZE = 5000
+    IMPORT_MAX_REPORTED_ERRORS = 1000
+
+    # Accounts checkpointed per transaction by the balance checkpoint job
+    CHECKPOINT_BATCH_SIZE = 1000
+
+    # Accounts rebuilt per transaction by the activity rollup rebuild
+    ROLLUP_REBUILD_BATCH_SIZE = 500
+
+    # Monthly Ledger partitions on PostgreSQL. manage.py ledger_partitions
+    # creates partitions this many months ahead and, when
+    # LEDGER_ARCHIVE_AFTER_MONTHS is set, archives older months to gzipped CSV
+    # files in LEDGER_ARCHIVE_DIR and drops them.
+    LEDGER_PARTITION_MONTHS_AHEAD = 3
+    LEDGER_ARCHIVE_AFTER_MONTHS = None
+    LEDGER_ARCHIVE_DIR = os.path.join(basedir, "archive")
+
+    # Ledger exports for analytics by manage.py export_ledger and, on a
+    # background thread, POST /admin/exports/ledger. Files hold
+    # LEDGER_EXPORT_ROWS_PER_FILE rows each, entries newer than
+    # LEDGER_EXPORT_LAG seconds wait for the next export. Parquet and Arrow
+    # need pyarrow installed.
+    LEDGER_EXPORT_DIR = os.path.join(basedir, "exports")
+    LEDGER_EXPORT_FORMAT = "parquet"
+    LEDGER_EXPORT_ROWS_PER_FILE = 500000
+    LEDGER_EXPORT_LAG = 300
+
 
 class ProductionConfig(Config):
     DEBUG = True
@@ -37,3 +190,31 @@ class DevelopmentConfig(Config):
 
 class TestingConfig(Config):
     TESTING = True
+
+    # Disposable database for benchmarks and load tests. They drop every table in it.
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "TEST_DATABASE_URI", "sqlite:///" + os.path.join(tempfile.gettempdir(), "acorns_test.db"))
+    LEDGER_EXPORT_DIR = os.path.join(tempfile.gettempdir(), "acorns_test_exports")
+    ADMIN_TOKEN = "acorns-test-admin-token"
+
+
+# Configs by the name create_app takes, by default from ACORNS_CONFIG
+CONFIGS = {
+    "production": ProductionConfig,
+    "staging": StagingConfig,
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+}
+
+
+def get_config(name=None):
+    """
+    Returns the config class called name, or named by the ACORNS_CONFIG
+    environment variable, production when neither is set.
+    """
+    name = name or os.environ.get("ACORNS_CONFIG", "production")
+
+    if name not in CONFIGS:
+        raise ValueError("Unknown config {}, use one of {}".format(name, ", ".join(sorted(CONFIGS))))
+
+    return CONFIGS[name]
@@ -0,0 +1,128 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is key versioned encryption of the customer fields. Every
+         ciphertext starts with the id of the key it was encrypted with, so
+         values are always written with ENCRYPTION_KEY_ID's key and read with
+         whichever key wrote them, and keys can be rotated without decrypting
+         everything at once. Values from before key ids were recorded are
+         read with LEGACY_ENCRYPTION_KEY_ID's key.
+"""
+
+import threading
+
+from sqlalchemy_utils import EncryptedType
+from sqlalchemy_utils.types.encrypted.encrypted_type import AesEngine
+
+# Separates the key id from the base64 ciphertext, which never contains it
+KEY_ID_SEPARATOR = ":"
+
+
+class Keyring(object):
+    """
+    Holds the encryption keys, following the Flask extension pattern. It's
+    used by column types outside of any app context, e.g. when rows are
+    decrypted on a thread pool, so it keeps what it needs from the config.
+    """
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.keys = {}
+        self.key_id = None
+        self.legacy_key_id = None
+        self.engines = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        keys = dict(app.config['ENCRYPTION_KEYS'])
+        key_id = app.config['ENCRYPTION_KEY_ID']
+
+        for name in keys:
+            if not name or KEY_ID_SEPARATOR in name:
+                raise ValueError("Encryption key id {!r} can't be empty or contain {!r}"
+                                 .format(name, KEY_ID_SEPARATOR))
+
+        if key_id not in keys:
+            raise ValueError("ENCRYPTION_KEY_ID {} isn't in ENCRYPTION_KEYS".format(key_id))
+
+        with self.lock:
+            self.keys = keys
+            self.key_id = key_id
+            self.legacy_key_id = app.config['LEGACY_ENCRYPTION_KEY_ID']
+            self.engines = {}
+
+    def engine(self, key_id, engine_class, padding):
+        """
+        Returns an engine of engine_class set up with the key. Setting a key
+        hashes it and builds the cipher, so there's one engine per key rather
+        than setting the key on every call like EncryptedType does.
+        """
+        engine = self.engines.get((key_id, engine_class, padding))
+
+        if engine is not None:
+            return engine
+
+        if key_id not in self.keys:
+            raise ValueError("Unknown encryption key id {}".format(key_id))
+
+        engine = engine_class()
+        if isinstance(engine, AesEngine):
+            engine._set_padding_mechanism(padding)
+        engine._update_key(self.keys[key_id])
+
+        with self.lock:
+            return self.engines.setdefault((key_id, engine_class, padding), engine)
+
+    def key_id_of(self, ciphertext):
+        """
+        Returns the id of the key a stored value was encrypted with.
+        """
+        if isinstance(ciphertext, bytes):
+            ciphertext = ciphertext.decode("utf-8")
+
+        key_id, separator, _ = ciphertext.partition(KEY_ID_SEPARATOR)
+        return key_id if separator else self.legacy_key_id
+
+
+class VersionedEncryptedType(EncryptedType):
+    """
+    EncryptedType for string columns that stores the id of the key each value
+    was encrypted with in front of it, e.g. 2:7lwQfJDh...
+    """
+
+    def __init__(self, type_in, keyring, engine, padding):
+        super(VersionedEncryptedType, self).__init__(type_in, None, engine, padding)
+        self.keyring = keyring
+        self.engine_class = engine
+        self.padding = padding
+
+    def encrypt(self, value, key_id):
+        engine = self.keyring.engine(key_id, self.engine_class, self.padding)
+        return "{}{}{}".format(key_id, KEY_ID_SEPARATOR, engine.encrypt(value)).encode("utf-8")
+
+    def decrypt(self, ciphertext):
+        if isinstance(ciphertext, bytes):
+            ciphertext = ciphertext.decode("utf-8")
+
+        key_id, separator, value = ciphertext.partition(KEY_ID_SEPARATOR)
+        if not separator:
+            key_id, value = self.keyring.legacy_key_id, ciphertext
+
+        return self.keyring.engine(key_id, self.engine_class, self.padding).decrypt(value)
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+
+        return self.encrypt(value, self.keyring.key_id)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+
+        return self.decrypt(value)
@@ -0,0 +1,293 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the ledger export for analytics. Ledger entries, with their
+         account's type, are read in id order through a server side cursor and
+         written to Parquet, Arrow or gzipped CSV files of a fixed number of
+         rows, so memory stays bounded by one file's rows. Each export records
+         the last id it wrote as a high water mark in the directory's
+         manifest.json and the next export carries on after it. The admin
+         endpoint runs exports on a background thread.
+"""
+
+import csv
+import fcntl
+import gzip
+import io
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import type_coerce
+
+from extensions import db, shards
+from models import Accounts, Ledger
+
+FORMATS = ("parquet", "arrow", "csv")
+EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow", "csv": ".csv.gz"}
+COLUMNS = ("id", "account_id", "account_type", "transaction_type", "amount", "details", "created_at")
+MANIFEST = "manifest.json"
+LOCK = ".lock"
+
+
+class ExportInProgress(Exception):
+    pass
+
+
+def arrow_table(rows):
+    # Only needed for the Parquet and Arrow formats
+    import pyarrow
+
+    schema = pyarrow.schema([
+        ("id", pyarrow.int64()),
+        ("account_id", pyarrow.int64()),
+        ("account_type", pyarrow.string()),
+        ("transaction_type", pyarrow.string()),
+        ("amount", pyarrow.float64()),
+        ("details", pyarrow.string()),
+        ("created_at", pyarrow.timestamp("us")),
+    ])
+
+    return pyarrow.Table.from_arrays([pyarrow.array([row[i] for row in rows], type=field.type)
+                                      for i, field in enumerate(schema)], schema=schema)
+
+
+def write_file(rows, path, file_format):
+    """
+    Writes rows to path in the given format.
+    """
+    if file_format == "parquet":
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(arrow_table(rows), path, compression="snappy")
+
+    elif file_format == "arrow":
+        import pyarrow
+        table = arrow_table(rows)
+        with pyarrow.OSFile(path, "wb") as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    else:
+        with io.TextIOWrapper(gzip.open(path, "wb"), encoding="utf-8", newline="") as archive:
+            writer = csv.writer(archive)
+            writer.writerow(COLUMNS)
+            writer.writerows(rows)
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+
+    if not os.path.exists(path):
+        return {"high_water_mark": 0, "files": []}
+
+    with open(path) as manifest:
+        return json.load(manifest)
+
+
+def write_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+
+    with open(path + ".partial", "w") as partial:
+        json.dump(manifest, partial, indent=2)
+
+    os.rename(path + ".partial", path)
+
+
+def ledger_rows(after_id):
+    """
+    Yields the export columns of every ledger entry with an id above after_id,
+    in id order, through a server side cursor.
+    """
+    query = db.session.query(
+        Ledger.id, Ledger.account_id,
+        type_coerce(Accounts.account_type, Accounts.account_type.type.impl),
+        type_coerce(Ledger.transaction_type, Ledger.transaction_type.type.impl),
+        Ledger.amount,
+        type_coerce(Ledger.details, Ledger.details.type.impl),
+        Ledger.created_at) \
+        .join(Accounts, Accounts.id == Ledger.account_id) \
+        .filter(Ledger.id > after_id).order_by(Ledger.id)
+
+    return query.yield_per(current_app.config['STREAM_BATCH_SIZE'])
+
+
+def export_ledger(directory, file_format, rows_per_file, after_id=None):
+    """
+    Exports the ledger entries after after_id, or after the directory's high
+    water mark when it is None, to files of rows_per_file rows named by their
+    first and last ids. The manifest is updated after every file so an
+    interrupted export carries on from the last complete file.
+
+    Ids are handed out before a transfer commits, so an entry can show up
+    after entries with higher ids. Entries newer than LEDGER_EXPORT_LAG
+    seconds, and everything after the first of them, are left for the next
+    export so no entry ever ends up below the high water mark unexported.
+    Returns a summary of the export. Raises ExportInProgress if another export
+    to the directory is running.
+    """
+    if file_format not in FORMATS:
+        raise ValueError("format must be one of {}".format(", ".join(FORMATS)))
+
+    # Held until the export is done so two exports never write the same files
+    lock = lock_directory(directory)
+
+    try:
+        return export_locked(directory, file_format, rows_per_file, after_id)
+    finally:
+        lock.close()
+
+
+def lock_directory(directory):
+    """
+    Takes the export lock of a directory, in any process. Returns the open
+    lock file, closing it releases the lock. Raises ExportInProgress if an
+    export holds it.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    lock = open(os.path.join(directory, LOCK), "w")
+
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        lock.close()
+        raise ExportInProgress("An export to {} is already running".format(directory))
+
+    return lock
+
+
+def shard_directory(directory, shard):
+    # The default database's files go straight into directory
+    return directory if shard is None else os.path.join(directory, shard)
+
+
+def export_shards(directory, file_format, rows_per_file, after_id=None):
+    """
+    Runs export_ledger on every shard, each into its own subdirectory named
+    after the shard, the default database's straight into directory. Returns
+    the summary of each shard with its name under "shard".
+    """
+    summaries = []
+
+    for shard in shards.names():
+        with shards.use(shard):
+            summary = export_ledger(shard_directory(directory, shard), file_format, rows_per_file, after_id)
+            summaries.append(dict(summary, shard=shard))
+
+    return summaries
+
+
+def export_status(directory):
+    """
+    Returns, for every shard, whether an export is running and how far the
+    exports got.
+    """
+    statuses = []
+
+    for shard in shards.names():
+        shard_dir = shard_directory(directory, shard)
+        manifest = read_manifest(shard_dir)
+
+        try:
+            lock_directory(shard_dir).close()
+            running = False
+        except ExportInProgress:
+            running = True
+
+        statuses.append({
+            "shard": shard,
+            "running": running,
+            "high_water_mark": manifest["high_water_mark"],
+            "files": len(manifest["files"]),
+            "last_file": manifest["files"][-1] if manifest["files"] else None,
+        })
+
+    return statuses
+
+
+def run_export(app, directory, file_format, rows_per_file, after_id):
+    with app.app_context():
+        try:
+            for summary in export_shards(directory, file_format, rows_per_file, after_id):
+                app.logger.info("Exported ledger entries after {} to {} files".format(
+                    summary["after_id"], len(summary["files"])))
+
+        except Exception as e:
+            app.logger.error(str(e))
+
+        finally:
+            db.session.remove()
+
+
+def start_export(directory, file_format, rows_per_file, after_id=None):
+    """
+    Starts export_shards on a background thread, so the request that asked
+    for it doesn't hold a connection and a worker for the whole export.
+    Progress is in export_status. Raises ValueError for an unknown format and
+    ExportInProgress if an export to the directory is already running.
+    """
+    if file_format not in FORMATS:
+        raise ValueError("format must be one of {}".format(", ".join(FORMATS)))
+
+    # An export started by another process in between fails on the lock
+    if any(status["running"] for status in export_status(directory)):
+        raise ExportInProgress("An export to {} is already running".format(directory))
+
+    thread = threading.Thread(target=run_export, name="ledger-export", args=(
+        current_app._get_current_object(), directory, file_format, rows_per_file, after_id))
+    thread.daemon = True
+    thread.start()
+
+    return thread
+
+
+def export_locked(directory, file_format, rows_per_file, after_id):
+    manifest = read_manifest(directory)
+    start = manifest["high_water_mark"] if after_id is None else after_id
+    cutoff = datetime.now() - timedelta(seconds=current_app.config['LEDGER_EXPORT_LAG'])
+    written = []
+    rows = []
+
+    def flush():
+        name = "ledger_{:012d}_{:012d}{}".format(rows[0][0], rows[-1][0], EXTENSIONS[file_format])
+        write_file(rows, os.path.join(directory, name + ".partial"), file_format)
+        os.rename(os.path.join(directory, name + ".partial"), os.path.join(directory, name))
+
+        manifest["high_water_mark"] = rows[-1][0]
+        manifest["files"].append({"file": name, "first_id": rows[0][0], "last_id": rows[-1][0],
+                                  "rows": len(rows), "exported_at": datetime.now().isoformat()})
+        write_manifest(directory, manifest)
+
+        written.append(name)
+        current_app.logger.info("Exported ledger entries {} to {} to {}".format(rows[0][0], rows[-1][0], name))
+        del rows[:]
+
+    try:
+        for row in ledger_rows(start):
+            if row[6] is not None and row[6] >= cutoff:
+                break
+
+            rows.append(tuple(row))
+
+            if len(rows) == rows_per_file:
+                flush()
+
+        if rows:
+            flush()
+
+    finally:
+        # Ends the read only transaction and closes the cursor if stopped early
+        db.session.rollback()
+
+    return {
+        "after_id": start,
+        "high_water_mark": manifest["high_water_mark"],
+        "files": written,
+        "format": file_format,
+    }
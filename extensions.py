@@ -0,0 +1,26 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: These are the Flask extensions. They are created without an app so
+         the models and the rest of the code can import them before
+         create_app binds them to one.
+"""
+
+from flask_restful import Api
+
+from cache import Cache
+from encryption import Keyring
+from metrics import Metrics
+from replicas import Replicas
+from sharding import ShardedSQLAlchemy, Shards
+
+api = Api()
+db = ShardedSQLAlchemy()
+shards = Shards()
+replicas = Replicas()
+cache = Cache()
+keyring = Keyring()
+metrics = Metrics()
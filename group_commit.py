@@ -0,0 +1,219 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is group commit for transfers. With TRANSFER_GROUP_COMMIT each
+         request hands its transfer to a committer thread instead of
+         committing it itself. The committer collects the transfers that arrive
+         within TRANSFER_GROUP_COMMIT_WINDOW seconds, or until it has
+         TRANSFER_GROUP_COMMIT_MAX_SIZE of them, and applies them in one
+         transaction with a savepoint per transfer, so the whole group pays for
+         one commit and a rejected transfer doesn't undo the others. Requests
+         wait for the commit before they respond, for up to
+         TRANSFER_GROUP_COMMIT_TIMEOUT seconds.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g
+
+from extensions import db, shards
+from transfers import TransferError, apply_transfer, commit_with_retries, lock_accounts, transfer
+
+
+class GroupCommitTimeout(TransferError):
+    """
+    Raised when a transfer's group didn't finish committing in time, so it
+    isn't known whether the transfer was applied.
+    """
+    status_code = 503
+
+
+class PendingTransfer(object):
+    def __init__(self, shard, customer_id, from_account_id, to_account_id, amount):
+        self.shard = shard
+        self.customer_id = customer_id
+        self.from_account_id = from_account_id
+        self.to_account_id = to_account_id
+        self.amount = amount
+        self.error = None
+        self.done = threading.Event()
+
+
+def run_group(group):
+    """
+    Applies a group of pending transfers inside the current transaction
+    without committing, each in its own savepoint. Every account involved is
+    locked up front in id order so two groups can't deadlock on each other.
+    Returns the TransferError of each transfer that was rejected, or None.
+    """
+    account_ids = set()
+    for pending in group:
+        account_ids.update((pending.from_account_id, pending.to_account_id))
+
+    lock_accounts(account_ids)
+    errors = []
+
+    for pending in group:
+        try:
+            with db.session.begin_nested():
+                apply_transfer(pending.customer_id, pending.from_account_id, pending.to_account_id, pending.amount)
+
+            errors.append(None)
+
+        except TransferError as e:
+            errors.append(e)
+
+    return errors
+
+
+class GroupCommitter(object):
+    """
+    Collects transfers from request threads and commits them in groups on one
+    background thread per process.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.pid = None
+
+    def submit(self, customer_id, from_account_id, to_account_id, amount):
+        """
+        Queues a transfer for the next group and waits until its group is
+        committed. The transfer runs on the request's current shard. A
+        transfer the committer hasn't picked up within
+        TRANSFER_GROUP_COMMIT_TIMEOUT seconds is taken back and committed on
+        its own instead. Raises TransferError if the transfer was rejected and
+        GroupCommitTimeout if its group was still committing.
+        """
+        app = current_app._get_current_object()
+        pending = PendingTransfer(g.get("shard"), customer_id, from_account_id, to_account_id, amount)
+
+        with self.condition:
+            self.start(app)
+            self.pending.append(pending)
+            self.condition.notify()
+
+        if not pending.done.wait(app.config['TRANSFER_GROUP_COMMIT_TIMEOUT']):
+            with self.condition:
+                queued = pending in self.pending
+
+                if queued:
+                    self.pending.remove(pending)
+
+                # Starts a new committer if this one died
+                self.start(app)
+
+            if queued:
+                app.logger.error("Group commit didn't pick up a transfer in time, committing it directly")
+                transfer(customer_id, from_account_id, to_account_id, amount)
+                return
+
+            if not pending.done.is_set():
+                raise GroupCommitTimeout("Transfer is still being committed, check the ledger before retrying")
+
+        if pending.error is not None:
+            raise pending.error
+
+    def start(self, app):
+        # Threads don't survive a fork so each worker process starts its own
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.pending = []
+            self.thread = None
+
+        if self.thread is None or not self.thread.is_alive():
+            if self.thread is not None:
+                app.logger.error("Group commit thread died, starting a new one")
+
+            self.thread = threading.Thread(target=self.run, args=(app,), name="group-commit")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def next_group(self):
+        """
+        Waits for a transfer, then for the window to pass or the group to fill,
+        and returns the group.
+        """
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+
+            max_size = current_app.config['TRANSFER_GROUP_COMMIT_MAX_SIZE']
+            deadline = time.time() + current_app.config['TRANSFER_GROUP_COMMIT_WINDOW']
+
+            while len(self.pending) < max_size and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+
+            group = self.pending[:max_size]
+            del self.pending[:max_size]
+
+            return group
+
+    def run(self, app):
+        with app.app_context():
+            while True:
+                group = self.next_group()
+
+                try:
+                    for shard in OrderedDict.fromkeys(pending.shard for pending in group):
+                        grouped = [pending for pending in group if pending.shard == shard]
+
+                        if grouped:
+                            with shards.use(shard):
+                                self.commit(grouped)
+
+                except Exception as e:
+                    current_app.logger.error(str(e))
+
+                    for pending in group:
+                        if not pending.done.is_set():
+                            pending.error = pending.error or Exception("Internal Server Error")
+                            pending.done.set()
+
+                finally:
+                    db.session.remove()
+
+    def commit(self, group):
+        """
+        Commits a group of transfers on the current shard in one transaction. If it fails for any reason other
+        than rejected transfers its transfers are committed again one per
+        transaction, so only the one at fault fails.
+        """
+        try:
+            errors = commit_with_retries(lambda: run_group(group))
+
+        except Exception as e:
+            current_app.logger.error(str(e))
+            errors = []
+
+            for pending in group:
+                try:
+                    errors.extend(commit_with_retries(lambda: run_group([pending])))
+
+                except Exception as e:
+                    current_app.logger.error(str(e))
+                    errors.append(e)
+
+        for pending, error in zip(group, errors):
+            pending.error = error
+            pending.done.set()
+
+
+committer = GroupCommitter()
+
+
+def group_transfer(customer_id, from_account_id, to_account_id, amount):
+    """
+    Same as transfers.transfer but committed together with the other transfers
+    that arrive around the same time. Raises TransferError if the transfer is
+    rejected.
+    """
+    committer.submit(customer_id, from_account_id, to_account_id, amount)
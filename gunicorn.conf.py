@@ -0,0 +1,27 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the gunicorn config. The master imports, creates and warms the
+         app before forking, so workers boot in milliseconds and share its
+         memory copy on write, and each worker drops the connections it
+         inherited.
+"""
+
+import multiprocessing
+import os
+
+wsgi_app = "wsgi:app"
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+preload_app = True
+
+
+def post_fork(server, worker):
+    from app import after_fork
+    from wsgi import app
+
+    after_fork(app)
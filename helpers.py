@@ -0,0 +1,182 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the helpers file for reading request params and building
+         responses that are shared between the controllers.
+"""
+
+from flask import Response, current_app, request, stream_with_context
+from flask_api import status
+from datetime import datetime
+from serializers import dumps, json_response
+import functools
+import hashlib
+import hmac
+
+
+def truthy(value):
+    """
+    Returns True for the usual spellings of true in a query string.
+    """
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+
+def page_args():
+    """
+    Reads the keyset pagination params off of the request.
+    Returns (after_id, limit) and raises ValueError if either is malformed.
+    """
+    after_id = int(request.args.get('after_id', 0))
+    limit = int(request.args.get('limit', current_app.config['DEFAULT_PAGE_SIZE']))
+
+    if after_id < 0 or limit <= 0:
+        raise ValueError("after_id must be >= 0 and limit must be > 0")
+
+    return after_id, min(limit, current_app.config['MAX_PAGE_SIZE'])
+
+
+def fields_arg(model):
+    """
+    Reads the optional comma separated ?fields= projection off of the request.
+    Returns the model's default fields if it isn't given and raises ValueError
+    if it names a field the model can't serialize.
+    """
+    value = request.args.get('fields')
+
+    if not value:
+        return model.default_fields
+
+    fields = tuple(field.strip() for field in value.split(",") if field.strip())
+    unknown = [field for field in fields if field not in model.fields]
+
+    if not fields or unknown:
+        raise ValueError("Unknown fields {}".format(", ".join(unknown)))
+
+    return fields
+
+
+def include_arg(choices):
+    """
+    Reads the optional comma separated ?include= list of related resources off
+    of the request. Naming a nested one like accounts.recent_ledger includes
+    its parents too. Raises ValueError if it names one that isn't in choices.
+    """
+    names = set(name.strip() for name in request.args.get('include', '').split(",") if name.strip())
+    unknown = names - set(choices)
+
+    if unknown:
+        raise ValueError("Unknown includes {}".format(", ".join(sorted(unknown))))
+
+    for name in list(names):
+        parts = name.split(".")
+        names.update(".".join(parts[:i]) for i in range(1, len(parts)))
+
+    return names
+
+
+def time_arg(name):
+    """
+    Reads an optional ISO 8601 date or datetime param off of the request.
+    Raises ValueError if it is malformed.
+    """
+    value = request.args.get(name)
+
+    if value is None:
+        return None
+
+    for time_format in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+
+    raise ValueError("{} must be an ISO 8601 date or datetime".format(name))
+
+
+def paginated(items, limit, next_id):
+    """
+    Makes a JSON array response for one page of results. When the page is full
+    the id to pass as after_id for the next page is set in X-Next-After-Id.
+    """
+    response = json_response(items)
+
+    if len(items) == limit:
+        response.headers['X-Next-After-Id'] = str(next_id)
+
+    return response
+
+
+def streamed(rows, serialize):
+    """
+    Makes a response that writes the JSON array of rows incrementally so that
+    only one batch of rows is ever held in memory.
+    """
+    def generate():
+        yield b"["
+        for i, row in enumerate(rows):
+            yield (b"," if i else b"") + dumps(serialize(row))
+        yield b"]"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def etag_for(*parts, **kwargs):
+    """
+    Makes a strong ETag for a representation from the resource's version parts
+    and the request's query string, since params like fields change the body.
+    query_string can be passed for use outside the request context.
+    """
+    query_string = kwargs.get("query_string")
+    if query_string is None:
+        query_string = request.query_string
+
+    tag = ":".join(str(part) for part in parts) + "?" + query_string.decode("utf-8")
+    return hashlib.sha1(tag.encode("utf-8")).hexdigest()
+
+
+def etag_matches(etag):
+    """
+    Returns True if the request's If-None-Match header matches the ETag.
+    """
+    return etag in request.if_none_match
+
+
+def not_modified(etag):
+    """
+    Makes an empty 304 response for the ETag.
+    """
+    return tagged(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+
+
+def tagged(response, etag):
+    """
+    Sets the ETag of a response and returns it.
+    """
+    response.set_etag(etag)
+    return response
+
+
+def admin_only(method):
+    """
+    Decorator for Resource methods only admins may call. Requests have to
+    send ADMIN_TOKEN as a bearer token, and while it isn't set the endpoint is
+    turned off.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        token = current_app.config['ADMIN_TOKEN']
+
+        if not token:
+            return {"error": "Forbidden"}, status.HTTP_403_FORBIDDEN
+
+        scheme, _, sent = request.headers.get("Authorization", "").partition(" ")
+
+        if scheme.lower() != "bearer" or not hmac.compare_digest(sent.encode("utf-8"), token.encode("utf-8")):
+            return {"error": "Unauthorized"}, status.HTTP_401_UNAUTHORIZED, {"WWW-Authenticate": "Bearer"}
+
+        return method(*args, **kwargs)
+
+    return wrapper
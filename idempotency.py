@@ -0,0 +1,248 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the Idempotency-Key support for POST endpoints. The first
+         request with a key claims it in IdempotencyKeys, runs, and stores its
+         response there. Retries with the same key get the stored response
+         back without running the controller again, and retries that arrive
+         while the first request is still running wait for its response.
+         Claims are leased, so a key whose request died without responding
+         is taken over by a retry. Keys expire after IDEMPOTENCY_KEY_TTL
+         seconds.
+"""
+
+import functools
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta
+
+from flask import Response, current_app, request
+from flask_api import status
+from flask_restful.utils import unpack
+from sqlalchemy.exc import IntegrityError
+
+from extensions import api, db
+from models import IdempotencyKeys
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+# Response headers kept with the stored response
+REPLAYED_HEADERS = ("Content-Type", "Location")
+
+
+def fingerprint():
+    """
+    Hash of everything that identifies the request, so a key reused for a
+    different request can be told apart from a retry.
+    """
+    digest = hashlib.sha256()
+
+    for part in (request.method, request.path, request.query_string,
+                 json.dumps(sorted(request.form.items(multi=True))), request.get_data(cache=True)):
+        digest.update(part if isinstance(part, bytes) else part.encode("utf-8"))
+        digest.update(b"\0")
+
+    return digest.hexdigest()
+
+
+def is_stale(record):
+    """
+    Returns True if the record is a claim whose lease ran out before its
+    request stored a response.
+    """
+    return not record.completed and record.lease_expires_at is not None \
+        and record.lease_expires_at < datetime.now()
+
+
+def take_over(key, request_fingerprint):
+    """
+    Claims a key whose lease ran out for this request. Only one of the
+    requests racing for it gets it. Returns True if this one did.
+    """
+    now = datetime.now()
+
+    taken = IdempotencyKeys.query.filter(IdempotencyKeys.key == key, IdempotencyKeys.completed.is_(False),
+                                         IdempotencyKeys.lease_expires_at < now).update({
+        "fingerprint": request_fingerprint,
+        "expires_at": now + timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL']),
+        "lease_expires_at": now + timedelta(seconds=current_app.config['IDEMPOTENCY_CLAIM_LEASE']),
+    }, synchronize_session=False)
+    db.session.commit()
+
+    if taken:
+        current_app.logger.warning("{} {} was taken over from a request that didn't finish".format(HEADER, key))
+
+    return bool(taken)
+
+
+def claim(key, request_fingerprint):
+    """
+    Inserts the key in its own transaction. Returns None if this request now
+    owns it, otherwise the existing record. An expired record is deleted and
+    a stale claim is taken over.
+    """
+    while True:
+        now = datetime.now()
+
+        # A plain INSERT, since the session may still hold an earlier record
+        # of the key that was released or taken over. The mapper binds it to
+        # the database the other statements on the key use, rather than the
+        # request's shard.
+        try:
+            db.session.execute(IdempotencyKeys.__table__.insert().values(
+                key=key, fingerprint=request_fingerprint, completed=False, created_at=now,
+                expires_at=now + timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL']),
+                lease_expires_at=now + timedelta(seconds=current_app.config['IDEMPOTENCY_CLAIM_LEASE'])),
+                mapper=IdempotencyKeys.__mapper__)
+            db.session.commit()
+            return None
+
+        except IntegrityError:
+            db.session.rollback()
+
+        record = IdempotencyKeys.query.filter_by(key=key).populate_existing().first()
+
+        if record is not None and record.expires_at >= datetime.now() and not is_stale(record):
+            return record
+
+        if record is not None and is_stale(record):
+            if take_over(key, request_fingerprint):
+                return None
+
+            continue
+
+        IdempotencyKeys.query.filter(IdempotencyKeys.key == key, IdempotencyKeys.expires_at < datetime.now()) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+
+def wait_for(key):
+    """
+    Polls a key claimed by another request until its response is stored or
+    its lease runs out. Returns the record, or None if it was released or the
+    wait timed out.
+    """
+    deadline = time.time() + current_app.config['IDEMPOTENCY_WAIT_TIMEOUT']
+
+    while time.time() < deadline:
+        # End the transaction so each poll sees what the other request committed
+        db.session.rollback()
+        time.sleep(current_app.config['IDEMPOTENCY_POLL_INTERVAL'])
+
+        record = IdempotencyKeys.query.filter_by(key=key).populate_existing().first()
+
+        if record is None or record.completed or is_stale(record):
+            return record
+
+    return None
+
+
+def replay(record):
+    response = Response(record.response_body, status=record.response_status,
+                        headers=json.loads(record.response_headers))
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def release(key):
+    IdempotencyKeys.query.filter(IdempotencyKeys.key == key).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def idempotent(method):
+    """
+    Decorator for Resource methods that makes them honour an Idempotency-Key
+    header. Requests without the header run as usual. Responses with a 5xx
+    status aren't stored, so a retry of a request that failed runs again.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(HEADER)
+
+        if key is None:
+            return method(*args, **kwargs)
+
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return {"error": "{} must be 1 to {} characters".format(HEADER, MAX_KEY_LENGTH)}, \
+                status.HTTP_400_BAD_REQUEST
+
+        request_fingerprint = fingerprint()
+
+        while True:
+            record = claim(key, request_fingerprint)
+
+            if record is None:
+                break
+
+            if record.fingerprint != request_fingerprint:
+                return {"error": "{} {} was already used for a different request".format(HEADER, key)}, \
+                    status.HTTP_400_BAD_REQUEST
+
+            if not record.completed:
+                record = wait_for(key)
+
+                if record is None and IdempotencyKeys.query.filter_by(key=key).first() is not None:
+                    return {"error": "A request with {} {} is still in progress".format(HEADER, key)}, \
+                        status.HTTP_409_CONFLICT
+
+            # Released keys and stale claims are claimed again, stored
+            # responses are replayed
+            if record is not None and record.completed:
+                return replay(record)
+
+        try:
+            result = method(*args, **kwargs)
+
+        except Exception:
+            db.session.rollback()
+            release(key)
+            raise
+
+        if isinstance(result, Response):
+            response = result
+        else:
+            data, code, headers = unpack(result)
+            response = api.make_response(data, code, headers=headers)
+
+        # Anything the controller left uncommitted is from a failure
+        db.session.rollback()
+
+        if response.status_code >= 500:
+            release(key)
+            return response
+
+        IdempotencyKeys.query.filter(IdempotencyKeys.key == key).update({
+            "completed": True,
+            "response_status": response.status_code,
+            "response_headers": json.dumps(dict((name, response.headers[name]) for name in REPLAYED_HEADERS
+                                                if name in response.headers)),
+            "response_body": response.get_data(),
+        }, synchronize_session=False)
+        db.session.commit()
+
+        return response
+
+    return wrapper
+
+
+def expire_keys(batch_size):
+    """
+    Deletes expired keys, batch_size per transaction. Returns the number deleted.
+    """
+    deleted = 0
+
+    while True:
+        keys = [key for (key,) in db.session.query(IdempotencyKeys.key)
+                .filter(IdempotencyKeys.expires_at < datetime.now()).limit(batch_size)]
+
+        if not keys:
+            return deleted
+
+        IdempotencyKeys.query.filter(IdempotencyKeys.key.in_(keys)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(keys)
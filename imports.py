@@ -0,0 +1,312 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the bulk importer for customers and accounts. Rows are read
+         from NDJSON or CSV, validated, encrypted a chunk at a time and loaded
+         with COPY on PostgreSQL (multi-row INSERT elsewhere). Each chunk is
+         committed along with the job's progress so a job can be resumed.
+"""
+
+import codecs
+import csv
+import io
+import json
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy.exc import DBAPIError
+
+from extensions import db, cache, shards
+from cache import accounts_key
+from helpers import truthy
+from models import Customers, Accounts, ImportJobs, blind_index, blind_index_normalizers
+
+FORMATS = ("ndjson", "csv")
+
+
+def require(row, name):
+    value = row.get(name)
+
+    if value is None or value == "":
+        raise ValueError("Missing {}".format(name))
+
+    return value
+
+
+def clean_customer(row):
+    """
+    Validates one customer row and returns the values to insert.
+    """
+    cleaned = {
+        "first_name": require(row, "first_name"),
+        "last_name": require(row, "last_name"),
+        "phone_number": require(row, "phone_number"),
+        "email": require(row, "email"),
+        "ssn": require(row, "ssn"),
+        "active": truthy(row.get("active", True)),
+    }
+
+    # Rows skip the ORM so the blind indexes have to be filled in here
+    for field in blind_index_normalizers:
+        cleaned[field + "_bidx"] = blind_index(field, cleaned[field])
+
+    return cleaned
+
+
+def clean_account(row):
+    """
+    Validates one account row and returns the values to insert.
+    """
+    account_type = require(row, "account_type")
+    account_status = require(row, "status")
+
+    if account_type not in dict(Accounts.account_types_choices):
+        raise ValueError("Invalid account_type {}".format(account_type))
+
+    if account_status not in dict(Accounts.status_choices):
+        raise ValueError("Invalid status {}".format(account_status))
+
+    return {
+        "customer_id": int(require(row, "customer_id")),
+        "account_type": account_type,
+        "balance": float(require(row, "balance")),
+        "account_number": require(row, "account_number"),
+        "routing_number": require(row, "routing_number"),
+        "status": account_status,
+        "active": truthy(row.get("active", True)),
+    }
+
+
+KINDS = {
+    "customers": (Customers.__table__, clean_customer),
+    "accounts": (Accounts.__table__, clean_account),
+}
+
+
+def read_rows(stream, file_format):
+    """
+    Yields (row, error) for every record of a binary stream of NDJSON or CSV.
+    A record that can't be parsed yields its error instead of stopping the read.
+    """
+    text = codecs.getreader("utf-8")(stream)
+
+    if file_format == "csv":
+        for row in csv.DictReader(text):
+            yield row, None
+        return
+
+    for line in text:
+        if not line.strip():
+            continue
+
+        try:
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError("Expected a JSON object")
+            yield row, None
+
+        except ValueError as e:
+            yield None, e
+
+
+def copy_value(value):
+    """
+    Returns how a bound value is written in COPY's CSV format. The bytea
+    EncryptedType columns come out of their bind processors as bytes or
+    psycopg2.Binary, which go in PostgreSQL's hex format.
+    """
+    if value is None:
+        return "\\N"
+
+    value = getattr(value, "adapted", value)
+
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\x" + bytes(value).hex()
+
+    return value
+
+
+def copy_rows(table, rows):
+    """
+    Loads rows with COPY ... FROM STDIN. Values go through each column type's
+    bind processor first so EncryptedType and ChoiceType columns are stored
+    exactly as the ORM would store them.
+    """
+    columns = list(rows[0].keys())
+    processors = [table.c[name].type.bind_processor(db.engine.dialect) for name in columns]
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    for row in rows:
+        writer.writerow([copy_value(process(row[name]) if process else row[name])
+                         for name, process in zip(columns, processors)])
+
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert('COPY "{}" ({}) FROM STDIN WITH (FORMAT csv, NULL \'\\N\')'
+                       .format(table.name, ", ".join('"{}"'.format(name) for name in columns)), buffer)
+
+
+def load_rows(table, rows):
+    """
+    Loads a chunk of rows in one statement.
+    """
+    if db.engine.dialect.name == "postgresql":
+        copy_rows(table, rows)
+    else:
+        db.session.execute(table.insert().values(rows))
+
+
+def load_rows_one_by_one(table, rows):
+    """
+    Loads rows one at a time, each in its own savepoint, so a row the database
+    rejects doesn't take the rest of the chunk with it. Returns a list of
+    (position in rows, error) for the rows that failed.
+    """
+    errors = []
+
+    for position, row in enumerate(rows):
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(row))
+
+        except DBAPIError as e:
+            errors.append((position, str(e.orig)))
+
+    return errors
+
+
+def load_records(table, loaded):
+    """
+    Loads (row number, row) records on the current shard without committing.
+    Returns the errors for the rows that didn't make it in.
+    """
+    errors = []
+
+    # Accounts have to belong to a customer that exists. Checking the whole
+    # chunk up front is one query instead of a foreign key error per row.
+    if table is Accounts.__table__:
+        customer_ids = set(row["customer_id"] for _, row in loaded)
+        existing = set(customer_id for (customer_id,) in db.session.query(Customers.id).filter(Customers.id.in_(customer_ids)))
+
+        for number, row in loaded:
+            if row["customer_id"] not in existing:
+                errors.append({"row": number, "error": "Customer with id {} does not exist"
+                                                       .format(row["customer_id"])})
+
+        loaded = [(number, row) for number, row in loaded if row["customer_id"] in existing]
+
+    if loaded:
+        rows = [row for _, row in loaded]
+
+        try:
+            with db.session.begin_nested():
+                load_rows(table, rows)
+
+        except DBAPIError:
+            for position, error in load_rows_one_by_one(table, rows):
+                errors.append({"row": loaded[position][0], "error": error})
+
+    return errors
+
+
+def import_chunk(job, table, clean, chunk):
+    """
+    Validates and loads one chunk of (row number, row, error) records and
+    commits it together with the job's progress. Returns the errors for the
+    rows that didn't make it in as a list of {"row", "error"} dicts. Rows on a
+    shard other than the default database are committed in a transaction of
+    their own alongside the job's progress, not atomically with it.
+    """
+    errors = []
+    loaded = []
+    now = datetime.now()
+
+    for number, row, error in chunk:
+        try:
+            if error is not None:
+                raise error
+
+            cleaned = clean(row)
+            cleaned["created_at"] = now
+            loaded.append((number, cleaned))
+
+        except (ValueError, TypeError) as e:
+            errors.append({"row": number, "error": str(e)})
+
+    # Accounts go to their customer's shard, a chunk of customers all go to
+    # the shard picked for them
+    if table is Accounts.__table__:
+        groups, rejected = shards.group(loaded, lambda record: record[1]["customer_id"])
+        errors.extend({"row": number, "error": error} for (number, _), error in rejected)
+    else:
+        groups = {shards.place(): loaded} if loaded else {}
+
+    for shard, grouped in groups.items():
+        with shards.use(shard):
+            errors.extend(load_records(table, grouped))
+
+    job.rows_processed = job.rows_processed + len(chunk)
+    job.rows_failed = job.rows_failed + len(errors)
+    job.rows_imported = job.rows_imported + len(chunk) - len(errors)
+    job.updated_at = datetime.now()
+    db.session.commit()
+
+    if table is Accounts.__table__:
+        cache.invalidate(*[accounts_key(row["customer_id"]) for _, row in loaded])
+
+    return sorted(errors, key=lambda error: error["row"])
+
+
+def run_import(job_id, kind, stream, file_format, chunk_size):
+    """
+    Imports every record of the stream into the table for kind, chunk_size
+    records per transaction. If job_id was used before, the records it already
+    processed are skipped so a failed job can be resumed by running it again
+    with the same input. Returns a summary of the job.
+    """
+    if kind not in KINDS:
+        raise ValueError("kind must be one of {}".format(", ".join(sorted(KINDS))))
+
+    if file_format not in FORMATS:
+        raise ValueError("format must be one of {}".format(", ".join(FORMATS)))
+
+    table, clean = KINDS[kind]
+
+    job = ImportJobs.query.get(job_id)
+
+    if job is None:
+        job = ImportJobs(id=job_id, kind=kind)
+        db.session.add(job)
+        db.session.commit()
+
+    elif job.kind != kind:
+        raise ValueError("Import job {} is a {} import".format(job_id, job.kind))
+
+    resume_from = job.rows_processed
+    max_errors = current_app.config['IMPORT_MAX_REPORTED_ERRORS']
+    errors = []
+    chunk = []
+
+    for number, (row, error) in enumerate(read_rows(stream, file_format), 1):
+        if number <= resume_from:
+            continue
+
+        chunk.append((number, row, error))
+
+        if len(chunk) == chunk_size:
+            errors.extend(import_chunk(job, table, clean, chunk)[:max(0, max_errors - len(errors))])
+            chunk = []
+
+    if chunk:
+        errors.extend(import_chunk(job, table, clean, chunk)[:max(0, max_errors - len(errors))])
+
+    summary = job.serialize()
+    summary["resumed_from"] = resume_from
+    summary["errors"] = errors
+
+    return summary
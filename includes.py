@@ -0,0 +1,88 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the code that embeds related resources in customer reads for
+         ?include=. Related rows are loaded in batches, one query per kind of
+         resource for a whole page of customers, so including them costs the
+         same number of queries no matter how many customers are on the page.
+"""
+
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import func, true
+
+from extensions import db
+from models import Accounts, Ledger
+from serializers import RowSerializer
+
+# Everything that can be named in ?include=
+INCLUDES = ("accounts", "accounts.recent_ledger")
+
+
+def embed_accounts(customers, recent_ledger=False):
+    """
+    Takes a list of (customer id, serialized customer) and adds each customer's
+    accounts, ordered by id, under "accounts" with one query. With
+    recent_ledger each account also gets its latest RECENT_LEDGER_SIZE ledger
+    entries under "recent_ledger" with one more query.
+    """
+    embedded = OrderedDict((customer_id, []) for customer_id, _ in customers)
+
+    if embedded:
+        serializer = RowSerializer(Accounts, Accounts.default_fields)
+        rows = db.session.query(Accounts.customer_id, *serializer.columns) \
+            .filter(Accounts.customer_id.in_(list(embedded))).order_by(Accounts.id)
+
+        for row in rows:
+            embedded[row[0]].append(serializer.serialize(row[1:]))
+
+    for customer_id, customer in customers:
+        customer["accounts"] = embedded[customer_id]
+
+    if recent_ledger:
+        embed_recent_ledger([account for accounts in embedded.values() for account in accounts],
+                            current_app.config['RECENT_LEDGER_SIZE'])
+
+
+def embed_recent_ledger(accounts, size):
+    """
+    Adds the latest size ledger entries of each serialized account, newest
+    first, under "recent_ledger" with one query. On PostgreSQL a LATERAL
+    subquery reads only the newest size entries of each account off the
+    (account_id, created_at, id) index. Elsewhere every entry of the accounts
+    is ranked with row_number() and the rest are filtered out.
+    """
+    entries = OrderedDict((account["id"], []) for account in accounts)
+
+    if entries:
+        serializer = RowSerializer(Ledger, Ledger.fields)
+
+        if db.engine.dialect.name == "postgresql":
+            recent = db.session.query(*serializer.columns) \
+                .filter(Ledger.account_id == Accounts.id) \
+                .order_by(Ledger.created_at.desc(), Ledger.id.desc()) \
+                .limit(size).subquery().lateral()
+
+            rows = db.session.query(recent).select_from(Accounts).join(recent, true()) \
+                .filter(Accounts.id.in_(list(entries))) \
+                .order_by(Accounts.id, recent.c.created_at.desc(), recent.c.id.desc())
+
+        else:
+            position = func.row_number().over(partition_by=Ledger.account_id,
+                                              order_by=(Ledger.created_at.desc(), Ledger.id.desc())).label("position")
+            ranked = db.session.query(*serializer.columns).add_columns(position) \
+                .filter(Ledger.account_id.in_(list(entries))).subquery()
+
+            rows = db.session.query(*[ranked.c[field] for field in serializer.fields]) \
+                .filter(ranked.c.position <= size).order_by(ranked.c.account_id, ranked.c.position)
+
+        for row in rows:
+            entry = serializer.serialize(row)
+            entries[entry["account_id"]].append(entry)
+
+    for account in accounts:
+        account["recent_ledger"] = entries[account["id"]]
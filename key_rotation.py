@@ -0,0 +1,197 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the encryption key rotation job. It re-encrypts the fields of
+         every customer that has one written with a key other than
+         ENCRYPTION_KEY_ID's, in id ranges handed out to worker processes.
+         Each range is committed on its own and KeyRotations records how far
+         every shard got, so a stopped rotation carries on from there. Workers
+         sleep between ranges to keep to a target write rate.
+"""
+
+import multiprocessing
+import time
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import LargeBinary, and_, bindparam, func, select, type_coerce
+
+from app import engines
+from extensions import db, keyring, shards
+from models import Customers, KeyRotations
+
+# Times a range is read again when rows in it changed while being rotated
+MAX_ATTEMPTS = 5
+
+# Set in each worker process by start_worker
+worker_app = None
+worker_shard = None
+worker_rows_per_second = None
+
+
+def id_ranges(after_id, max_id, chunk_size):
+    """
+    Yields (start, end] id ranges of chunk_size from after_id up to max_id.
+    """
+    for start in range(after_id, max_id, chunk_size):
+        yield start, min(start + chunk_size, max_id)
+
+
+def stale_rows(start, end):
+    """
+    Locks the customers with ids in (start, end] and returns the ones with a
+    field that isn't encrypted with the current key, as (id, version, stored
+    fields) rows.
+    """
+    table = Customers.__table__
+    stored = [type_coerce(table.c[field], LargeBinary).label(field) for field in Customers.encrypted_fields]
+
+    rows = db.session.execute(select([table.c.id, table.c.version] + stored)
+                              .where(and_(table.c.id > start, table.c.id <= end))
+                              .order_by(table.c.id)
+                              .with_for_update()).fetchall()
+
+    return [row for row in rows
+            if any(value is not None and keyring.key_id_of(value) != keyring.key_id for value in row[2:])]
+
+
+def rotate_range(start, end):
+    """
+    Re-encrypts the customers with ids in (start, end] that need it with the
+    current key and commits. A row updated in between keeps its new values
+    and is read again. Returns how many rows were rewritten.
+    """
+    table = Customers.__table__
+    fields = Customers.encrypted_fields
+
+    # The version isn't bumped since the values don't change, only their keys
+    statement = table.update() \
+        .where(and_(table.c.id == bindparam("row_id"), table.c.version == bindparam("row_version"))) \
+        .values(**dict((field, bindparam("new_" + field)) for field in fields))
+
+    rotated = 0
+
+    for _ in range(MAX_ATTEMPTS):
+        rows = stale_rows(start, end)
+
+        if not rows:
+            db.session.commit()
+            return rotated
+
+        params = []
+        for row in rows:
+            values = {"row_id": row[0], "row_version": row[1]}
+            for field, value in zip(fields, row[2:]):
+                values["new_" + field] = None if value is None else table.c[field].type.decrypt(value)
+            params.append(values)
+
+        rotated += db.session.execute(statement, params).rowcount
+        db.session.commit()
+
+    raise RuntimeError("Customers {} to {} kept changing while being rotated".format(start + 1, end))
+
+
+def start_worker(app, shard, rows_per_second):
+    global worker_app, worker_shard, worker_rows_per_second
+
+    worker_app = app
+    worker_shard = shard
+    worker_rows_per_second = rows_per_second
+
+
+def rotate_chunk(bounds):
+    """
+    Rotates one id range in a worker process, then sleeps long enough to keep
+    to the worker's share of the write rate. Returns the end of the range and
+    how many rows were rewritten.
+    """
+    start, end = bounds
+    started = time.time()
+
+    with worker_app.app_context(), shards.use(worker_shard):
+        try:
+            rotated = rotate_range(start, end)
+        finally:
+            db.session.remove()
+
+    if worker_rows_per_second:
+        time.sleep(max(0.0, rotated / worker_rows_per_second - (time.time() - started)))
+
+    return end, rotated
+
+
+def rotate_shard(shard, workers, chunk_size, rows_per_second=None, restart=False):
+    """
+    Rotates the customers of the current shard to the current key on workers
+    processes, recording progress after every range so a rotation that
+    stopped resumes after the last range it finished. restart goes over every
+    customer again, e.g. when servers still on the old key wrote some after a
+    rotation finished. Returns a summary of the rotation.
+    """
+    name = shard or "default"
+    rotation = KeyRotations.query.get((keyring.key_id, name))
+
+    if rotation is None or restart:
+        # Customers created after this are written with the current key
+        max_id = db.session.query(func.max(Customers.id)).scalar() or 0
+
+        if rotation is None:
+            rotation = KeyRotations(keyring.key_id, name, max_id)
+            db.session.add(rotation)
+        else:
+            rotation.last_id = 0
+            rotation.max_id = max_id
+            rotation.rows_rotated = 0
+            rotation.completed_at = None
+
+        db.session.commit()
+
+    if rotation.completed_at is not None:
+        return rotation.serialize()
+
+    ranges = id_ranges(rotation.last_id, rotation.max_id, chunk_size)
+    app = current_app._get_current_object()
+
+    # Workers are forked and must not inherit connections, so drop them first
+    db.session.remove()
+    for engine in engines(app):
+        engine.dispose()
+
+    pool = multiprocessing.get_context("fork").Pool(
+        workers, start_worker, (app, shard, rows_per_second / float(workers) if rows_per_second else None))
+
+    try:
+        rotation = KeyRotations.query.get((keyring.key_id, name))
+
+        # Ranges come back in order, so last_id never skips one still running
+        for end, rotated in pool.imap(rotate_chunk, ranges):
+            rotation.last_id = end
+            rotation.rows_rotated = rotation.rows_rotated + rotated
+            rotation.updated_at = datetime.now()
+            db.session.commit()
+
+        rotation.completed_at = datetime.now()
+        db.session.commit()
+
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return rotation.serialize()
+
+
+def rotate_keys(workers, chunk_size, rows_per_second=None, restart=False):
+    """
+    Rotates the customers of every shard to ENCRYPTION_KEY_ID's key. Returns
+    a summary per shard.
+    """
+    summaries = []
+
+    for shard in shards.names():
+        with shards.use(shard):
+            summaries.append(rotate_shard(shard, workers, chunk_size, rows_per_second, restart))
+
+    return summaries
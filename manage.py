@@ -7,14 +7,222 @@ Status: Production
 Summary: This is the management script that runs the spark app.
 """
 
+from flask import current_app
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
-from app import app, db
+from app import create_app
+from extensions import db, shards
+import json
 import os
 
-migrate = Migrate(app, db)
-manager = Manager(app)
+migrate = Migrate()
+
+
+def create_manage_app(config=None):
+    # The app served to requests has no use for migrations, they're added here
+    app = create_app(config)
+    migrate.init_app(app, db)
+    return app
+
+
+manager = Manager(create_manage_app)
+manager.add_option('-c', '--config', dest='config', required=False,
+                   help="Name of the config to use. Defaults to ACORNS_CONFIG or production")
 manager.add_command('db', MigrateCommand)
 
+
+def shard_label(shard):
+    # Prefix for output about one shard, nothing when not sharded
+    return "[{}] ".format(shard or "default") if shards.enabled else ""
+
+
+@manager.option('path', help="NDJSON or CSV file to import")
+@manager.option('kind', help="customers or accounts")
+@manager.option('-j', '--job-id', dest='job_id', help="Name of the job. Defaults to the file name")
+@manager.option('-f', '--format', dest='file_format', help="ndjson or csv. Defaults to the file extension")
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int, help="Rows committed per transaction")
+def bulk_import(kind, path, job_id=None, file_format=None, chunk_size=None):
+    """
+    Bulk imports customers or accounts. Running it again with the same job id
+    resumes after the last committed chunk.
+    """
+    from imports import run_import
+
+    if file_format is None:
+        file_format = "csv" if path.lower().endswith(".csv") else "ndjson"
+
+    with open(path, "rb") as stream:
+        summary = run_import(job_id or os.path.basename(path), kind, stream, file_format,
+                             chunk_size or current_app.config['IMPORT_CHUNK_SIZE'])
+
+    print(json.dumps(summary, default=str, indent=2))
+
+
+@manager.option('-a', '--as-of', dest='as_of', help="YYYY-MM-DD to checkpoint at. Defaults to today at midnight")
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, help="Accounts checkpointed per transaction")
+def checkpoint_balances(as_of=None, batch_size=None):
+    """
+    Records a balance checkpoint for every account. Meant to be run daily.
+    """
+    from datetime import datetime
+    from balances import create_checkpoints
+
+    if as_of:
+        as_of = datetime.strptime(as_of, "%Y-%m-%d")
+    else:
+        as_of = datetime.combine(datetime.now().date(), datetime.min.time())
+
+    for shard in shards.names():
+        with shards.use(shard):
+            created = create_checkpoints(as_of, batch_size or current_app.config['CHECKPOINT_BATCH_SIZE'])
+            print("{}Created {} balance checkpoints as of {}".format(shard_label(shard), created, as_of))
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, help="Accounts rebuilt per transaction")
+def rebuild_rollups(batch_size=None):
+    """
+    Recomputes the activity rollups of every account from the ledger, leaving
+    the months archived from a partitioned Ledger as they are.
+    """
+    from rollups import rebuild_rollups
+
+    for shard in shards.names():
+        with shards.use(shard):
+            rebuilt = rebuild_rollups(batch_size or current_app.config['ROLLUP_REBUILD_BATCH_SIZE'])
+            print("{}Rebuilt activity rollups for {} accounts".format(shard_label(shard), rebuilt))
+
+
+@manager.option('-a', '--months-ahead', dest='months_ahead', type=int, help="Months of partitions to create ahead")
+@manager.option('-k', '--keep-months', dest='keep_months', type=int,
+                help="Archive partitions of months that ended more than this many months ago")
+@manager.option('-d', '--archive-dir', dest='archive_dir', help="Directory the archived partitions are written to")
+def ledger_partitions(months_ahead=None, keep_months=None, archive_dir=None):
+    """
+    Creates upcoming monthly Ledger partitions and archives old ones. Meant to
+    be run daily.
+    """
+    from partitions import create_partitions, archive_partitions
+
+    months_ahead = current_app.config['LEDGER_PARTITION_MONTHS_AHEAD'] if months_ahead is None else months_ahead
+    keep_months = current_app.config['LEDGER_ARCHIVE_AFTER_MONTHS'] if keep_months is None else keep_months
+    archive_dir = archive_dir or current_app.config['LEDGER_ARCHIVE_DIR']
+
+    for shard in shards.names():
+        with shards.use(shard):
+            created = create_partitions(months_ahead)
+            print("{}Created Ledger partitions: {}".format(shard_label(shard), ", ".join(created) or "none"))
+
+            if keep_months is not None:
+                archived = archive_partitions(keep_months, archive_dir if shard is None
+                                              else os.path.join(archive_dir, shard))
+                print("{}Archived Ledger partitions: {}".format(shard_label(shard), ", ".join(archived) or "none"))
+
+
+@manager.option('-w', '--workers', dest='workers', type=int, help="Worker processes")
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, help="Transfers run per transaction")
+@manager.option('-p', '--poll-interval', dest='poll_interval', type=float, help="Seconds to wait when the queue is empty")
+@manager.option('-d', '--drain', dest='drain', action='store_true', help="Exit once the queue is empty")
+def transfer_workers(workers=None, batch_size=None, poll_interval=None, drain=False):
+    """
+    Runs the workers that drain the asynchronous transfer queue.
+    """
+    from transfer_queue import run_workers
+
+    run_workers(workers or current_app.config['TRANSFER_QUEUE_WORKERS'],
+                batch_size or current_app.config['TRANSFER_QUEUE_BATCH_SIZE'],
+                poll_interval or current_app.config['TRANSFER_QUEUE_POLL_INTERVAL'], drain)
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, help="Keys deleted per transaction")
+def expire_idempotency_keys(batch_size=None):
+    """
+    Deletes expired idempotency keys. Meant to be run periodically.
+    """
+    from idempotency import expire_keys
+
+    deleted = expire_keys(batch_size or current_app.config['IDEMPOTENCY_EXPIRE_BATCH_SIZE'])
+    print("Deleted {} expired idempotency keys".format(deleted))
+
+
+@manager.option('-d', '--export-dir', dest='export_dir', help="Directory the files and manifest are written to")
+@manager.option('-f', '--format', dest='file_format', help="parquet, arrow or csv")
+@manager.option('-r', '--rows-per-file', dest='rows_per_file', type=int, help="Ledger entries per file")
+@manager.option('-a', '--after-id', dest='after_id', type=int,
+                help="Export the entries after this ledger id instead of after the last export")
+def export_ledger(export_dir=None, file_format=None, rows_per_file=None, after_id=None):
+    """
+    Exports new ledger entries to files for analytics. Meant to be run
+    periodically, each run carries on from where the last one stopped.
+    """
+    from exports import export_shards
+
+    summaries = export_shards(export_dir or current_app.config['LEDGER_EXPORT_DIR'],
+                              file_format or current_app.config['LEDGER_EXPORT_FORMAT'],
+                              rows_per_file or current_app.config['LEDGER_EXPORT_ROWS_PER_FILE'], after_id)
+
+    for summary in summaries:
+        if summary["files"]:
+            print("{}Exported ledger entries {} to {} to: {}".format(
+                shard_label(summary["shard"]), summary["after_id"] + 1, summary["high_water_mark"],
+                ", ".join(summary["files"])))
+        else:
+            print("{}No ledger entries after {} to export".format(shard_label(summary["shard"]), summary["after_id"]))
+
+
+@manager.option('-w', '--workers', dest='workers', type=int, help="Worker processes")
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int, help="Customers rotated per transaction")
+@manager.option('-r', '--rows-per-second', dest='rows_per_second', type=int,
+                help="Most customers rewritten per second across the workers, 0 for no limit")
+@manager.option('--restart', dest='restart', action='store_true',
+                help="Go over every customer again instead of resuming or skipping a finished rotation")
+def rotate_keys(workers=None, chunk_size=None, rows_per_second=None, restart=False):
+    """
+    Re-encrypts every customer written with an old key with ENCRYPTION_KEY_ID's
+    key. Running it again resumes after the last committed chunk.
+    """
+    from key_rotation import rotate_keys
+
+    if rows_per_second is None:
+        rows_per_second = current_app.config['KEY_ROTATION_ROWS_PER_SECOND']
+
+    summaries = rotate_keys(workers or current_app.config['KEY_ROTATION_WORKERS'],
+                            chunk_size or current_app.config['KEY_ROTATION_CHUNK_SIZE'], rows_per_second, restart)
+
+    for summary in summaries:
+        print("{}Rotated {} customers to key {}, every customer up to id {} is on it".format(
+            shard_label(None if summary["shard"] == "default" else summary["shard"]), summary["rows_rotated"],
+            summary["key_id"], summary["last_id"]))
+
+
+@manager.command
+def configure_shards():
+    """
+    Sets up the id sequences of every shard in SHARDS. Run it with writes
+    stopped when turning sharding on and whenever SHARDS changes.
+    """
+    from rebalance import configure_sequences
+
+    highest = configure_sequences()
+    print("Configured the id sequences of {} shards. The highest customer id is {}, when turning sharding on "
+          "set SHARD_LEGACY_MAX_ID to it".format(len(shards.names()), highest))
+
+
+@manager.option('customer_ids', nargs='+', type=int, help="Customers to move")
+@manager.option('-s', '--shard', dest='shard', required=True, help="Shard to move them to, default for the default database")
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, help="Rows copied per round trip")
+def rebalance(customer_ids, shard, batch_size=None):
+    """
+    Moves customers with their accounts, ledger and the rest of their rows to
+    another shard while the API keeps running. Each customer's writes get a
+    503 for the few seconds their move takes.
+    """
+    from rebalance import move_customer
+
+    for customer_id in customer_ids:
+        moved = move_customer(customer_id, None if shard == "default" else shard,
+                              batch_size or current_app.config['SHARD_REBALANCE_BATCH_SIZE'])
+        print("Moved customer {} to {} with {} rows".format(customer_id, shard, moved))
+
+
 if __name__ == '__main__':
     manager.run()
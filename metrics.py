@@ -0,0 +1,288 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the request instrumentation served from /metrics in the
+         Prometheus text format. It records per endpoint request latency and
+         SQL statement counts, and how long statements, commits, waiting for a
+         pooled connection and encrypting or decrypting customer fields took.
+         Everything is kept in process as fixed bucket histograms so recording
+         is a couple of clock reads and a counter bump.
+"""
+
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+# Upper bounds of the histogram buckets, in seconds or statements
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                0.05, 0.1, 0.25, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50, 100)
+
+HISTOGRAMS = (
+    ("http_request_duration_seconds", "Time to build each response.",
+     ("endpoint", "method", "status"), LATENCY_BUCKETS),
+    ("http_request_sql_statements", "SQL statements executed per request.",
+     ("endpoint", "method"), COUNT_BUCKETS),
+    ("sql_statement_duration_seconds", "Time each SQL statement took.",
+     ("endpoint",), FAST_BUCKETS),
+    ("sql_commit_duration_seconds", "Time each commit took, including its flush.",
+     ("endpoint",), FAST_BUCKETS),
+    ("sql_pool_wait_seconds", "Time spent waiting for a pooled connection.",
+     ("endpoint",), FAST_BUCKETS),
+    ("crypto_duration_seconds", "Time each encrypted field took to encrypt or decrypt.",
+     ("endpoint", "operation"), FAST_BUCKETS),
+)
+
+
+def current_endpoint():
+    # The route rule, not the path, so ids don't each get their own series
+    if has_request_context():
+        return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+    return "none"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(name, escape(value)) for name, value in zip(names, values)]
+
+    if extra is not None:
+        pairs.append('{}="{}"'.format(*extra))
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_bound(bound):
+    return repr(float(bound)) if bound != float("inf") else "+Inf"
+
+
+class Histogram(object):
+    """
+    Fixed bucket histogram per combination of label values. Not thread safe on
+    its own, the Metrics lock guards it.
+    """
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, values, amount):
+        series = self.series.get(values)
+
+        if series is None:
+            series = self.series[values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+        series[0][bisect_left(self.buckets, amount)] += 1
+        series[1] += amount
+        series[2] += 1
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} histogram".format(self.name)]
+
+        for values, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, format_labels(self.labels, values, ("le", format_bound(bound))), cumulative))
+
+            lines.append("{}_sum{} {}".format(self.name, format_labels(self.labels, values), repr(total)))
+            lines.append("{}_count{} {}".format(self.name, format_labels(self.labels, values), count))
+
+        return lines
+
+
+class Metrics(object):
+    """
+    Request, SQL and encryption instrumentation. Configured from METRICS_ENABLED
+    in the app config, following the Flask extension pattern. Statements run
+    while a streamed response is being sent are timed but not counted against
+    the request, which has already been recorded by then.
+    """
+
+    def __init__(self, app=None, db=None):
+        self.enabled = False
+        self.db = None
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.instrumented = set()
+        self.engines = []
+        self.collectors = []
+
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.enabled = app.config['METRICS_ENABLED']
+        self.db = db
+        self.reset()
+
+        if not self.enabled:
+            return
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+        # Shards and replicas have engines of their own, created on first use
+        if self.instrument not in db.engine_hooks:
+            db.engine_hooks.append(self.instrument)
+
+        # The session is shared by every app the extension is bound to
+        if not event.contains(db.session, "before_commit", self.start_commit):
+            event.listen(db.session, "before_commit", self.start_commit)
+            event.listen(db.session, "after_commit", self.finish_commit)
+            event.listen(db.session, "after_rollback", self.cancel_commit)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = dict((name, Histogram(name, description, labels, buckets))
+                                   for name, description, labels, buckets in HISTOGRAMS)
+
+    def observe(self, name, values, amount):
+        with self.lock:
+            self.histograms[name].observe(values, amount)
+
+    def collector(self, collect):
+        """
+        Registers a function returning (name, type, description, {labels: value})
+        tuples to render along with the histograms, for values kept elsewhere.
+        """
+        self.collectors.append(collect)
+        return collect
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+        with self.lock:
+            lines = []
+            for name, _, _, _ in HISTOGRAMS:
+                lines.extend(self.histograms[name].render())
+
+        for collect in self.collectors:
+            for name, kind, description, samples in collect():
+                lines.append("# HELP {} {}".format(name, description))
+                lines.append("# TYPE {} {}".format(name, kind))
+
+                for labels, value in sorted(samples.items()):
+                    lines.append("{}{} {}".format(name, format_labels([label for label, _ in labels],
+                                                                      [v for _, v in labels]), value))
+
+        return "\n".join(lines) + "\n"
+
+    def instrument(self, engine):
+        """
+        Times the statements run on an engine and how long its pool takes to
+        hand out a connection. Safe to call for an engine more than once.
+        """
+        if id(engine) not in self.instrumented:
+            event.listen(engine, "before_cursor_execute", self.start_statement)
+            event.listen(engine, "after_cursor_execute", self.finish_statement)
+
+            with self.lock:
+                self.instrumented.add(id(engine))
+                self.engines.append(engine)
+
+        # The pool is replaced whenever the engine is disposed so check it each time
+        pool = engine.pool
+
+        if not getattr(pool, "metrics_timed", False):
+            connect = pool.connect
+
+            def timed_connect():
+                started = perf_counter()
+                try:
+                    return connect()
+                finally:
+                    self.observe("sql_pool_wait_seconds", (current_endpoint(),), perf_counter() - started)
+
+            pool.connect = timed_connect
+            pool.metrics_timed = True
+
+    def start_request(self):
+        # Disposing of an engine replaces its pool, which needs timing again
+        for engine in list(self.engines):
+            self.instrument(engine)
+        g.metrics_started = perf_counter()
+        g.metrics_statements = 0
+
+    def finish_request(self, response):
+        started = g.pop("metrics_started", None)
+
+        if started is not None:
+            endpoint = current_endpoint()
+            self.observe("http_request_duration_seconds", (endpoint, request.method, response.status_code),
+                         perf_counter() - started)
+            self.observe("http_request_sql_statements", (endpoint, request.method), g.pop("metrics_statements", 0))
+
+        return response
+
+    def start_statement(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started", []).append(perf_counter())
+
+    def finish_statement(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = perf_counter() - conn.info["metrics_started"].pop()
+        self.observe("sql_statement_duration_seconds", (current_endpoint(),), elapsed)
+
+        if has_request_context() and "metrics_statements" in g:
+            g.metrics_statements += 1
+
+    def start_commit(self, session):
+        session.info["metrics_commit_started"] = perf_counter()
+
+    def finish_commit(self, session):
+        started = session.info.pop("metrics_commit_started", None)
+
+        if started is not None:
+            self.observe("sql_commit_duration_seconds", (current_endpoint(),), perf_counter() - started)
+
+    def cancel_commit(self, session):
+        session.info.pop("metrics_commit_started", None)
+
+    def crypto_engine(self, engine):
+        """
+        Returns a subclass of an EncryptedType engine that times encrypt and
+        decrypt while metrics are enabled. The models are defined before the
+        app is created, so it's decided on each call.
+        """
+        metrics = self
+
+        class TimedEngine(engine):
+            def encrypt(self, value):
+                if not metrics.enabled:
+                    return super(TimedEngine, self).encrypt(value)
+
+                started = perf_counter()
+                try:
+                    return super(TimedEngine, self).encrypt(value)
+                finally:
+                    metrics.observe("crypto_duration_seconds", (current_endpoint(), "encrypt"),
+                                    perf_counter() - started)
+
+            def decrypt(self, value):
+                if not metrics.enabled:
+                    return super(TimedEngine, self).decrypt(value)
+
+                started = perf_counter()
+                try:
+                    return super(TimedEngine, self).decrypt(value)
+                finally:
+                    metrics.observe("crypto_duration_seconds", (current_endpoint(), "decrypt"),
+                                    perf_counter() - started)
+
+        TimedEngine.__name__ = "Timed" + engine.__name__
+        return TimedEngine
@@ -0,0 +1,33 @@
+"""add balance checkpoints
+
+Revision ID: 1e7d3b5a8c26
+Revises: d5b8e07f4a19
+Create Date: 2026-10-18 11:48:52.307115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1e7d3b5a8c26'
+down_revision = 'd5b8e07f4a19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('BalanceCheckpoints',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('account_id', sa.Integer(), nullable=True),
+    sa.Column('as_of', sa.DateTime(), nullable=True),
+    sa.Column('balance', sa.Float(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['account_id'], ['Accounts.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('account_id', 'as_of')
+    )
+
+
+def downgrade():
+    op.drop_table('BalanceCheckpoints')
@@ -0,0 +1,24 @@
+"""add ledger account/created_at index
+
+Revision ID: 3c1e5a9d7b42
+Revises: 472bb91c6dfc
+Create Date: 2026-10-18 09:12:41.201733
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1e5a9d7b42'
+down_revision = '472bb91c6dfc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_Ledger_account_id_created_at_id', 'Ledger', ['account_id', 'created_at', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_Ledger_account_id_created_at_id', table_name='Ledger')
@@ -0,0 +1,44 @@
+"""add transfer requests queue
+
+Revision ID: 4c7e2a9f1b65
+Revises: b83c1f6e2d90
+Create Date: 2026-10-18 14:02:37.215840
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlalchemy_utils
+from models import TransferRequests
+
+# revision identifiers, used by Alembic.
+revision = '4c7e2a9f1b65'
+down_revision = 'b83c1f6e2d90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('TransferRequests',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('customer_id', sa.Integer(), nullable=True),
+    sa.Column('from_account_id', sa.Integer(), nullable=True),
+    sa.Column('to_account_id', sa.Integer(), nullable=True),
+    sa.Column('amount', sa.Float(), nullable=True),
+    sa.Column('partition', sa.Integer(), nullable=False),
+    sa.Column('status', sqlalchemy_utils.types.choice.ChoiceType(TransferRequests.status_choices), nullable=False),
+    sa.Column('error', sa.String(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('completed_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['customer_id'], ['Customers.id'], ),
+    sa.ForeignKeyConstraint(['from_account_id'], ['Accounts.id'], ),
+    sa.ForeignKeyConstraint(['to_account_id'], ['Accounts.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_TransferRequests_status_partition_id', 'TransferRequests',
+                    ['status', 'partition', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_TransferRequests_status_partition_id', table_name='TransferRequests')
+    op.drop_table('TransferRequests')
@@ -0,0 +1,30 @@
+"""add customer shards
+
+Revision ID: 5a8e2d7c1f94
+Revises: 7d1f3e8a2c49
+Create Date: 2026-10-18 17:02:37.918254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a8e2d7c1f94'
+down_revision = '7d1f3e8a2c49'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('CustomerShards',
+    sa.Column('customer_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('shard', sa.String(length=64), nullable=True),
+    sa.Column('moving', sa.Boolean(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('customer_id')
+    )
+
+
+def downgrade():
+    op.drop_table('CustomerShards')
@@ -0,0 +1,37 @@
+"""add activity rollups
+
+Revision ID: 6f2a9d4c0b57
+Revises: 1e7d3b5a8c26
+Create Date: 2026-10-18 12:31:09.884126
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlalchemy_utils
+from models import ActivityRollups, Ledger
+
+# revision identifiers, used by Alembic.
+revision = '6f2a9d4c0b57'
+down_revision = '1e7d3b5a8c26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('ActivityRollups',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('account_id', sa.Integer(), nullable=True),
+    sa.Column('granularity', sqlalchemy_utils.types.choice.ChoiceType(ActivityRollups.granularity_choices), nullable=True),
+    sa.Column('period_start', sa.Date(), nullable=True),
+    sa.Column('transaction_type', sqlalchemy_utils.types.choice.ChoiceType(Ledger.transaction_type_choices), nullable=True),
+    sa.Column('details', sqlalchemy_utils.types.choice.ChoiceType(Ledger.details_choices), nullable=True),
+    sa.Column('count', sa.Integer(), nullable=True),
+    sa.Column('total', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['account_id'], ['Accounts.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('account_id', 'granularity', 'period_start', 'transaction_type', 'details')
+    )
+
+
+def downgrade():
+    op.drop_table('ActivityRollups')
@@ -0,0 +1,94 @@
+"""partition ledger by month
+
+Revision ID: 7d1f3e8a2c49
+Revises: e29d5b7c3f08
+Create Date: 2026-10-18 15:36:51.170462
+
+Rebuilds Ledger as a table range partitioned on created_at with one
+partition per month, from the month of the oldest entry through
+FUTURE_MONTHS months from now, plus a default partition. Needs PostgreSQL 11
+or later and does nothing on other databases. Rows are copied in one
+statement, so run it in a maintenance window. The primary key becomes
+(id, created_at) since a partitioned table's keys have to include the
+partition column.
+
+"""
+from datetime import date, datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d1f3e8a2c49'
+down_revision = 'e29d5b7c3f08'
+branch_labels = None
+depends_on = None
+
+FUTURE_MONTHS = 3
+COLUMNS = 'id, account_id, transaction_type, amount, details, created_at'
+
+
+def add_months(month, months):
+    months = month.year * 12 + month.month - 1 + months
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    if bind.dialect.name != "postgresql":
+        return
+
+    op.execute('ALTER TABLE "Ledger" RENAME TO "Ledger_unpartitioned"')
+    op.execute('ALTER TABLE "Ledger_unpartitioned" RENAME CONSTRAINT "Ledger_pkey" TO "Ledger_unpartitioned_pkey"')
+    op.execute('ALTER INDEX "ix_Ledger_account_id_created_at_id" RENAME TO "ix_Ledger_unpartitioned_account_id_created_at_id"')
+    op.execute('ALTER SEQUENCE "Ledger_id_seq" OWNED BY NONE')
+
+    op.execute('CREATE TABLE "Ledger" (LIKE "Ledger_unpartitioned" INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)')
+    op.execute('ALTER TABLE "Ledger" ALTER COLUMN created_at SET NOT NULL')
+    op.execute('ALTER TABLE "Ledger" ADD CONSTRAINT "Ledger_pkey" PRIMARY KEY (id, created_at)')
+    op.execute('ALTER TABLE "Ledger" ADD CONSTRAINT "Ledger_account_id_fkey" '
+               'FOREIGN KEY (account_id) REFERENCES "Accounts" (id)')
+
+    oldest = bind.execute(sa.text('SELECT min(created_at) FROM "Ledger_unpartitioned"')).scalar() or datetime.now()
+    month = date(oldest.year, oldest.month, 1)
+    last = add_months(date.today().replace(day=1), FUTURE_MONTHS)
+
+    while month <= last:
+        op.execute('CREATE TABLE "Ledger_y{:04d}m{:02d}" PARTITION OF "Ledger" FOR VALUES FROM (\'{}\') TO (\'{}\')'
+                   .format(month.year, month.month, month.isoformat(), add_months(month, 1).isoformat()))
+        month = add_months(month, 1)
+
+    op.execute('CREATE TABLE "Ledger_default" PARTITION OF "Ledger" DEFAULT')
+
+    # Entries without a created_at can't go in a partition's key so they get
+    # the epoch, which lands them in the default partition
+    op.execute('INSERT INTO "Ledger" ({0}) SELECT id, account_id, transaction_type, amount, details, '
+               'COALESCE(created_at, \'1970-01-01\') FROM "Ledger_unpartitioned"'.format(COLUMNS))
+
+    op.create_index('ix_Ledger_account_id_created_at_id', 'Ledger', ['account_id', 'created_at', 'id'], unique=False)
+    op.execute('ALTER SEQUENCE "Ledger_id_seq" OWNED BY "Ledger".id')
+    op.execute('DROP TABLE "Ledger_unpartitioned"')
+    op.execute('ANALYZE "Ledger"')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != "postgresql":
+        return
+
+    op.execute('ALTER TABLE "Ledger" RENAME TO "Ledger_partitioned"')
+    op.execute('ALTER TABLE "Ledger_partitioned" RENAME CONSTRAINT "Ledger_pkey" TO "Ledger_partitioned_pkey"')
+    op.execute('ALTER INDEX "ix_Ledger_account_id_created_at_id" RENAME TO "ix_Ledger_partitioned_account_id_created_at_id"')
+    op.execute('ALTER SEQUENCE "Ledger_id_seq" OWNED BY NONE')
+
+    op.execute('CREATE TABLE "Ledger" (LIKE "Ledger_partitioned" INCLUDING DEFAULTS)')
+    op.execute('ALTER TABLE "Ledger" ALTER COLUMN created_at DROP NOT NULL')
+    op.execute('ALTER TABLE "Ledger" ADD CONSTRAINT "Ledger_pkey" PRIMARY KEY (id)')
+    op.execute('ALTER TABLE "Ledger" ADD CONSTRAINT "Ledger_account_id_fkey" '
+               'FOREIGN KEY (account_id) REFERENCES "Accounts" (id)')
+    op.execute('INSERT INTO "Ledger" ({0}) SELECT {0} FROM "Ledger_partitioned"'.format(COLUMNS))
+
+    op.create_index('ix_Ledger_account_id_created_at_id', 'Ledger', ['account_id', 'created_at', 'id'], unique=False)
+    op.execute('ALTER SEQUENCE "Ledger_id_seq" OWNED BY "Ledger".id')
+    op.execute('DROP TABLE "Ledger_partitioned"')
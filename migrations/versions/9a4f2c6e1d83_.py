@@ -0,0 +1,33 @@
+"""add import jobs
+
+Revision ID: 9a4f2c6e1d83
+Revises: 3c1e5a9d7b42
+Create Date: 2026-10-18 10:24:07.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4f2c6e1d83'
+down_revision = '3c1e5a9d7b42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('ImportJobs',
+    sa.Column('id', sa.String(), nullable=False),
+    sa.Column('kind', sa.String(), nullable=True),
+    sa.Column('rows_processed', sa.Integer(), nullable=True),
+    sa.Column('rows_imported', sa.Integer(), nullable=True),
+    sa.Column('rows_failed', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('ImportJobs')
@@ -0,0 +1,37 @@
+"""add key rotations
+
+Revision ID: a3d6f1b9e274
+Revises: 5a8e2d7c1f94
+Create Date: 2026-10-18 19:12:44.281930
+
+Existing customer fields have no key id and keep being read with
+LEGACY_ENCRYPTION_KEY_ID's key until manage.py rotate_keys rewrites them.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3d6f1b9e274'
+down_revision = '5a8e2d7c1f94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('KeyRotations',
+    sa.Column('key_id', sa.String(length=64), nullable=False),
+    sa.Column('shard', sa.String(length=64), nullable=False),
+    sa.Column('last_id', sa.Integer(), nullable=False),
+    sa.Column('max_id', sa.Integer(), nullable=False),
+    sa.Column('rows_rotated', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.Column('completed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('key_id', 'shard')
+    )
+
+
+def downgrade():
+    op.drop_table('KeyRotations')
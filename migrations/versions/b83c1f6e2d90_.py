@@ -0,0 +1,26 @@
+"""add customer and account versions
+
+Revision ID: b83c1f6e2d90
+Revises: 6f2a9d4c0b57
+Create Date: 2026-10-18 13:15:44.092671
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b83c1f6e2d90'
+down_revision = '6f2a9d4c0b57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Customers', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('Accounts', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('Accounts', 'version')
+    op.drop_column('Customers', 'version')
@@ -0,0 +1,24 @@
+"""add idempotency claim leases
+
+Revision ID: c81e4d2a6f37
+Revises: a3d6f1b9e274
+Create Date: 2026-10-18 20:41:09.517362
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81e4d2a6f37'
+down_revision = 'a3d6f1b9e274'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('IdempotencyKeys', sa.Column('lease_expires_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('IdempotencyKeys', 'lease_expires_at')
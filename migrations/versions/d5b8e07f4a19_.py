@@ -0,0 +1,67 @@
+"""add customer blind indexes
+
+Revision ID: d5b8e07f4a19
+Revises: 9a4f2c6e1d83
+Create Date: 2026-10-18 11:02:13.640218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from models import Customers, blind_index, blind_index_normalizers
+
+# revision identifiers, used by Alembic.
+revision = 'd5b8e07f4a19'
+down_revision = '9a4f2c6e1d83'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    op.add_column('Customers', sa.Column('email_bidx', sa.String(length=64), nullable=True))
+    op.add_column('Customers', sa.Column('phone_number_bidx', sa.String(length=64), nullable=True))
+    op.add_column('Customers', sa.Column('ssn_bidx', sa.String(length=64), nullable=True))
+
+    # Backfill existing customers a batch at a time. Selecting through the
+    # model's columns decrypts the values so they can be hashed.
+    connection = op.get_bind()
+    customers = Customers.__table__
+    fields = list(blind_index_normalizers)
+    update = customers.update() \
+        .where(customers.c.id == sa.bindparam('customer_id')) \
+        .values(**{field + '_bidx': sa.bindparam(field + '_bidx') for field in fields})
+    last_id = 0
+
+    while True:
+        rows = connection.execute(
+            sa.select([customers.c.id] + [customers.c[field] for field in fields])
+            .where(customers.c.id > last_id)
+            .order_by(customers.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+
+        if not rows:
+            break
+
+        params = []
+        for row in rows:
+            values = {field + '_bidx': blind_index(field, row[field]) for field in fields}
+            values['customer_id'] = row['id']
+            params.append(values)
+
+        connection.execute(update, params)
+        last_id = rows[-1]['id']
+
+    op.create_index(op.f('ix_Customers_email_bidx'), 'Customers', ['email_bidx'], unique=False)
+    op.create_index(op.f('ix_Customers_phone_number_bidx'), 'Customers', ['phone_number_bidx'], unique=False)
+    op.create_index(op.f('ix_Customers_ssn_bidx'), 'Customers', ['ssn_bidx'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_Customers_ssn_bidx'), table_name='Customers')
+    op.drop_index(op.f('ix_Customers_phone_number_bidx'), table_name='Customers')
+    op.drop_index(op.f('ix_Customers_email_bidx'), table_name='Customers')
+    op.drop_column('Customers', 'ssn_bidx')
+    op.drop_column('Customers', 'phone_number_bidx')
+    op.drop_column('Customers', 'email_bidx')
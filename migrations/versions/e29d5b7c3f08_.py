@@ -0,0 +1,36 @@
+"""add idempotency keys
+
+Revision ID: e29d5b7c3f08
+Revises: 4c7e2a9f1b65
+Create Date: 2026-10-18 14:48:12.604391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e29d5b7c3f08'
+down_revision = '4c7e2a9f1b65'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('IdempotencyKeys',
+    sa.Column('key', sa.String(length=255), nullable=False),
+    sa.Column('fingerprint', sa.String(length=64), nullable=False),
+    sa.Column('completed', sa.Boolean(), nullable=False),
+    sa.Column('response_status', sa.Integer(), nullable=True),
+    sa.Column('response_headers', sa.Text(), nullable=True),
+    sa.Column('response_body', sa.LargeBinary(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index(op.f('ix_IdempotencyKeys_expires_at'), 'IdempotencyKeys', ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_IdempotencyKeys_expires_at'), table_name='IdempotencyKeys')
+    op.drop_table('IdempotencyKeys')
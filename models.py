@@ -7,25 +7,70 @@ Status: Production
 Summary: This is the models file where all database models are defined.
 """
 
-from app import db
+from flask import current_app
+from encryption import VersionedEncryptedType
+from extensions import db, keyring, metrics
 from datetime import datetime
-from sqlalchemy_utils import ChoiceType, EncryptedType
+from sqlalchemy.orm import validates
+from sqlalchemy_utils import ChoiceType
 from sqlalchemy_utils.types.encrypted.encrypted_type import AesEngine
+import hashlib
+import hmac
+import re
 
-secret_key = "F21998729FE5D4BCCE8A4FAADE659"
+# AES engine for the encrypted columns, timed for /metrics. Their keys are
+# ENCRYPTION_KEYS, held by the keyring.
+aes_engine = metrics.crypto_engine(AesEngine)
+
+# How each blind indexed field is normalized before hashing so lookups match
+# regardless of case or punctuation
+blind_index_normalizers = {
+    'email': lambda value: value.strip().lower(),
+    'phone_number': lambda value: re.sub(r'\D', '', value),
+    'ssn': lambda value: re.sub(r'\D', '', value),
+}
+
+
+def blind_index(field, value):
+    """
+    Returns the keyed HMAC of a normalized field value. Equal values always get
+    the same blind index so it can be indexed and searched without decrypting.
+    """
+    if value is None:
+        return None
+
+    message = "{}:{}".format(field, blind_index_normalizers[field](value))
+    return hmac.new(current_app.config['BLIND_INDEX_KEY'].encode('utf-8'), message.encode('utf-8'),
+                    hashlib.sha256).hexdigest()
 
 
 class Customers(db.Model):
     __tablename__ = "Customers"
 
     id = db.Column(db.Integer, primary_key=True)
-    first_name = db.Column(EncryptedType(db.String(), secret_key, AesEngine, 'pkcs5'))
-    last_name = db.Column(EncryptedType(db.String(), secret_key, AesEngine, 'pkcs5'))
-    phone_number = db.Column(EncryptedType(db.String(), secret_key, AesEngine, 'pkcs5'))  # Must be of format ###-###-####
-    email = db.Column(EncryptedType(db.String(), secret_key, AesEngine, 'pkcs5'))  # Must be of farmat abc@qrs.xyz
-    ssn = db.Column(EncryptedType(db.String(11), secret_key, AesEngine, 'pkcs5'))  # Must be of format ###-##-####
+    first_name = db.Column(VersionedEncryptedType(db.String(), keyring, aes_engine, 'pkcs5'))
+    last_name = db.Column(VersionedEncryptedType(db.String(), keyring, aes_engine, 'pkcs5'))
+    phone_number = db.Column(VersionedEncryptedType(db.String(), keyring, aes_engine, 'pkcs5'))  # Must be of format ###-###-####
+    email = db.Column(VersionedEncryptedType(db.String(), keyring, aes_engine, 'pkcs5'))  # Must be of farmat abc@qrs.xyz
+    ssn = db.Column(VersionedEncryptedType(db.String(11), keyring, aes_engine, 'pkcs5'))  # Must be of format ###-##-####
     active = db.Column(db.Boolean())
-    created_at = db.Column(db.DateTime, default=datetime.now())
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    # Bumped by every update. Used for ETags and to stop concurrent updates
+    # from silently overwriting each other.
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    __mapper_args__ = {"version_id_col": version}
+
+    # Blind indexes of the encrypted fields that customers can be looked up by
+    email_bidx = db.Column(db.String(64), index=True)
+    phone_number_bidx = db.Column(db.String(64), index=True)
+    ssn_bidx = db.Column(db.String(64), index=True)
+
+    # Fields that can be asked for with ?fields= and the ones returned when it
+    # isn't given. The SSN is only ever returned when explicitly asked for.
+    fields = ('id', 'first_name', 'last_name', 'phone_number', 'email', 'ssn', 'active', 'created_at')
+    default_fields = ('id', 'first_name', 'last_name', 'phone_number', 'email', 'active', 'created_at')
+    encrypted_fields = ('first_name', 'last_name', 'phone_number', 'email', 'ssn')
 
     def __init__(self, first_name, last_name, phone_number, email, ssn, active):
         self.first_name = first_name
@@ -38,17 +83,13 @@ class Customers(db.Model):
     def __repr__(self):
         return '<id {}, name {} {}>'.format(self.id, self.first_name, self.last_name)
 
-    def serialize(self):
-        return {
-            'id': self.id,
-            'first_name': self.first_name,
-            'last_name': self.last_name,
-            'phone_number': self.phone_number,
-            'email': self.email,
-            'ssn': self.ssn,
-            'active': self.active,
-            'created_at': self.created_at
-        }
+    @validates('email', 'phone_number', 'ssn')
+    def update_blind_index(self, key, value):
+        setattr(self, key + '_bidx', blind_index(key, value))
+        return value
+
+    def serialize(self, fields=None):
+        return {field: getattr(self, field) for field in fields or self.default_fields}
 
 
 class Accounts(db.Model):
@@ -80,7 +121,17 @@ class Accounts(db.Model):
     routing_number = db.Column(db.String())
     status = db.Column(ChoiceType(status_choices))
     active = db.Column(db.Boolean())
-    created_at = db.Column(db.DateTime, default=datetime.now())
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    # Bumped by every update, including balance changes made by the transfer
+    # engine. Used for ETags and to stop concurrent updates from silently
+    # overwriting each other.
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    __mapper_args__ = {"version_id_col": version}
+
+    # Fields that can be asked for with ?fields= and the ones returned when it isn't given
+    fields = ('id', 'account_type', 'balance', 'account_number', 'routing_number', 'status', 'active', 'created_at')
+    default_fields = fields
 
     def __init__(self, customer, customer_id, account_type, balance, account_number, routing_number, status, active):
         self.customer_id = customer_id
@@ -95,21 +146,25 @@ class Accounts(db.Model):
     def __repr__(self):
         return '<id {}, account number {}>'.format(self.id, self.account_number)
 
-    def serialize(self):
-        return {
-            'id': self.id,
-            'account_type': self.account_type.value,
-            'balance': self.balance,
-            'account_number': self.account_number,
-            'routing_number': self.routing_number,
-            'status': self.status.value,
-            'active': self.active,
-            'created_at': self.created_at
-        }
+    def serialize(self, fields=None):
+        serialized = {field: getattr(self, field) for field in fields or self.default_fields}
+
+        # ChoiceType columns hold Choice objects so unwrap them to their value
+        for field in ('account_type', 'status'):
+            if field in serialized:
+                serialized[field] = serialized[field].value
+
+        return serialized
 
 
 class Ledger(db.Model):
+    # On PostgreSQL the migrations partition this table by month on created_at
+    # with a (id, created_at) primary key. See partitions.py.
     __tablename__ = "Ledger"
+    __table_args__ = (
+        # Serves the paginated, time ranged ledger reads for a single account
+        db.Index("ix_Ledger_account_id_created_at_id", "account_id", "created_at", "id"),
+    )
 
     transaction_type_choices = {
         ("debit", "debit"),
@@ -131,7 +186,10 @@ class Ledger(db.Model):
     transaction_type = db.Column(ChoiceType(transaction_type_choices))
     amount = db.Column(db.Float())
     details = db.Column(ChoiceType(details_choices))
-    created_at = db.Column(db.DateTime, default=datetime.now())
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    # Fields returned by serialize()
+    fields = ('id', 'account_id', 'transaction_type', 'amount', 'details', 'created_at')
 
     def __init__(self, account_id, account, transaction_type, amount, details):
         self.account_id = account_id
@@ -152,3 +210,233 @@ class Ledger(db.Model):
             'details': self.details.value,
             'created_at': self.created_at,
         }
+
+
+class ImportJobs(db.Model):
+    __tablename__ = "ImportJobs"
+
+    id = db.Column(db.String(), primary_key=True)
+    kind = db.Column(db.String())
+    rows_processed = db.Column(db.Integer, default=0)
+    rows_imported = db.Column(db.Integer, default=0)
+    rows_failed = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now)
+
+    def __init__(self, id, kind):
+        self.id = id
+        self.kind = kind
+        self.rows_processed = 0
+        self.rows_imported = 0
+        self.rows_failed = 0
+
+    def __repr__(self):
+        return '<id {}, kind {}>'.format(self.id, self.kind)
+
+    def serialize(self):
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'rows_processed': self.rows_processed,
+            'rows_imported': self.rows_imported,
+            'rows_failed': self.rows_failed,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+        }
+
+
+class BalanceCheckpoints(db.Model):
+    __tablename__ = "BalanceCheckpoints"
+    __table_args__ = (
+        # One checkpoint per account per point in time. Also serves the
+        # nearest checkpoint lookups for point in time balances.
+        db.UniqueConstraint("account_id", "as_of"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey("Accounts.id"))
+    as_of = db.Column(db.DateTime)
+    balance = db.Column(db.Float())
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    def __init__(self, account_id, as_of, balance):
+        self.account_id = account_id
+        self.as_of = as_of
+        self.balance = balance
+
+    def __repr__(self):
+        return '<id {}, account id {}, as of {}>'.format(self.id, self.account_id, self.as_of)
+
+
+class ActivityRollups(db.Model):
+    __tablename__ = "ActivityRollups"
+    __table_args__ = (
+        db.UniqueConstraint("account_id", "granularity", "period_start", "transaction_type", "details"),
+    )
+
+    granularity_choices = {
+        ("day", "day"),
+        ("month", "month")
+    }
+
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey("Accounts.id"))
+    granularity = db.Column(ChoiceType(granularity_choices))
+    period_start = db.Column(db.Date)
+    transaction_type = db.Column(ChoiceType(Ledger.transaction_type_choices))
+    details = db.Column(ChoiceType(Ledger.details_choices))
+    count = db.Column(db.Integer)
+    total = db.Column(db.Float())
+
+    def __init__(self, account_id, granularity, period_start, transaction_type, details, count, total):
+        self.account_id = account_id
+        self.granularity = granularity
+        self.period_start = period_start
+        self.transaction_type = transaction_type
+        self.details = details
+        self.count = count
+        self.total = total
+
+    def __repr__(self):
+        return '<id {}, account id {}, {} of {}>'.format(self.id, self.account_id, self.granularity, self.period_start)
+
+    def serialize(self):
+        return {
+            'period_start': self.period_start.isoformat(),
+            'transaction_type': self.transaction_type.value,
+            'details': self.details.value,
+            'count': self.count,
+            'total': self.total,
+        }
+
+
+class TransferRequests(db.Model):
+    __tablename__ = "TransferRequests"
+    __table_args__ = (
+        # Serves the workers' oldest queued transfers first lookups per partition
+        db.Index("ix_TransferRequests_status_partition_id", "status", "partition", "id"),
+    )
+
+    status_choices = {
+        ("queued", "queued"),
+        ("completed", "completed"),
+        ("failed", "failed")
+    }
+
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey("Customers.id"))
+    from_account_id = db.Column(db.Integer, db.ForeignKey("Accounts.id"))
+    to_account_id = db.Column(db.Integer, db.ForeignKey("Accounts.id"))
+    amount = db.Column(db.Float())
+    partition = db.Column(db.Integer, nullable=False)
+    status = db.Column(ChoiceType(status_choices), nullable=False)
+    error = db.Column(db.String())
+    attempts = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    completed_at = db.Column(db.DateTime)
+
+    def __init__(self, customer_id, from_account_id, to_account_id, amount, partition):
+        self.customer_id = customer_id
+        self.from_account_id = from_account_id
+        self.to_account_id = to_account_id
+        self.amount = amount
+        self.partition = partition
+        self.status = "queued"
+        self.attempts = 0
+
+    def __repr__(self):
+        return '<id {}, status {}>'.format(self.id, self.status)
+
+    def serialize(self):
+        return {
+            'transfer_id': self.id,
+            'customer_id': self.customer_id,
+            'from_account_id': self.from_account_id,
+            'to_account_id': self.to_account_id,
+            'amount': self.amount,
+            'status': self.status.value,
+            'error': self.error,
+            'created_at': self.created_at,
+            'completed_at': self.completed_at,
+        }
+
+
+class IdempotencyKeys(db.Model):
+    __tablename__ = "IdempotencyKeys"
+
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    completed = db.Column(db.Boolean, default=False, nullable=False)
+    response_status = db.Column(db.Integer)
+    response_headers = db.Column(db.Text)
+    response_body = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    lease_expires_at = db.Column(db.DateTime)  # When a claim that never completed can be taken over
+
+    def __init__(self, key, fingerprint, expires_at, lease_expires_at):
+        self.key = key
+        self.fingerprint = fingerprint
+        self.completed = False
+        self.expires_at = expires_at
+        self.lease_expires_at = lease_expires_at
+
+    def __repr__(self):
+        return '<key {}, completed {}>'.format(self.key, self.completed)
+
+
+class CustomerShards(db.Model):
+    # Customers that were moved off their home shard. Lives on the default
+    # database with the other tables that aren't sharded.
+    __tablename__ = "CustomerShards"
+
+    customer_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    shard = db.Column(db.String(64))  # Bind key, null for the default database
+    moving = db.Column(db.Boolean, default=False, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now)
+
+    def __init__(self, customer_id, shard, moving):
+        self.customer_id = customer_id
+        self.shard = shard
+        self.moving = moving
+
+    def __repr__(self):
+        return '<customer_id {}, shard {}, moving {}>'.format(self.customer_id, self.shard, self.moving)
+
+
+class KeyRotations(db.Model):
+    # Progress of rotating the customers of one shard to a key. Every customer
+    # with an id up to last_id is encrypted with it. Lives on the default
+    # database with the other tables that aren't sharded.
+    __tablename__ = "KeyRotations"
+
+    key_id = db.Column(db.String(64), primary_key=True)
+    shard = db.Column(db.String(64), primary_key=True)  # Bind key, default for the default database
+    last_id = db.Column(db.Integer, default=0, nullable=False)
+    max_id = db.Column(db.Integer, default=0, nullable=False)
+    rows_rotated = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now)
+    completed_at = db.Column(db.DateTime)
+
+    def __init__(self, key_id, shard, max_id):
+        self.key_id = key_id
+        self.shard = shard
+        self.last_id = 0
+        self.max_id = max_id
+        self.rows_rotated = 0
+
+    def __repr__(self):
+        return '<key_id {}, shard {}, last_id {}>'.format(self.key_id, self.shard, self.last_id)
+
+    def serialize(self):
+        return {
+            'key_id': self.key_id,
+            'shard': self.shard,
+            'last_id': self.last_id,
+            'max_id': self.max_id,
+            'rows_rotated': self.rows_rotated,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+            'completed_at': self.completed_at,
+        }
@@ -0,0 +1,178 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the maintenance code for the monthly Ledger partitions on
+         PostgreSQL. Partitions are created a few months ahead so entries
+         never land in the default partition, and partitions older than the
+         retention period are detached, written to a gzipped CSV file and
+         dropped.
+"""
+
+import csv
+import gzip
+import io
+import os
+import re
+from datetime import date
+
+from flask import current_app
+
+from extensions import db
+
+PARTITION_NAME = re.compile(r"^Ledger_y(\d{4})m(\d{2})$")
+
+
+class PartitionError(Exception):
+    pass
+
+
+def add_months(month, months):
+    months = month.year * 12 + month.month - 1 + months
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def partition_name(month):
+    return "Ledger_y{:04d}m{:02d}".format(month.year, month.month)
+
+
+def is_partitioned():
+    if db.engine.dialect.name != "postgresql":
+        return False
+
+    return bool(db.session.execute(
+        "SELECT count(*) FROM pg_partitioned_table WHERE partrelid = '\"Ledger\"'::regclass").scalar())
+
+
+def require_partitioned():
+    if db.engine.dialect.name != "postgresql":
+        raise PartitionError("Ledger partitions need PostgreSQL")
+
+    if not is_partitioned():
+        raise PartitionError("Ledger isn't partitioned, run the migrations first")
+
+
+def partitions():
+    """
+    Returns the months of the monthly partitions attached to Ledger, oldest first.
+    """
+    names = db.session.execute(
+        "SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = '\"Ledger\"'::regclass")
+
+    months = []
+
+    for (name,) in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            months.append(date(int(match.group(1)), int(match.group(2)), 1))
+
+    return sorted(months)
+
+
+def oldest_partition():
+    """
+    Returns the month of the oldest partition attached to Ledger, or None when
+    Ledger isn't partitioned. Entries of the months before it may have been
+    archived.
+    """
+    if not is_partitioned():
+        return None
+
+    months = partitions()
+    return months[0] if months else None
+
+
+def create_partitions(months_ahead):
+    """
+    Creates any missing partitions from this month through months_ahead months
+    from now. Returns the names of the partitions created.
+    """
+    require_partitioned()
+
+    existing = set(partitions())
+    this_month = date.today().replace(day=1)
+    created = []
+
+    for offset in range(months_ahead + 1):
+        month = add_months(this_month, offset)
+
+        if month in existing:
+            continue
+
+        db.session.execute('CREATE TABLE "{}" PARTITION OF "Ledger" FOR VALUES FROM (\'{}\') TO (\'{}\')'
+                           .format(partition_name(month), month.isoformat(), add_months(month, 1).isoformat()))
+        db.session.commit()
+        created.append(partition_name(month))
+        current_app.logger.info("Created Ledger partition {}".format(partition_name(month)))
+
+    return created
+
+
+def export_partition(name, path):
+    """
+    Writes every row of a table to a gzipped CSV file with a header through
+    COPY and returns the number of rows the file holds.
+    """
+    cursor = db.session.connection().connection.cursor()
+
+    with gzip.open(path, "wb") as archive:
+        cursor.copy_expert('COPY "{}" TO STDOUT WITH (FORMAT csv, HEADER)'.format(name), archive)
+
+    with io.TextIOWrapper(gzip.open(path, "rb"), encoding="utf-8") as archive:
+        return sum(1 for _ in csv.reader(archive)) - 1
+
+
+def archive_partitions(keep_months, directory):
+    """
+    Archives every partition of a month that ended more than keep_months months
+    ago. Each one is detached from Ledger, exported to directory and only
+    dropped once the export has every row. A partition whose export fails is
+    attached again. Returns the paths of the files written.
+
+    Archived entries are gone from ledger reads and point in time balances
+    before the oldest remaining partition. Activity rollups keep their totals.
+    """
+    require_partitioned()
+
+    cutoff = add_months(date.today().replace(day=1), -keep_months)
+    archived = []
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    for month in partitions():
+        if add_months(month, 1) > cutoff:
+            continue
+
+        name = partition_name(month)
+        path = os.path.join(directory, name + ".csv.gz")
+
+        db.session.execute('ALTER TABLE "Ledger" DETACH PARTITION "{}"'.format(name))
+        db.session.commit()
+
+        try:
+            # Written under a temporary name so a file at path is always complete
+            rows = db.session.execute('SELECT count(*) FROM "{}"'.format(name)).scalar()
+            written = export_partition(name, path + ".partial")
+
+            if written != rows:
+                raise PartitionError("Archive of {} has {} of its {} rows".format(name, written, rows))
+
+            os.rename(path + ".partial", path)
+            db.session.execute('DROP TABLE "{}"'.format(name))
+            db.session.commit()
+
+        except Exception:
+            db.session.rollback()
+            db.session.execute('ALTER TABLE "Ledger" ATTACH PARTITION "{}" FOR VALUES FROM (\'{}\') TO (\'{}\')'
+                               .format(name, month.isoformat(), add_months(month, 1).isoformat()))
+            db.session.commit()
+            raise
+
+        archived.append(path)
+        current_app.logger.info("Archived Ledger partition {} with {} rows to {}".format(name, rows, path))
+
+    return archived
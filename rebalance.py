@@ -0,0 +1,184 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the shard maintenance code. configure_sequences sets up the
+         id sequences of every shard so ids are unique across shards and a
+         customer's id tells which shard created them. move_customer moves a
+         customer, with their accounts, ledger and everything else keyed by
+         them, to another shard while the API keeps serving their reads.
+"""
+
+import time
+
+from flask import current_app
+from sqlalchemy import text
+
+from extensions import db, shards
+from models import CustomerShards
+from sharding import ShardError
+
+# Sharded tables with their customer's rows, parents first
+CUSTOMER_ROWS = (
+    ("Customers", "id = :customer_id"),
+    ("Accounts", "customer_id = :customer_id"),
+    ("Ledger", 'account_id IN (SELECT id FROM "Accounts" WHERE customer_id = :customer_id)'),
+    ("BalanceCheckpoints", 'account_id IN (SELECT id FROM "Accounts" WHERE customer_id = :customer_id)'),
+    ("ActivityRollups", 'account_id IN (SELECT id FROM "Accounts" WHERE customer_id = :customer_id)'),
+    ("TransferRequests", "customer_id = :customer_id"),
+)
+
+
+def engine_for(shard):
+    return db.get_engine(bind=shard)
+
+
+def configure_sequences():
+    """
+    Restarts the id sequence of every sharded table on every shard above the
+    highest id on any shard, stepping by SHARD_ID_STRIDE from the shard's
+    position in SHARDS. Run it with writes stopped whenever SHARDS changes.
+    Returns the highest customer id found.
+    """
+    names = shards.names()
+    stride = current_app.config['SHARD_ID_STRIDE']
+
+    if len(names) > stride:
+        raise ShardError("SHARDS can't have more than SHARD_ID_STRIDE ({}) shards".format(stride))
+
+    for shard in names:
+        if engine_for(shard).dialect.name != "postgresql":
+            raise ShardError("Shard sequences need PostgreSQL")
+
+    highest_customer_id = 0
+
+    for table, _ in CUSTOMER_ROWS:
+        highest = max(engine_for(shard).execute('SELECT COALESCE(max(id), 0) FROM "{}"'.format(table)).scalar()
+                      for shard in names)
+        base = (highest // stride + 1) * stride
+
+        for index, shard in enumerate(names):
+            engine_for(shard).execute('ALTER SEQUENCE "{}_id_seq" INCREMENT BY {} RESTART WITH {}'
+                                      .format(table, stride, base + index))
+
+        if table == "Customers":
+            highest_customer_id = highest
+
+        current_app.logger.info("{} ids start at {} on the first shard".format(table, base))
+
+    return highest_customer_id
+
+
+def set_directory(customer_id, shard, moving):
+    """
+    Records where a customer lives. Customers back on their home shard are
+    taken out of the directory.
+    """
+    CustomerShards.query.filter(CustomerShards.customer_id == customer_id).delete(synchronize_session=False)
+
+    if moving or shard != shards.home(customer_id):
+        db.session.add(CustomerShards(customer_id, shard, moving))
+
+    db.session.commit()
+    shards.expire()
+
+
+def delete_rows(connection, customer_id):
+    for table, condition in reversed(CUSTOMER_ROWS):
+        connection.execute(text('DELETE FROM "{}" WHERE {}'.format(table, condition)), customer_id=customer_id)
+
+
+def count_rows(connection, customer_id):
+    return [connection.execute(text('SELECT count(*) FROM "{}" WHERE {}'.format(table, condition)),
+                               customer_id=customer_id).scalar()
+            for table, condition in CUSTOMER_ROWS]
+
+
+def copy_rows(source, target, customer_id, batch_size):
+    """
+    Copies every row of the customer from the source to the target connection
+    as stored, so encrypted fields are never decrypted, batch_size rows at a
+    time through a server side cursor. Returns the number of rows copied.
+    """
+    copied = 0
+
+    for table, condition in CUSTOMER_ROWS:
+        rows = source.execution_options(stream_results=True) \
+            .execute(text('SELECT * FROM "{}" WHERE {}'.format(table, condition)), customer_id=customer_id)
+        columns = list(rows.keys())
+        insert = text('INSERT INTO "{}" ({}) VALUES ({})'.format(
+            table, ", ".join('"{}"'.format(column) for column in columns),
+            ", ".join(":c{}".format(index) for index in range(len(columns)))))
+
+        while True:
+            batch = rows.fetchmany(batch_size)
+
+            if not batch:
+                break
+
+            target.execute(insert, [dict(("c{}".format(index), value) for index, value in enumerate(row))
+                                    for row in batch])
+            copied += len(batch)
+
+    return copied
+
+
+def move_customer(customer_id, target, batch_size):
+    """
+    Moves a customer to the target shard. Writes for the customer are turned
+    away with a 503 while the customer is marked as moving, reads keep going
+    to the old shard. Once every process has seen the mark the rows are
+    copied in one transaction on the target and checked, the directory is
+    pointed at the target and, once every process has seen that, the rows are
+    deleted from the old shard. Returns the number of rows moved.
+    """
+    if target not in shards.names():
+        raise ShardError("{} isn't in SHARDS".format(target))
+
+    shards.expire()
+    source = shards.shard_for(customer_id)
+
+    if source == target:
+        return 0
+
+    with engine_for(source).connect() as connection:
+        if not connection.execute(text('SELECT count(*) FROM "Customers" WHERE id = :customer_id'),
+                                  customer_id=customer_id).scalar():
+            raise ShardError("Customer with id {} does not exist".format(customer_id))
+
+        if connection.execute(text("SELECT count(*) FROM \"TransferRequests\" WHERE customer_id = :customer_id "
+                                   "AND status = 'queued'"), customer_id=customer_id).scalar():
+            raise ShardError("Customer with id {} has queued transfers, move them once the queue has run them"
+                             .format(customer_id))
+
+    # Leftovers of a move that didn't finish
+    with engine_for(target).begin() as connection:
+        delete_rows(connection, customer_id)
+
+    wait = 2 * current_app.config['SHARD_DIRECTORY_TTL']
+    set_directory(customer_id, source, moving=True)
+    time.sleep(wait)
+
+    try:
+        with engine_for(source).connect() as source_connection:
+            with engine_for(target).begin() as target_connection:
+                moved = copy_rows(source_connection, target_connection, customer_id, batch_size)
+
+                if count_rows(target_connection, customer_id) != count_rows(source_connection, customer_id):
+                    raise ShardError("Copy of customer {} to {} is missing rows".format(customer_id, target))
+
+    except Exception:
+        set_directory(customer_id, source, moving=False)
+        raise
+
+    set_directory(customer_id, target, moving=False)
+    time.sleep(wait)
+
+    with engine_for(source).begin() as connection:
+        delete_rows(connection, customer_id)
+
+    current_app.logger.info("Moved customer {} with {} rows from {} to {}".format(customer_id, moved, source, target))
+
+    return moved
@@ -0,0 +1,256 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is read replica routing. GET requests read from a replica of
+         each primary listed in REPLICAS and everything else goes to the
+         primary. Responses to writes carry a read-after token, as a cookie and
+         a header, with the primary's position after the write. A read that
+         sends it back waits briefly for its replica to replay up to that
+         position and otherwise reads from the primary, so clients always see
+         their own writes.
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+
+COOKIE = "read_after"
+HEADER = "X-Read-After"
+
+# Request methods served from replicas
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def lsn_value(lsn):
+    # PostgreSQL LSNs are two hex numbers, e.g. 16/B374D848
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def parse_token(value):
+    """
+    Returns {primary: position} from a read-after token. The default database
+    is written as an empty name. Malformed entries are ignored.
+    """
+    positions = {}
+
+    for entry in (value or "").split(","):
+        primary, _, position = entry.partition("@")
+
+        if position:
+            positions[primary or None] = position
+
+    return positions
+
+
+def format_token(positions):
+    return ",".join("{}@{}".format(primary or "", position) for primary, position in sorted(
+        positions.items(), key=lambda item: item[0] or ""))
+
+
+class Replicas(object):
+    """
+    Routes reads to replicas, following the Flask extension pattern. REPLICAS
+    maps the bind key of each primary, None for the default database, to the
+    SQLALCHEMY_BINDS keys of its replicas.
+    """
+
+    def __init__(self, app=None, db=None):
+        self.lock = threading.Lock()
+        self.counters = {}
+
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        self.reset_stats()
+
+        if app.config['REPLICAS']:
+            app.before_request(self.route_request)
+            app.after_request(self.remember_writes)
+
+    @property
+    def enabled(self):
+        return bool(self.app.config['REPLICAS'])
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def reset_stats(self):
+        with self.lock:
+            self.counters = {"replica": 0, "caught_up": 0, "primary": 0}
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def engine(self, bind):
+        return self.db.get_engine(self.app, bind=bind)
+
+    def position(self, primary):
+        """
+        Returns the primary's current write position. Databases other than
+        PostgreSQL get the time instead and reads pin to the primary for
+        REPLICA_PIN_SECONDS after it.
+        """
+        engine = self.engine(primary)
+
+        if engine.dialect.name == "postgresql":
+            return engine.execute("SELECT pg_current_wal_lsn()::text").scalar()
+
+        return "t{:.6f}".format(time.time())
+
+    def caught_up(self, replica, position):
+        if position.startswith("t"):
+            return time.time() - float(position[1:]) >= self.app.config['REPLICA_PIN_SECONDS']
+
+        lsn = lsn_value(position)
+        engine = self.engine(replica)
+
+        if engine.dialect.name != "postgresql":
+            raise ValueError("Replica {} can't report its replay position".format(replica))
+
+        replayed = engine.execute("SELECT pg_last_wal_replay_lsn()::text").scalar()
+
+        # Not replaying anything means it isn't a standby, so it has every write
+        return replayed is None or lsn_value(replayed) >= lsn
+
+    def wait_for(self, replica, position):
+        """
+        Polls the replica for up to REPLICA_WAIT_TIMEOUT seconds until it has
+        replayed position. Returns False if it didn't get there in time or
+        can't be asked.
+        """
+        deadline = time.time() + self.app.config['REPLICA_WAIT_TIMEOUT']
+
+        while True:
+            try:
+                if self.caught_up(replica, position):
+                    return True
+
+            except ValueError:
+                # A token that isn't a position can't be waited for
+                return False
+
+            except Exception as e:
+                self.app.logger.error(str(e))
+                return False
+
+            if time.time() >= deadline:
+                return False
+
+            time.sleep(self.app.config['REPLICA_POLL_INTERVAL'])
+
+    def route_request(self):
+        """
+        Picks a replica of every primary for a read, leaving out the primaries
+        whose replica hasn't caught up with the client's last write.
+        """
+        if request.method not in READ_METHODS:
+            return None
+
+        positions = parse_token(request.headers.get(HEADER) or request.cookies.get(COOKIE))
+        binds = {}
+
+        for primary, replicas in self.app.config['REPLICAS'].items():
+            replica = random.choice(replicas)
+            position = positions.get(primary)
+
+            if position is None:
+                self.count("replica")
+            elif self.wait_for(replica, position):
+                self.count("caught_up")
+            else:
+                self.count("primary")
+                continue
+
+            binds[primary] = replica
+
+        g.replica_binds = binds
+
+    def remember_writes(self, response):
+        """
+        Adds the write position of every primary with replicas that a
+        successful write used to the client's read-after token.
+        """
+        if request.method in READ_METHODS or response.status_code >= 400:
+            return response
+
+        written = [primary for primary in g.get("primaries", ()) if primary in self.app.config['REPLICAS']]
+
+        if not written:
+            return response
+
+        positions = parse_token(request.cookies.get(COOKIE))
+        for primary in written:
+            positions[primary] = self.position(primary)
+
+        token = format_token(positions)
+        response.set_cookie(COOKIE, token, max_age=self.app.config['REPLICA_TOKEN_MAX_AGE'], httponly=True)
+        response.headers[HEADER] = token
+
+        return response
+
+    @contextmanager
+    def primary(self):
+        """
+        Sends reads to the primaries until the block ends.
+        """
+        binds = g.pop("replica_binds", None)
+
+        try:
+            yield
+
+        finally:
+            if binds is not None:
+                g.replica_binds = binds
+
+    def on_primary(self, load, cached):
+        """
+        Wraps a loader so it reads from the primary when the value it loads is
+        cached. A replica could still have the data from before a write whose
+        invalidation the value would be cached under, and then every client,
+        the writer too, would read it until the next write. Values that
+        aren't cached are loaded from the replica.
+        """
+        def primary_load():
+            if not cached:
+                return load()
+
+            with self.primary():
+                return load()
+
+        return primary_load
+
+    def lag(self):
+        """
+        Returns {replica: seconds behind its primary} for the PostgreSQL
+        replicas that answer.
+        """
+        lags = {}
+
+        for replicas in self.app.config['REPLICAS'].values():
+            for replica in replicas:
+                engine = self.engine(replica)
+
+                if engine.dialect.name != "postgresql":
+                    continue
+
+                try:
+                    lags[replica] = float(engine.execute(
+                        "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                        "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END").scalar())
+
+                except Exception as e:
+                    self.app.logger.error(str(e))
+
+        return lags
@@ -0,0 +1,176 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the account activity rollup code. Ledger writers record the
+         rows they insert here so ActivityRollups always holds the count and
+         total of every account's ledger entries per day and month, split by
+         transaction type and details.
+"""
+
+from collections import defaultdict
+from datetime import date
+
+from sqlalchemy import func, literal
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+
+from extensions import db
+from models import Accounts, Ledger, ActivityRollups
+
+GRANULARITIES = ("day", "month")
+
+
+def period_start(moment, granularity):
+    """
+    Returns the date that starts the day or month moment falls in.
+    """
+    if granularity == "month":
+        return date(moment.year, moment.month, 1)
+
+    return date(moment.year, moment.month, moment.day)
+
+
+def period_start_sql(column, granularity):
+    """
+    SQL version of period_start for rebuilding rollups inside the database.
+    """
+    if db.engine.dialect.name == "postgresql":
+        return func.date_trunc(granularity, column).cast(db.Date)
+
+    if granularity == "month":
+        return func.date(column, "start of month")
+
+    return func.date(column)
+
+
+def record_activity(rows):
+    """
+    Adds ledger rows that were just inserted in the current transaction to the
+    rollups. Each row needs account_id, transaction_type, details, amount and
+    created_at. Rows are aggregated first so each rollup is written once, in a
+    fixed order, with an upsert on PostgreSQL.
+    """
+    totals = defaultdict(lambda: [0, 0.0])
+
+    for row in rows:
+        for granularity in GRANULARITIES:
+            key = (row["account_id"], granularity, period_start(row["created_at"], granularity),
+                   row["transaction_type"], row["details"])
+            totals[key][0] += 1
+            totals[key][1] += row["amount"]
+
+    if not totals:
+        return
+
+    values = [
+        {
+            "account_id": account_id,
+            "granularity": granularity,
+            "period_start": start,
+            "transaction_type": transaction_type,
+            "details": details,
+            "count": count,
+            "total": total,
+        }
+        for (account_id, granularity, start, transaction_type, details), (count, total) in sorted(totals.items())
+    ]
+
+    table = ActivityRollups.__table__
+
+    if db.engine.dialect.name == "postgresql":
+        statement = postgresql_insert(table).values(values)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=["account_id", "granularity", "period_start", "transaction_type", "details"],
+            set_={"count": table.c.count + statement.excluded.count,
+                  "total": table.c.total + statement.excluded.total},
+        ))
+        return
+
+    for value in values:
+        updated = db.session.execute(
+            table.update()
+            .where(table.c.account_id == value["account_id"])
+            .where(table.c.granularity == value["granularity"])
+            .where(table.c.period_start == value["period_start"])
+            .where(table.c.transaction_type == value["transaction_type"])
+            .where(table.c.details == value["details"])
+            .values(count=table.c.count + value["count"], total=table.c.total + value["total"])
+        )
+
+        if not updated.rowcount:
+            db.session.execute(table.insert().values(value))
+
+
+def rebuild_rollups(batch_size):
+    """
+    Recomputes every account's rollups from the Ledger, batch_size accounts per
+    transaction. The accounts of a batch are locked while it is rebuilt so
+    transfers running at the same time can't be counted twice or missed.
+    Only periods from the oldest Ledger partition on are rebuilt, since the
+    rollups are all that is left of archived months. Returns the number of
+    accounts rebuilt.
+    """
+    from partitions import oldest_partition
+    from transfers import lock_accounts
+
+    table = ActivityRollups.__table__
+    since = oldest_partition()
+    rebuilt = 0
+    last_id = 0
+
+    while True:
+        account_ids = [account_id for (account_id,) in db.session.query(Accounts.id)
+                       .filter(Accounts.id > last_id).order_by(Accounts.id).limit(batch_size)]
+
+        if not account_ids:
+            return rebuilt
+
+        last_id = account_ids[-1]
+        lock_accounts(account_ids)
+
+        deleted = table.delete().where(table.c.account_id.in_(account_ids))
+
+        if since is not None:
+            deleted = deleted.where(table.c.period_start >= since)
+
+        db.session.execute(deleted)
+
+        for granularity in GRANULARITIES:
+            start = period_start_sql(Ledger.created_at, granularity)
+            aggregate = db.session.query(
+                Ledger.account_id, literal(granularity), start, Ledger.transaction_type,
+                Ledger.details, func.count(Ledger.id), func.sum(Ledger.amount)) \
+                .filter(Ledger.account_id.in_(account_ids)) \
+                .group_by(Ledger.account_id, start, Ledger.transaction_type, Ledger.details)
+
+            if since is not None:
+                # Entries older than every partition are in the default partition
+                # and their periods' rollups were kept
+                aggregate = aggregate.filter(Ledger.created_at >= since)
+
+            db.session.execute(table.insert().from_select(
+                ["account_id", "granularity", "period_start", "transaction_type", "details", "count", "total"],
+                aggregate))
+
+        db.session.commit()
+        rebuilt += len(account_ids)
+
+
+def activity(account_id, granularity, since=None, until=None):
+    """
+    Returns the rollups of an account at the given granularity whose periods
+    start in [since, until), ordered by period.
+    """
+    query = ActivityRollups.query.filter(ActivityRollups.account_id == account_id,
+                                         ActivityRollups.granularity == granularity)
+
+    if since is not None:
+        query = query.filter(ActivityRollups.period_start >= period_start(since, granularity))
+
+    if until is not None:
+        query = query.filter(ActivityRollups.period_start < until)
+
+    return query.order_by(ActivityRollups.period_start, ActivityRollups.transaction_type,
+                          ActivityRollups.details).all()
@@ -0,0 +1,250 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the customer sharding layer. Customers, with their accounts,
+         ledger and everything else keyed by them, live on one of the
+         databases named in SHARDS. A customer's home shard comes from their
+         id, since each shard hands out ids in its own residue class modulo
+         SHARD_ID_STRIDE, and CustomerShards records the customers that were
+         moved somewhere else. The session sends queries for sharded tables to
+         the shard that is current for the request, everything else goes to
+         the default database.
+"""
+
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import g, has_app_context, jsonify, request
+from flask_api import status
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+
+# Tables whose rows belong to a customer and live on the customer's shard
+SHARDED_TABLES = frozenset(("Customers", "Accounts", "Ledger", "BalanceCheckpoints", "ActivityRollups",
+                            "TransferRequests"))
+
+# Request methods that can run while a customer is being moved
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class ShardError(Exception):
+    pass
+
+
+class CustomerMoving(Exception):
+    pass
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that binds sharded tables, and statements without a model, to the
+    current shard. Reads of a request with replica binds go to the replica of
+    the primary they would have used, other requests record the primaries
+    they used in g.primaries.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not has_app_context():
+            return SignallingSession.get_bind(self, mapper, clause)
+
+        shard = g.get("shard")
+        primary = None
+
+        if shard is not None and (mapper is None or mapper.persist_selectable.name in SHARDED_TABLES):
+            primary = shard
+
+        replica_binds = g.get("replica_binds")
+
+        if replica_binds is None:
+            g.setdefault("primaries", set()).add(primary)
+            bind = primary
+        else:
+            bind = replica_binds.get(primary, primary)
+
+        if bind is None:
+            return SignallingSession.get_bind(self, mapper, clause)
+
+        return self.db.get_engine(self.app, bind=bind)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy with the routing session. Every engine it creates, for the
+    default database, a shard or a replica, is passed to each function in
+    engine_hooks.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.engine_hooks = []
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = SQLAlchemy.create_engine(self, sa_url, engine_opts)
+
+        for hook in self.engine_hooks:
+            hook(engine)
+
+        return engine
+
+
+class Shards(object):
+    """
+    Routes customers to shards. Without SHARDS everything is on the default
+    database and names() is just [None].
+
+    SHARDS lists SQLALCHEMY_BINDS keys, where None is the default database.
+    Customers with ids up to SHARD_LEGACY_MAX_ID were created before sharding
+    and live on the first shard.
+    """
+
+    def __init__(self, app=None, db=None):
+        self.lock = threading.Lock()
+        self.overrides = {}
+        self.loaded_at = None
+
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+
+        if app.config['SHARDS']:
+            app.before_request(self.route_request)
+
+    @property
+    def enabled(self):
+        return bool(self.app.config['SHARDS'])
+
+    def names(self):
+        return list(self.app.config['SHARDS']) or [None]
+
+    def home(self, customer_id):
+        """
+        Returns the shard that handed out the customer's id.
+        """
+        shards = self.app.config['SHARDS']
+
+        if not shards or customer_id <= self.app.config['SHARD_LEGACY_MAX_ID']:
+            return shards[0] if shards else None
+
+        index = customer_id % self.app.config['SHARD_ID_STRIDE']
+
+        if index >= len(shards):
+            raise ShardError("Customer id {} is from shard {} which isn't in SHARDS".format(customer_id, index))
+
+        return shards[index]
+
+    def directory(self):
+        """
+        Returns {customer_id: (shard, moving)} for every moved customer. It's
+        read from the default database at most every SHARD_DIRECTORY_TTL
+        seconds.
+        """
+        from models import CustomerShards
+
+        with self.lock:
+            if self.loaded_at is None or time.time() - self.loaded_at > self.app.config['SHARD_DIRECTORY_TTL']:
+                table = CustomerShards.__table__
+
+                with self.db.engine.connect() as connection:
+                    rows = connection.execute(table.select())
+                    self.overrides = dict((row.customer_id, (row.shard, row.moving)) for row in rows)
+
+                self.loaded_at = time.time()
+
+            return self.overrides
+
+    def expire(self):
+        with self.lock:
+            self.loaded_at = None
+
+    def shard_for(self, customer_id, writing=False):
+        """
+        Returns the shard a customer lives on. With writing raises
+        CustomerMoving while the customer is being moved.
+        """
+        if not self.enabled:
+            return None
+
+        shard, moving = self.directory().get(customer_id, (self.home(customer_id), False))
+
+        if moving and writing:
+            raise CustomerMoving("Customer with id {} is being moved to another shard".format(customer_id))
+
+        return shard
+
+    def place(self):
+        """
+        Picks the shard for a new customer.
+        """
+        return random.choice(self.names())
+
+    def group(self, items, customer_id):
+        """
+        Splits items to be written by the shard of customer_id(item). Returns
+        an OrderedDict of shard to items, in the order of SHARDS, and a list of
+        (item, error) for the items whose customer is being moved or has an id
+        no shard handed out.
+        """
+        groups = OrderedDict((shard, []) for shard in self.names())
+        rejected = []
+
+        for item in items:
+            try:
+                groups[self.shard_for(customer_id(item), writing=True)].append(item)
+            except (CustomerMoving, ShardError) as e:
+                rejected.append((item, str(e)))
+
+        return OrderedDict((shard, grouped) for shard, grouped in groups.items() if grouped), rejected
+
+    @contextmanager
+    def use(self, shard):
+        """
+        Makes shard the current shard of the session until the block ends.
+        """
+        previous = g.get("shard")
+        g.shard = shard
+
+        try:
+            yield
+
+        finally:
+            g.shard = previous
+
+    def route_request(self):
+        """
+        Makes the shard of the customer in the url the current one. Requests
+        that write to a customer being moved get a 503 to retry.
+        """
+        customer_id = (request.view_args or {}).get("customer_id")
+
+        try:
+            customer_id = int(customer_id)
+        except (TypeError, ValueError):
+            return None
+
+        try:
+            g.shard = self.shard_for(customer_id, request.method not in READ_METHODS)
+
+        except CustomerMoving as e:
+            response = jsonify({"error": str(e)})
+            response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+            response.headers["Retry-After"] = str(self.app.config['SHARD_DIRECTORY_TTL'])
+            return response
+
+        except ShardError:
+            return None
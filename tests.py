@@ -4,14 +4,31 @@ License: GPL
 Version: 0.0.1
 Maintainer: Tyler Puleo
 Status: Production
-Summary: This is a small testing file that I used to test the post requests
-         for my api. I tested the PUT requests with Postman and the GET requests
-         with the browser.
+Summary: These are the tests for the api. They run against TestingConfig's
+         TEST_DATABASE_URI, SQLite in the temp directory by default, and drop
+         every table in it. The PostgreSQL only tests run when it points at
+         PostgreSQL, e.g.
+
+             python -m pytest tests.py
+             TEST_DATABASE_URI=postgresql:///acorns_test python -m pytest tests.py
+
+         post_examples() is the small script I used to try the post requests
+         against a running server. I tested the PUT requests with Postman and
+         the GET requests with the browser.
 """
 
-import requests
-import datetime
+import io
 import json
+import os
+import tempfile
+import threading
+import unittest
+
+from sqlalchemy import LargeBinary, select, type_coerce
+
+from app import create_app
+from config import TestingConfig
+from extensions import db, shards
 
 customer = {
     "first_name": "Tyler",
@@ -38,10 +55,1116 @@ transfer = {
     "amount": 9.99
 }
 
-response = requests.post('http://127.0.0.1:5000/customers', data=customer, verify=False)
-response = requests.post('http://127.0.0.1:5000/customers/1/accounts', data=account, verify=False)
-response = requests.post('http://127.0.0.1:5000/customers/1/transfer', data=transfer, verify=False)
+on_postgresql = unittest.skipUnless(TestingConfig.SQLALCHEMY_DATABASE_URI.startswith("postgresql"),
+                                    "needs TEST_DATABASE_URI to be a PostgreSQL database")
+
+
+class ApiTestCase(unittest.TestCase):
+    """
+    Creates the app with config and fresh tables for every test.
+    """
+
+    config = TestingConfig
+
+    def setUp(self):
+        self.app = create_app(self.config)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def create_customer(self, **values):
+        data = dict(customer, **values)
+        response = self.client.post('/customers', data=data)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.get_json()
+
+    def create_account(self, customer_id, **values):
+        data = dict(account, **values)
+        response = self.client.post('/customers/{}/accounts'.format(customer_id), data=data)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.get_json()
+
+
+class ConfigTestCase(unittest.TestCase):
+    def setUp(self):
+        self.environ = os.environ.pop("ACORNS_CONFIG", None)
+
+    def tearDown(self):
+        os.environ.pop("ACORNS_CONFIG", None)
+
+        if self.environ is not None:
+            os.environ["ACORNS_CONFIG"] = self.environ
+
+    def test_configs_are_chosen_by_name(self):
+        from config import DevelopmentConfig, ProductionConfig, get_config
+
+        self.assertIs(get_config("testing"), TestingConfig)
+        self.assertIs(get_config(), ProductionConfig)
+
+        os.environ["ACORNS_CONFIG"] = "development"
+        self.assertIs(get_config(), DevelopmentConfig)
+        self.assertIs(get_config("testing"), TestingConfig)
+
+    def test_create_app_takes_a_name_or_a_class(self):
+        self.assertTrue(create_app("testing").config['TESTING'])
+        self.assertTrue(create_app(TestingConfig).config['TESTING'])
+
+        os.environ["ACORNS_CONFIG"] = "testing"
+        app = create_app()
+        self.assertEqual(app.config['SQLALCHEMY_DATABASE_URI'], TestingConfig.SQLALCHEMY_DATABASE_URI)
+        self.assertEqual(app.config['ADMIN_TOKEN'], TestingConfig.ADMIN_TOKEN)
+
+    def test_unknown_configs_are_rejected(self):
+        from config import get_config
+
+        self.assertRaises(ValueError, get_config, "prod")
+        self.assertRaises(ValueError, create_app, "prod")
+
+        os.environ["ACORNS_CONFIG"] = "prod"
+        self.assertRaises(ValueError, create_app)
+
+
+class ImportTestCase(ApiTestCase):
+    def test_imports_need_the_admin_token(self):
+        from models import Customers
+
+        body = json.dumps(customer) + "\n"
+        path = '/imports/customers?job_id=auth'
+
+        self.assertEqual(self.client.post(path, data=body).status_code, 401)
+        self.assertEqual(self.client.post(path, data=body, headers={"Authorization": "Bearer wrong"}).status_code, 401)
+        self.assertEqual(Customers.query.count(), 0)
+
+        admin = {"Authorization": "Bearer {}".format(self.app.config['ADMIN_TOKEN'])}
+        response = self.client.post(path, data=body, headers=admin)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.get_json()["rows_imported"], 1)
+
+        self.app.config['ADMIN_TOKEN'] = None
+        self.assertEqual(self.client.post(path, data=body, headers=admin).status_code, 403)
+
+    @on_postgresql
+    def test_copied_customers_read_back(self):
+        from imports import run_import
+        from models import Customers
+
+        rows = [dict(customer, email="customer{}@example.com".format(i)) for i in range(3)]
+        body = "".join(json.dumps(row) + "\n" for row in rows).encode("utf-8")
+
+        summary = run_import("customers", "customers", io.BytesIO(body), "ndjson", 2)
+        self.assertEqual(summary["rows_imported"], 3)
+        db.session.remove()
+
+        imported = Customers.query.order_by(Customers.id).all()
+        self.assertEqual([c.email for c in imported], [row["email"] for row in rows])
+        self.assertEqual(imported[0].ssn, customer["ssn"])
+        self.assertEqual(imported[0].first_name, customer["first_name"])
+
+
+class CacheTestCase(ApiTestCase):
+    def setUp(self):
+        super(CacheTestCase, self).setUp()
+        self.customer_id = self.create_customer()["id"]
+        self.account_id = self.create_account(self.customer_id)["id"]
+        self.path = '/customers/{}/accounts/{}'.format(self.customer_id, self.account_id)
+
+    def test_reads_are_cached_until_a_write(self):
+        from extensions import cache
+
+        cache.reset_stats()
+        self.assertEqual(self.client.get(self.path).get_json()["routing_number"], account["routing_number"])
+        self.assertEqual(self.client.get(self.path).get_json()["routing_number"], account["routing_number"])
+        self.assertEqual((cache.stats()["local_misses"], cache.stats()["local_hits"]), (1, 1))
+
+        response = self.client.put(self.path, data={"routing_number": "111111111"})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(self.client.get(self.path).get_json()["routing_number"], "111111111")
+        self.assertEqual(cache.stats()["local_misses"], 2)
+
+    def test_writes_invalidate_every_variant(self):
+        from extensions import cache
+
+        self.client.get(self.path + '?fields=balance')
+        self.client.get('/customers/{}/accounts'.format(self.customer_id))
+        other_id = self.create_account(self.customer_id, account_number="22222222222")["id"]
+
+        # Creating an account replaced the list's generation
+        self.assertEqual(len(self.client.get('/customers/{}/accounts'.format(self.customer_id)).get_json()), 2)
+
+        self.client.post('/customers/{}/transfer'.format(self.customer_id), data={
+            "from_account_id": self.account_id, "to_account_id": other_id, "amount": 50})
+
+        cache.reset_stats()
+        self.assertEqual(self.client.get(self.path + '?fields=balance').get_json()["balance"], 100.0)
+        self.assertEqual(cache.stats()["local_hits"], 0)
+
+    def test_shared_cache_keeps_pii_in_process(self):
+        from extensions import cache
+
+        self.app.config['CACHE_SHARED_URL'] = "fake://"
+        cache.init_app(self.app)
+        response = self.client.get('/customers/{}?fields=id,ssn'.format(self.customer_id))
+        self.assertEqual(response.get_json()["ssn"], customer["ssn"])
+        self.assertEqual(self.client.get(self.path).status_code, 200)
+
+        stored = dict((key, value) for key, (_, value) in cache.shared.client.backend.entries.items())
+        self.assertTrue([key for key in stored if key.startswith("account:")])
+        self.assertFalse([key for key, value in stored.items() if customer["ssn"].encode("utf-8") in value])
+
+
+class ConditionalGetTestCase(ApiTestCase):
+    def setUp(self):
+        super(ConditionalGetTestCase, self).setUp()
+        self.customer_id = self.create_customer()["id"]
+        self.from_id = self.create_account(self.customer_id, account_number="11111111111")["id"]
+        self.to_id = self.create_account(self.customer_id, account_number="22222222222")["id"]
+
+    def assertNotModifiedUntil(self, path, write):
+        response = self.client.get(path)
+        etag = response.headers["ETag"]
+        self.assertEqual(response.status_code, 200)
+
+        cached = self.client.get(path, headers={"If-None-Match": etag})
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.get_data(), b"")
+
+        write()
+
+        changed = self.client.get(path, headers={"If-None-Match": etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers["ETag"], etag)
+
+    def test_customers(self):
+        path = '/customers/{}'.format(self.customer_id)
+        self.assertNotModifiedUntil(path, lambda: self.client.put(path, data={"first_name": "Other"}))
+
+        # Fields change the body, so they change the ETag
+        self.assertNotEqual(self.client.get(path).headers["ETag"],
+                            self.client.get(path + '?fields=id,email').headers["ETag"])
+
+    def test_accounts(self):
+        path = '/customers/{}/accounts/{}'.format(self.customer_id, self.from_id)
+        self.assertNotModifiedUntil(path, lambda: self.client.put(path, data={"routing_number": "111111111"}))
+
+    def test_ledgers(self):
+        def transfer():
+            self.client.post('/customers/{}/transfer'.format(self.customer_id), data={
+                "from_account_id": self.from_id, "to_account_id": self.to_id, "amount": 10})
+
+        self.assertNotModifiedUntil('/customers/{}/accounts/{}/ledger'.format(self.customer_id, self.from_id),
+                                    transfer)
+
+
+class CustomerListTestCase(ApiTestCase):
+    def setUp(self):
+        super(CustomerListTestCase, self).setUp()
+        self.ids = [self.create_customer(email="customer{}@example.com".format(i))["id"] for i in range(5)]
+
+    def test_pages_follow_the_cursor(self):
+        first = self.client.get('/customers?limit=2')
+        self.assertEqual([row["id"] for row in first.get_json()], self.ids[:2])
+        self.assertEqual(first.headers["X-Next-After-Id"], str(self.ids[1]))
+
+        second = self.client.get('/customers?limit=2&after_id={}'.format(self.ids[1]))
+        self.assertEqual([row["id"] for row in second.get_json()], self.ids[2:4])
+
+        last = self.client.get('/customers?limit=2&after_id={}'.format(self.ids[3]))
+        self.assertEqual([row["id"] for row in last.get_json()], self.ids[4:])
+        self.assertNotIn("X-Next-After-Id", last.headers)
+
+    def test_stream_returns_every_customer(self):
+        response = self.client.get('/customers?stream=true')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row["id"] for row in json.loads(response.get_data())], self.ids)
+
+    def test_encrypted_fields_are_looked_up_by_blind_index(self):
+        from models import Customers
+
+        response = self.client.get('/customers?email=%20Customer3@Example.com')
+        self.assertEqual([row["id"] for row in response.get_json()], [self.ids[3]])
+
+        self.create_customer(email="other@example.com", phone_number="(555) 123-4567")
+        response = self.client.get('/customers?phone_number=555.123.4567')
+        self.assertEqual([row["email"] for row in response.get_json()], ["other@example.com"])
+
+        self.assertEqual(self.client.get('/customers?email=nobody@example.com').get_json(), [])
+
+        # Only the HMAC is stored next to the ciphertext
+        stored = db.session.query(Customers.email_bidx).filter(Customers.id == self.ids[3]).scalar()
+        self.assertNotIn("customer3", stored)
+
+    def test_bad_cursors_are_rejected(self):
+        self.assertEqual(self.client.get('/customers?after_id=-1').status_code, 400)
+        self.assertEqual(self.client.get('/customers?limit=0').status_code, 400)
+        self.assertEqual(self.client.get('/customers?limit=many').status_code, 400)
+
+
+class LedgerTestCase(ApiTestCase):
+    def setUp(self):
+        from datetime import datetime
+        from models import Ledger
+
+        super(LedgerTestCase, self).setUp()
+        self.customer_id = self.create_customer()["id"]
+        self.account_id = self.create_account(self.customer_id)["id"]
+
+        # Inserted out of created_at order, and the first and third share one
+        db.session.execute(Ledger.__table__.insert(), [
+            {"account_id": self.account_id, "transaction_type": "credit", "amount": day,
+             "details": "cash_deposit", "created_at": datetime(2020, 1, day)}
+            for day in (2, 1, 2, 3)])
+        db.session.commit()
+
+        self.ids = [entry.id for entry in Ledger.query.order_by(Ledger.created_at, Ledger.id)]
+        self.path = '/customers/{}/accounts/{}/ledger'.format(self.customer_id, self.account_id)
+
+    def pages(self, **args):
+        pages = []
+        after_id = None
+
+        while True:
+            response = self.client.get(self.path, query_string=dict(args, after_id=after_id or 0))
+            self.assertEqual(response.status_code, 200, response.data)
+            pages.append([row["id"] for row in response.get_json()])
+            after_id = response.headers.get("X-Next-After-Id")
+
+            if after_id is None:
+                return pages
+
+    def test_pages_split_entries_created_at_the_same_time(self):
+        self.assertNotEqual(self.ids, sorted(self.ids))
+        self.assertEqual(self.pages(limit=2), [self.ids[:2], self.ids[2:], []])
+
+    def test_time_ranges_carry_over_to_the_next_page(self):
+        self.assertEqual(self.pages(limit=1, since="2020-01-02", until="2020-01-03"),
+                         [self.ids[1:2], self.ids[2:3], []])
+        self.assertEqual(self.pages(limit=2, since="2020-01-02"), [self.ids[1:3], self.ids[3:]])
+        self.assertEqual(self.pages(limit=2, until="2020-01-03"), [self.ids[:2], self.ids[2:3]])
+
+    def test_missing_accounts_are_not_found(self):
+        response = self.client.get('/customers/{}/accounts/{}/ledger'.format(self.customer_id, self.account_id + 1))
+        self.assertEqual(response.status_code, 404)
+
+
+class IncludeTestCase(ApiTestCase):
+    def setUp(self):
+        super(IncludeTestCase, self).setUp()
+        self.accounts = {}
+
+        for i in range(4):
+            customer_id = self.create_customer(email="customer{}@example.com".format(i))["id"]
+            self.accounts[customer_id] = [
+                self.create_account(customer_id, account_number="{}{}".format(i, k) * 5)["id"] for k in range(2)]
+
+    def statements(self, path):
+        from extensions import metrics
+
+        metrics.reset()
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200, response.data)
+
+        for line in metrics.render().splitlines():
+            if line.startswith("http_request_sql_statements_sum"):
+                return response.get_json(), float(line.split()[-1])
+
+    def test_accounts_are_loaded_for_the_whole_page(self):
+        customers, statements = self.statements('/customers?include=accounts')
+        self.assertEqual(dict((row["id"], [a["id"] for a in row["accounts"]]) for row in customers), self.accounts)
+
+        _, fewer = self.statements('/customers?include=accounts&limit=1')
+        self.assertEqual(statements, fewer)
+
+    def test_recent_ledger_is_embedded(self):
+        customer_id, (from_id, to_id) = sorted(self.accounts.items())[0]
+        self.client.post('/customers/{}/transfer'.format(customer_id),
+                         data={"from_account_id": from_id, "to_account_id": to_id, "amount": 10})
+
+        customer_row, _ = self.statements('/customers/{}?include=accounts.recent_ledger'.format(customer_id))
+        ledgers = dict((a["id"], [entry["transaction_type"] for entry in a["recent_ledger"]])
+                       for a in customer_row["accounts"])
+        self.assertEqual(ledgers, {from_id: ["debit"], to_id: ["credit"]})
+
+    def test_recent_ledger_keeps_only_the_newest_entries(self):
+        from datetime import datetime, timedelta
+        from models import Ledger
+
+        customer_id, (from_id, to_id) = sorted(self.accounts.items())[0]
+        start = datetime(2020, 1, 1)
+
+        # Two entries share every created_at so the id breaks the tie
+        db.session.execute(Ledger.__table__.insert(), [
+            {"account_id": account_id, "transaction_type": "credit", "amount": i, "details": "cash_deposit",
+             "created_at": start + timedelta(days=i)}
+            for i in range(8) for account_id in (from_id, from_id, to_id)])
+        db.session.commit()
+
+        expected = {}
+        for account_id in (from_id, to_id):
+            newest = Ledger.query.filter_by(account_id=account_id) \
+                .order_by(Ledger.created_at.desc(), Ledger.id.desc()).limit(self.app.config['RECENT_LEDGER_SIZE'])
+            expected[account_id] = [entry.id for entry in newest]
+
+        customer_row, _ = self.statements('/customers/{}?include=accounts.recent_ledger'.format(customer_id))
+        self.assertEqual(dict((a["id"], [entry["id"] for entry in a["recent_ledger"]])
+                              for a in customer_row["accounts"]), expected)
+
+    def test_unknown_includes_are_rejected(self):
+        self.assertEqual(self.client.get('/customers?include=ledgers').status_code, 400)
+        self.assertEqual(self.client.get('/customers?include=accounts&stream=1').status_code, 400)
+
+
+class TransferTestCase(ApiTestCase):
+    def setUp(self):
+        super(TransferTestCase, self).setUp()
+        self.customer_id = self.create_customer()["id"]
+        self.from_account = self.create_account(self.customer_id, account_number="11111111111")
+        self.to_account = self.create_account(self.customer_id, account_number="22222222222")
+
+    def transfer(self, amount, **values):
+        data = dict(from_account_id=self.from_account["id"], to_account_id=self.to_account["id"], amount=amount,
+                    **values)
+        return self.client.post('/customers/{}/transfer'.format(self.customer_id), data=data)
+
+    def balances(self):
+        return [self.client.get('/customers/{}/accounts/{}'.format(self.customer_id, account["id"]))
+                .get_json()["balance"] for account in (self.from_account, self.to_account)]
+
+    def test_transfer_moves_money(self):
+        response = self.transfer(25)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(self.balances(), [125.0, 175.0])
+
+    def test_non_finite_amounts_are_rejected(self):
+        for amount in ("nan", "inf", "-inf", "0", "-5"):
+            response = self.transfer(amount)
+            self.assertEqual(response.status_code, 400, amount)
+
+        response = self.client.post('/transfers/batch', json=[
+            {"customer_id": self.customer_id, "from_account_id": self.from_account["id"],
+             "to_account_id": self.to_account["id"], "amount": "NaN"}])
+        self.assertEqual(response.get_json()[0]["status"], "error")
+
+        self.assertEqual(self.balances(), [150.0, 150.0])
+
+    def test_batches_apply_in_order_against_running_balances(self):
+        def item(from_account, to_account, amount):
+            return {"customer_id": self.customer_id, "from_account_id": from_account["id"],
+                    "to_account_id": to_account["id"], "amount": amount}
+
+        response = self.client.post('/transfers/batch?chunk_size=2', json=[
+            item(self.from_account, self.to_account, 100),
+            item(self.from_account, self.to_account, 100),
+            item(self.to_account, self.from_account, 50),
+            {"customer_id": self.customer_id, "amount": 5},
+        ])
+
+        self.assertEqual(response.status_code, 200, response.data)
+        results = response.get_json()
+        self.assertEqual([result["index"] for result in results], [0, 1, 2, 3])
+        self.assertEqual([result["status"] for result in results], ["ok", "error", "ok", "error"])
+        self.assertEqual(results[1]["error"], "Insufficient in from account")
+        self.assertEqual(self.balances(), [100.0, 200.0])
+
+    def test_batches_must_be_arrays(self):
+        self.assertEqual(self.client.post('/transfers/batch', json={"amount": 5}).status_code, 400)
+        self.assertEqual(self.client.post('/transfers/batch?chunk_size=0', json=[]).status_code, 400)
+
+    def test_queued_transfers_are_checked_up_front(self):
+        from models import TransferRequests
+
+        for amount in ("nan", "inf", "0"):
+            response = self.transfer(amount, **{"async": "1"})
+            self.assertEqual(response.status_code, 400, amount)
+
+        self.assertEqual(TransferRequests.query.count(), 0)
+
+        response = self.transfer(25, **{"async": "1"})
+        self.assertEqual(response.status_code, 202, response.data)
+        self.assertEqual(self.client.get(response.headers["Location"]).get_json()["status"], "queued")
+
+        transfer_id = response.get_json()["transfer_id"]
+        self.assertEqual(self.client.get('/transfers/{}'.format(transfer_id)).get_json()["status"], "queued")
+        self.assertEqual(self.client.get('/customers/{}/transfers/{}'.format(self.customer_id + 1, transfer_id))
+                         .status_code, 404)
+
+
+class GroupCommitTestCase(TransferTestCase):
+    def setUp(self):
+        import group_commit
+
+        super(GroupCommitTestCase, self).setUp()
+        self.app.config['TRANSFER_GROUP_COMMIT'] = True
+        self.app.config['TRANSFER_GROUP_COMMIT_TIMEOUT'] = 0.2
+
+        # Each test gets its own committer thread, running on its own app
+        self.committer = group_commit.committer
+        group_commit.committer = group_commit.GroupCommitter()
+
+    def tearDown(self):
+        import group_commit
+
+        group_commit.committer = self.committer
+        super(GroupCommitTestCase, self).tearDown()
+
+    def test_transfers_the_committer_misses_are_committed_directly(self):
+        import group_commit
+
+        # A committer that is alive but never takes anything
+        stuck = threading.Event()
+        group_commit.committer.pid = os.getpid()
+        group_commit.committer.thread = threading.Thread(target=stuck.wait)
+        group_commit.committer.thread.start()
+
+        try:
+            response = self.transfer(25)
+
+        finally:
+            stuck.set()
+
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(group_commit.committer.pending, [])
+        self.assertEqual(self.balances(), [125.0, 175.0])
+
+    def test_dead_committers_are_replaced(self):
+        import group_commit
+
+        dead = threading.Thread(target=lambda: None)
+        dead.start()
+        dead.join()
+        group_commit.committer.pid = os.getpid()
+        group_commit.committer.thread = dead
+
+        self.assertEqual(self.transfer(25).status_code, 200)
+        self.assertIsNot(group_commit.committer.thread, dead)
+        self.assertEqual(self.balances(), [125.0, 175.0])
+
+
+class BalanceTestCase(ApiTestCase):
+    def setUp(self):
+        from datetime import datetime
+        from models import Accounts, Ledger
+
+        super(BalanceTestCase, self).setUp()
+        self.customer_id = self.create_customer()["id"]
+        self.account_id = self.create_account(self.customer_id, account_number="11111111111")["id"]
+        self.quiet_id = self.create_account(self.customer_id, account_number="22222222222")["id"]
+
+        # 100.00 until Jan 1 2020, then +50, -20 and +5
+        db.session.execute(Ledger.__table__.insert(), [
+            {"account_id": self.account_id, "transaction_type": transaction_type, "amount": amount,
+             "details": "cash_deposit", "created_at": datetime(2020, 1, day)}
+            for day, transaction_type, amount in ((1, "credit", 50.0), (3, "debit", 20.0), (5, "credit", 5.0))])
+        db.session.execute(Accounts.__table__.update().where(Accounts.id == self.account_id).values(balance=135.0))
+        db.session.commit()
+
+    def balance(self, at, account_id=None):
+        response = self.client.get('/customers/{}/accounts/{}/balance'.format(
+            self.customer_id, account_id or self.account_id), query_string={"at": at})
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.get_json()
+
+    def checkpoints(self):
+        from models import BalanceCheckpoints
+
+        return [(c.account_id, c.as_of.day, c.balance)
+                for c in BalanceCheckpoints.query.order_by(BalanceCheckpoints.as_of, BalanceCheckpoints.account_id)]
+
+    def test_checkpoints_roll_forward_from_the_last_one(self):
+        from datetime import datetime
+        from balances import create_checkpoints
+
+        self.assertEqual(create_checkpoints(datetime(2020, 1, 2), 1), 2)
+        self.assertEqual(create_checkpoints(datetime(2020, 1, 4), 1), 2)
+
+        # Accounts with a checkpoint at or after as_of are skipped
+        self.assertEqual(create_checkpoints(datetime(2020, 1, 2), 1), 0)
+
+        self.assertEqual(self.checkpoints(), [
+            (self.account_id, 2, 150.0), (self.quiet_id, 2, 150.0),
+            (self.account_id, 4, 130.0), (self.quiet_id, 4, 150.0)])
+
+    def test_balance_at(self):
+        from datetime import datetime
+        from balances import create_checkpoints
+        from werkzeug.http import http_date
+
+        # Without checkpoints the current balance is rolled back
+        self.assertEqual(self.balance("2020-01-02")["balance"], 150.0)
+        self.assertIsNone(self.balance("2020-01-02")["checkpoint_at"])
+
+        create_checkpoints(datetime(2020, 1, 2), 10)
+        create_checkpoints(datetime(2020, 1, 4), 10)
+
+        for at, balance, checkpoint_day in (("2019-12-31", 100.0, 2), ("2020-01-02", 150.0, 2),
+                                            ("2020-01-03T12:00:00", 130.0, 2), ("2020-01-04", 130.0, 4),
+                                            ("2020-01-06", 135.0, 4)):
+            row = self.balance(at)
+            self.assertEqual((row["balance"], row["checkpoint_at"]),
+                             (balance, http_date(datetime(2020, 1, checkpoint_day))), at)
+
+        self.assertEqual(self.balance("2019-12-31", self.quiet_id)["balance"], 150.0)
+
+    def test_bad_times_are_rejected(self):
+        response = self.client.get('/customers/{}/accounts/{}/balance?at=yesterday'.format(
+            self.customer_id, self.account_id))
+        self.assertEqual(response.status_code, 400)
+
+
+class RollupTestCase(ApiTestCase):
+    def setUp(self):
+        super(RollupTestCase, self).setUp()
+        self.customer_id = self.create_customer()["id"]
+        self.from_id = self.create_account(self.customer_id, account_number="11111111111")["id"]
+        self.to_id = self.create_account(self.customer_id, account_number="22222222222")["id"]
+
+    def activity(self, account_id, **args):
+        response = self.client.get('/customers/{}/accounts/{}/activity'.format(self.customer_id, account_id),
+                                   query_string=args)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.get_json()
+
+    def test_buckets_match_the_ledger(self):
+        from collections import defaultdict
+        from models import Ledger
+
+        path = '/customers/{}/transfer'.format(self.customer_id)
+        for amount in (10, 2.5, 7):
+            self.client.post(path, data={"from_account_id": self.from_id, "to_account_id": self.to_id,
+                                         "amount": amount})
+        self.client.post(path, data={"from_account_id": self.to_id, "to_account_id": self.from_id, "amount": 4})
+
+        for account_id in (self.from_id, self.to_id):
+            for granularity, period in (("day", lambda moment: moment.date()),
+                                        ("month", lambda moment: moment.date().replace(day=1))):
+                expected = defaultdict(lambda: [0, 0.0])
+
+                for entry in Ledger.query.filter_by(account_id=account_id):
+                    key = (period(entry.created_at).isoformat(), entry.transaction_type.value, entry.details.value)
+                    expected[key][0] += 1
+                    expected[key][1] += entry.amount
+
+                buckets = dict(((row["period_start"], row["transaction_type"], row["details"]),
+                                [row["count"], row["total"]])
+                               for row in self.activity(account_id, granularity=granularity))
+                self.assertEqual(buckets, dict(expected), granularity)
+
+        self.assertEqual(sorted(row["total"] for row in self.activity(self.to_id, granularity="month")), [4, 19.5])
+
+    def test_bad_granularities_are_rejected(self):
+        response = self.client.get('/customers/{}/accounts/{}/activity?granularity=week'.format(
+            self.customer_id, self.from_id))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.activity(self.from_id), [])
+
+    def partition_ledger(self):
+        # What the migrations do to Ledger on PostgreSQL
+        for statement in (
+                'ALTER TABLE "Ledger" RENAME TO "Ledger_unpartitioned"',
+                'ALTER SEQUENCE "Ledger_id_seq" OWNED BY NONE',
+                'CREATE TABLE "Ledger" (LIKE "Ledger_unpartitioned" INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)',
+                'ALTER TABLE "Ledger" ADD PRIMARY KEY (id, created_at)',
+                'ALTER SEQUENCE "Ledger_id_seq" OWNED BY "Ledger".id',
+                'DROP TABLE "Ledger_unpartitioned"',
+                'CREATE TABLE "Ledger_y2020m01" PARTITION OF "Ledger" FOR VALUES FROM (\'2020-01-01\') TO (\'2020-02-01\')',
+                'CREATE TABLE "Ledger_default" PARTITION OF "Ledger" DEFAULT'):
+            db.session.execute(statement)
+        db.session.commit()
+
+    @on_postgresql
+    def test_rebuild_keeps_archived_months(self):
+        from datetime import datetime
+        from partitions import archive_partitions, create_partitions
+        from rollups import rebuild_rollups, record_activity
+        from models import Ledger
+
+        self.partition_ledger()
+        create_partitions(1)
+
+        archived = [{"account_id": self.to_id, "transaction_type": "credit", "amount": 40.0,
+                     "details": "cash_deposit", "created_at": datetime(2020, 1, 15)}]
+        db.session.execute(Ledger.__table__.insert().values(archived))
+        record_activity(archived)
+        db.session.commit()
+
+        self.client.post('/customers/{}/transfer'.format(self.customer_id),
+                         data={"from_account_id": self.from_id, "to_account_id": self.to_id, "amount": 10})
+        before = self.activity(self.to_id, granularity="month")
+
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertEqual(len(archive_partitions(1, directory)), 1)
+        finally:
+            import shutil
+            shutil.rmtree(directory)
+
+        rebuild_rollups(10)
+        db.session.remove()
+
+        self.assertEqual(self.activity(self.to_id, granularity="month"), before)
+        self.assertEqual(before[0]["period_start"], "2020-01-01")
+
+
+class LedgerExportTestCase(ApiTestCase):
+    def setUp(self):
+        super(LedgerExportTestCase, self).setUp()
+        self.app.config['LEDGER_EXPORT_DIR'] = tempfile.mkdtemp()
+        self.app.config['LEDGER_EXPORT_LAG'] = -60
+        self.admin = {"Authorization": "Bearer {}".format(self.app.config['ADMIN_TOKEN'])}
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.app.config['LEDGER_EXPORT_DIR'])
+        super(LedgerExportTestCase, self).tearDown()
+
+    def test_exports_need_the_admin_token(self):
+        self.assertEqual(self.client.post('/admin/exports/ledger').status_code, 401)
+        self.assertEqual(self.client.get('/admin/exports/ledger', headers={"Authorization": "Bearer wrong"})
+                         .status_code, 401)
+
+        self.app.config['ADMIN_TOKEN'] = None
+        self.assertEqual(self.client.post('/admin/exports/ledger', headers=self.admin).status_code, 403)
+
+    def test_exports_run_in_the_background(self):
+        import time
+
+        customer_id = self.create_customer()["id"]
+        from_account = self.create_account(customer_id, account_number="11111111111")
+        to_account = self.create_account(customer_id, account_number="22222222222")
+        self.client.post('/customers/{}/transfer'.format(customer_id), data={
+            "from_account_id": from_account["id"], "to_account_id": to_account["id"], "amount": 25})
+
+        response = self.client.post('/admin/exports/ledger?format=csv', headers=self.admin)
+        self.assertEqual(response.status_code, 202, response.data)
+
+        deadline = time.time() + 10
+        while True:
+            export = self.client.get(response.headers["Location"], headers=self.admin).get_json()
+
+            if not export["running"] and export["files"] or time.time() > deadline:
+                break
+
+            time.sleep(0.05)
+
+        self.assertEqual(export["files"], 1)
+        self.assertEqual(export["last_file"]["rows"], 2)
+        self.assertEqual(export["high_water_mark"], export["last_file"]["last_id"])
+
+
+class IdempotencyTestCase(ApiTestCase):
+    def post_customer(self, key, **values):
+        return self.client.post('/customers', data=dict(customer, **values), headers={"Idempotency-Key": key})
+
+    def test_retries_replay_the_first_response(self):
+        from models import Customers
+
+        first = self.post_customer("key-1")
+        retry = self.post_customer("key-1")
+
+        self.assertEqual(first.status_code, 200, first.data)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.headers.get("Idempotent-Replayed"), "true")
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(Customers.query.count(), 1)
+
+    def test_keys_are_not_reused_for_other_requests(self):
+        self.assertEqual(self.post_customer("key-1").status_code, 200)
+        self.assertEqual(self.post_customer("key-1", first_name="Other").status_code, 400)
+
+    def test_running_claims_are_waited_for_and_stale_ones_taken_over(self):
+        from datetime import datetime, timedelta
+        from idempotency import claim, fingerprint
+        from models import Customers, IdempotencyKeys
+
+        self.app.config['IDEMPOTENCY_WAIT_TIMEOUT'] = 0.1
+
+        # A request that is still running holds its key
+        with self.app.test_request_context('/customers', method='POST', data=customer):
+            self.assertIsNone(claim("key-1", fingerprint()))
+            db.session.remove()
+
+        self.assertEqual(self.post_customer("key-1").status_code, 409)
+
+        # Until its lease runs out, as it would if its process died
+        IdempotencyKeys.query.filter_by(key="key-1").update(
+            {"lease_expires_at": datetime.now() + timedelta(seconds=0.2)})
+        db.session.commit()
+        self.app.config['IDEMPOTENCY_WAIT_TIMEOUT'] = 5
+
+        response = self.post_customer("key-1")
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertNotIn("Idempotent-Replayed", response.headers)
+        self.assertEqual(self.post_customer("key-1").headers.get("Idempotent-Replayed"), "true")
+        self.assertEqual(Customers.query.count(), 1)
+
+
+class KeyRotationTestCase(ApiTestCase):
+    def setUp(self):
+        super(KeyRotationTestCase, self).setUp()
+        from sqlalchemy_utils import EncryptedType
+        from sqlalchemy_utils.types.encrypted.encrypted_type import AesEngine
+        from models import Customers
+
+        self.ids = [self.create_customer(email="customer{}@example.com".format(i))["id"] for i in range(5)]
+
+        # The first customer's name is from before key ids were stored
+        legacy = EncryptedType(db.String(), self.app.config['ENCRYPTION_KEYS']["1"], AesEngine, 'pkcs5')
+        table = Customers.__table__
+        db.session.execute(table.update().where(table.c.id == self.ids[0]).values(
+            first_name=type_coerce(legacy.process_bind_param(customer["first_name"], None), LargeBinary)))
+        db.session.commit()
+
+    def key_ids(self):
+        from extensions import keyring
+        from models import Customers
+
+        table = Customers.__table__
+        return set(keyring.key_id_of(value) for field in Customers.encrypted_fields
+                   for (value,) in db.session.execute(select([type_coerce(table.c[field], LargeBinary)])))
+
+    def use_key(self, key_id):
+        from extensions import keyring
+
+        self.app.config['ENCRYPTION_KEYS'] = dict(self.app.config['ENCRYPTION_KEYS'], **{"2": "0123456789abcdef"})
+        self.app.config['ENCRYPTION_KEY_ID'] = key_id
+        keyring.init_app(self.app)
+
+    def test_every_field_is_rewritten_with_the_current_key(self):
+        from key_rotation import rotate_keys
+
+        self.assertEqual(self.key_ids(), {"1"})
+        self.use_key("2")
+
+        summary, = rotate_keys(2, 2)
+        self.assertEqual(summary["rows_rotated"], 5)
+        self.assertIsNotNone(summary["completed_at"])
+        db.session.remove()
+
+        self.assertEqual(self.key_ids(), {"2"})
+        response = self.client.get('/customers/{}?fields=first_name,email,ssn'.format(self.ids[0])).get_json()
+        self.assertEqual((response["first_name"], response["email"], response["ssn"]),
+                         (customer["first_name"], "customer0@example.com", customer["ssn"]))
+        self.assertEqual([row["id"] for row in self.client.get('/customers?email=customer3@example.com')
+                          .get_json()], [self.ids[3]])
+
+    def test_rotations_resume_where_they_stopped(self):
+        from key_rotation import rotate_keys
+        from models import KeyRotations
+
+        self.use_key("2")
+
+        # A rotation that stopped after the first two customers
+        rotation = KeyRotations("2", "default", self.ids[-1])
+        rotation.last_id = self.ids[1]
+        db.session.add(rotation)
+        db.session.commit()
+
+        summary, = rotate_keys(2, 2)
+        self.assertEqual(summary["rows_rotated"], 3)
+        db.session.remove()
+        self.assertEqual(self.key_ids(), {"1", "2"})
+
+        # A finished rotation is only run again when asked to
+        self.assertEqual(rotate_keys(2, 2)[0]["rows_rotated"], 3)
+        self.assertEqual(rotate_keys(2, 2, restart=True)[0]["rows_rotated"], 2)
+        db.session.remove()
+        self.assertEqual(self.key_ids(), {"2"})
+
+
+class AsgiTestCase(ApiTestCase):
+    def setUp(self):
+        import asyncio
+        from async_app import create_asgi_app
+
+        super(AsgiTestCase, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.asgi = create_asgi_app("testing")
+
+        self.customer_id = self.create_customer()["id"]
+        self.create_customer(email="other@example.com")
+        self.from_id = self.create_account(self.customer_id, account_number="11111111111")["id"]
+        self.to_id = self.create_account(self.customer_id, account_number="22222222222")["id"]
+        self.client.post('/customers/{}/transfer'.format(self.customer_id), data={
+            "from_account_id": self.from_id, "to_account_id": self.to_id, "amount": 25})
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.asgi.database.disconnect())
+        self.loop.close()
+        self.asgi.threads.shutdown()
+        super(AsgiTestCase, self).tearDown()
+
+    def request(self, method, path, body=b"", headers=None):
+        path, _, query_string = path.partition("?")
+        headers = dict(headers or {}, **({"Content-Length": str(len(body))} if body else {}))
+        scope = {"type": "http", "method": method, "path": path, "query_string": query_string.encode("latin-1"),
+                 "http_version": "1.1",
+                 "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                             for name, value in headers.items()]}
+        messages = [{"type": "http.request", "body": body}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        self.loop.run_until_complete(self.asgi(scope, receive, send))
+        return (sent[0]["status"], dict((name.decode("latin-1").lower(), value.decode("latin-1"))
+                                        for name, value in sent[0]["headers"]), sent[1]["body"])
+
+    def assertSameResponse(self, path, headers=None):
+        status_code, asgi_headers, body = self.request("GET", path, headers=headers)
+        response = self.client.get(path, headers=headers)
+
+        self.assertEqual(status_code, response.status_code, path)
+        self.assertEqual(json.loads(body) if body else None, response.get_json(), path)
+
+        for name in ("etag", "x-next-after-id"):
+            self.assertEqual(asgi_headers.get(name), response.headers.get(name), path)
+
+        return asgi_headers
+
+    def test_native_routes_match_the_flask_app(self):
+        self.assertSameResponse('/customers?limit=1')
+        self.assertSameResponse('/customers?limit=1&after_id={}'.format(self.customer_id))
+        self.assertSameResponse('/customers?email=other@example.com')
+        self.assertSameResponse('/customers/{}/accounts'.format(self.customer_id))
+        self.assertSameResponse('/customers/{}/accounts?fields=id,balance'.format(self.customer_id))
+        self.assertSameResponse('/customers/0/accounts')
+        self.assertSameResponse('/customers?limit=0')
+
+    def test_ledger_etags_match_the_flask_app(self):
+        path = '/customers/{}/accounts/{}/ledger'.format(self.customer_id, self.from_id)
+        etag = self.assertSameResponse(path)["etag"]
+
+        self.assertEqual(self.request("GET", path, headers={"If-None-Match": etag})[0], 304)
+        self.assertSameResponse(path, {"If-None-Match": etag})
+        self.assertSameResponse(path + '?limit=1&since=2020-01-01')
+
+        self.assertSameResponse('/customers/{}/accounts/{}/ledger'.format(self.customer_id, self.to_id + 1))
+
+    def test_other_requests_fall_through_to_flask(self):
+        from urllib.parse import urlencode
+
+        status_code, _, body = self.request("POST", '/customers', urlencode(dict(customer, email="new@example.com"))
+                                            .encode("utf-8"), {"Content-Type": "application/x-www-form-urlencoded"})
+        self.assertEqual(status_code, 200, body)
+
+        created = json.loads(body)
+        self.assertEqual(created["email"], "new@example.com")
+        self.assertSameResponse('/customers/{}'.format(created["id"]))
+
+
+class ShardedConfig(TestingConfig):
+    # Shards are copied between as stored, so both are the same kind of database
+    SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(tempfile.gettempdir(), "acorns_test_s0.db")
+    SQLALCHEMY_BINDS = {"s1": "sqlite:///" + os.path.join(tempfile.gettempdir(), "acorns_test_s1.db")}
+    SHARDS = [None, "s1"]
+    SHARD_ID_STRIDE = 2
+    SHARD_DIRECTORY_TTL = 0.01
+
+
+class ShardedTestCase(ApiTestCase):
+    """
+    Two shards, the test database and a SQLite one, with customers 2 to 9 on
+    their home shards.
+    """
+
+    config = ShardedConfig
+
+    def setUp(self):
+        super(ShardedTestCase, self).setUp()
+        from models import Customers
+
+        for shard in shards.names():
+            db.Model.metadata.drop_all(db.get_engine(self.app, bind=shard))
+            db.Model.metadata.create_all(db.get_engine(self.app, bind=shard))
+
+        for customer_id in range(2, 10):
+            with shards.use(shards.home(customer_id)):
+                row = Customers(customer["first_name"], customer["last_name"], customer["phone_number"],
+                                "customer{}@example.com".format(customer_id), customer["ssn"], True)
+                row.id = customer_id
+                db.session.add(row)
+                db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        for shard in shards.names():
+            db.Model.metadata.drop_all(db.get_engine(self.app, bind=shard))
+        super(ShardedTestCase, self).tearDown()
+
+    def customer_pages(self, limit):
+        ids = []
+        response = self.client.get('/customers?limit={}'.format(limit))
+
+        while True:
+            self.assertEqual(response.status_code, 200, response.data)
+            ids.extend(row["id"] for row in response.get_json())
+
+            after_id = response.headers.get("X-Next-After-Id")
+            if after_id is None:
+                return ids
+
+            response = self.client.get('/customers?limit={}&after_id={}'.format(limit, after_id))
+
+    def test_customers_are_read_from_their_shard(self):
+        self.assertEqual(self.client.get('/customers/3').get_json()["email"], "customer3@example.com")
+        self.assertEqual(self.client.get('/customers/4').get_json()["email"], "customer4@example.com")
+        self.assertEqual(self.customer_pages(3), list(range(2, 10)))
+
+    def test_shard_statements_are_timed(self):
+        from extensions import metrics
+
+        # Customer 3's accounts are read with one statement on s1
+        metrics.reset()
+        self.client.get('/customers/3/accounts')
+
+        self.assertIn(id(db.get_engine(self.app, bind="s1")), metrics.instrumented)
+        self.assertIn('http_request_sql_statements_sum{endpoint="/customers/<string:customer_id>/accounts",'
+                      'method="GET"} 1.0', metrics.render().splitlines())
+
+    def test_queued_transfers_are_read_from_their_customers_shard(self):
+        locations = {}
+
+        # Without configured sequences both shards hand out transfer id 1
+        for customer_id, amount in ((2, 10), (3, 20)):
+            from_id = self.create_account(customer_id, account_number="{}1111111111".format(customer_id))["id"]
+            to_id = self.create_account(customer_id, account_number="{}2222222222".format(customer_id))["id"]
+            response = self.client.post('/customers/{}/transfer'.format(customer_id), data={
+                "from_account_id": from_id, "to_account_id": to_id, "amount": amount, "async": "1"})
+            self.assertEqual(response.status_code, 202, response.data)
+            locations[customer_id] = response.headers["Location"]
+
+        self.assertEqual(locations, {2: "http://localhost/customers/2/transfers/1",
+                                     3: "http://localhost/customers/3/transfers/1"})
+        self.assertEqual(self.client.get(locations[2]).get_json()["amount"], 10)
+        self.assertEqual(self.client.get(locations[3]).get_json()["amount"], 20)
+
+        self.assertEqual(self.client.get('/customers/4/transfers/1').status_code, 404)
+        self.assertEqual(self.client.get('/transfers/1').status_code, 400)
+
+    def test_keyed_posts_for_other_shards_are_replayed(self):
+        from models import Accounts, IdempotencyKeys
+
+        path = '/customers/3/accounts'
+        headers = {"Idempotency-Key": "key-1"}
+        first = self.client.post(path, data=account, headers=headers)
+        retry = self.client.post(path, data=account, headers=headers)
+
+        self.assertEqual(first.status_code, 200, first.data)
+        self.assertEqual(retry.headers.get("Idempotent-Replayed"), "true")
+        self.assertEqual(retry.get_json(), first.get_json())
+
+        # Keys live on the default database, the account on customer 3's shard
+        self.assertTrue(IdempotencyKeys.query.get("key-1").completed)
+        with shards.use("s1"):
+            self.assertEqual(Accounts.query.filter_by(customer_id=3).count(), 1)
+
+    def test_customers_are_read_from_where_they_moved(self):
+        from rebalance import move_customer
+
+        move_customer(3, None, 100)
+        self.assertEqual(shards.shard_for(3), None)
+        self.assertEqual(self.client.get('/customers/3').get_json()["email"], "customer3@example.com")
+        self.assertEqual(self.customer_pages(2), list(range(2, 10)))
+
+    def test_shard_pages_skip_customers_being_moved(self):
+        from app import shard_page
+        from models import Customers
+        from rebalance import copy_rows, engine_for, set_directory
+
+        # Customers 3 and 5 are copied to the default shard but still read from s1
+        for customer_id in (3, 5):
+            set_directory(customer_id, "s1", moving=True)
+            with engine_for("s1").connect() as source, engine_for(None).begin() as target:
+                copy_rows(source, target, customer_id, 100)
+
+        query = db.session.query(Customers.id).order_by(Customers.id)
+        with shards.use(None):
+            self.assertEqual([row[0] for row in shard_page(query, None, 3)], [2, 4, 6])
+
+        self.assertEqual(self.customer_pages(3), list(range(2, 10)))
+
+        response = self.client.get('/customers?limit=3&after_id=5')
+        self.assertEqual([row["id"] for row in response.get_json()], [6, 7, 8])
+        self.assertEqual(response.headers.get("X-Next-After-Id"), "8")
+
+
+class ReplicaConfig(TestingConfig):
+    # The replica never replays anything, so it only has what a test puts there
+    SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(tempfile.gettempdir(), "acorns_test_primary.db")
+    SQLALCHEMY_BINDS = {"replica1": "sqlite:///" + os.path.join(tempfile.gettempdir(), "acorns_test_replica.db")}
+    REPLICAS = {None: ["replica1"]}
+    CACHE_SHARED_URL = "fake://"
+
+
+class ReplicaTestCase(ApiTestCase):
+    config = ReplicaConfig
+
+    def setUp(self):
+        super(ReplicaTestCase, self).setUp()
+        db.Model.metadata.drop_all(db.get_engine(self.app, bind="replica1"))
+        db.Model.metadata.create_all(db.get_engine(self.app, bind="replica1"))
+
+    def tearDown(self):
+        db.session.remove()
+        db.Model.metadata.drop_all(db.get_engine(self.app, bind="replica1"))
+        super(ReplicaTestCase, self).tearDown()
+
+    def test_clients_read_their_own_writes(self):
+        customer_id = self.create_customer()["id"]
+        account_id = self.create_account(customer_id)["id"]
+        path = '/customers/{}/accounts/{}'.format(customer_id, account_id)
+
+        # The writer's token sends it to the primary, anyone else reads the replica
+        self.assertEqual(self.client.get(path).status_code, 200)
+        self.assertEqual(self.app.test_client().get(path).status_code, 404)
+
+    def test_other_readers_dont_cache_what_the_replica_has(self):
+        customer_id = self.create_customer()["id"]
+        path = '/customers/{}/accounts'.format(customer_id)
+
+        # Another client's read between the write and the writer's read
+        account_id = self.create_account(customer_id)["id"]
+        self.assertEqual([row["id"] for row in self.app.test_client().get(path).get_json()], [account_id])
+        self.assertEqual([row["id"] for row in self.client.get(path).get_json()], [account_id])
+
+    def test_only_cached_loads_are_pinned(self):
+        from flask import g
+        from extensions import replicas
+        from models import Customers
+
+        self.create_customer()
+
+        def load():
+            return Customers.query.count()
+
+        with self.app.test_request_context('/customers'):
+            g.replica_binds = {None: "replica1"}
+            self.assertEqual(replicas.on_primary(load, True)(), 1)
+            self.assertEqual(replicas.on_primary(load, False)(), 0)
+
+
+def post_examples(base_url="http://127.0.0.1:5000"):
+    import requests
+
+    response = requests.post(base_url + '/customers', data=customer, verify=False)
+    response = requests.post(base_url + '/customers/1/accounts', data=account, verify=False)
+    response = requests.post(base_url + '/customers/1/transfer', data=transfer, verify=False)
+
+    print(response)
+
+    print(response.text)
 
-print response
 
-print response.text
+if __name__ == '__main__':
+    unittest.main()
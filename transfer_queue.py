@@ -0,0 +1,185 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the asynchronous transfer queue. In async mode POST /transfer
+         validates a transfer and stores it in TransferRequests instead of
+         running it. Worker processes drain the queue in batches. Every transfer
+         goes in the partition of its from account and each partition is only
+         drained by one worker, oldest first, so transfers out of the same
+         account run one at a time in the order they were submitted while
+         different accounts are processed in parallel.
+"""
+
+import multiprocessing
+import time
+from datetime import datetime
+
+from flask import current_app
+
+from extensions import db, cache, shards
+from cache import account_key, accounts_key
+from models import Accounts, TransferRequests
+from transfers import TransferError, AccountNotFound, apply_transfer, check_amount, commit_with_retries
+
+
+def partition_for(account_id):
+    return account_id % current_app.config['TRANSFER_QUEUE_PARTITIONS']
+
+
+def enqueue_transfer(customer_id, from_account_id, to_account_id, amount):
+    """
+    Checks what can be checked up front and queues the transfer. Balances and
+    account statuses are checked when the transfer runs since they can change
+    while it waits. Raises TransferError if the transfer is rejected. Returns
+    the committed TransferRequests row.
+    """
+    check_amount(amount)
+
+    if from_account_id == to_account_id:
+        raise TransferError("To and from accounts must be different")
+
+    owned = db.session.query(Accounts.id) \
+        .filter(Accounts.id.in_([from_account_id, to_account_id]), Accounts.customer_id == customer_id).count()
+
+    if owned != 2:
+        raise AccountNotFound("Customer with id {} does not own accounts {} and {}"
+                              .format(customer_id, from_account_id, to_account_id))
+
+    queued = TransferRequests(customer_id, from_account_id, to_account_id, amount, partition_for(from_account_id))
+    db.session.add(queued)
+    db.session.commit()
+
+    return queued
+
+
+def queued_in(partition):
+    return TransferRequests.query \
+        .filter(TransferRequests.status == "queued", TransferRequests.partition == partition) \
+        .order_by(TransferRequests.id)
+
+
+def run_batch(query, batch_size):
+    """
+    Claims up to batch_size queued transfers from query and runs each in its own
+    savepoint inside the current transaction, so a rejected transfer is marked
+    failed without undoing the others. Doesn't commit. Returns the number of
+    transfers run and (customer_id, from_account_id, to_account_id) for each
+    one that completed.
+    """
+    requests = query.limit(batch_size).with_for_update(skip_locked=True).all()
+    completed = []
+
+    for queued in requests:
+        queued.attempts = queued.attempts + 1
+
+        try:
+            with db.session.begin_nested():
+                apply_transfer(queued.customer_id, queued.from_account_id, queued.to_account_id, queued.amount)
+
+            queued.status = "completed"
+            completed.append((queued.customer_id, queued.from_account_id, queued.to_account_id))
+
+        except TransferError as e:
+            queued.status = "failed"
+            queued.error = e.message
+
+        queued.completed_at = datetime.now()
+
+    return len(requests), completed
+
+
+def fail(request_id):
+    TransferRequests.query.filter(TransferRequests.id == request_id) \
+        .update({"status": "failed", "error": "Internal Server Error", "completed_at": datetime.now()},
+                synchronize_session=False)
+    db.session.commit()
+
+
+def drain_batch(partition, batch_size):
+    """
+    Runs and commits the next batch of a partition. If the batch fails for any
+    reason other than rejected transfers its transfers are run again one per
+    transaction, so only the one at fault is marked failed. Returns the number
+    of transfers run.
+    """
+    query = queued_in(partition)
+
+    try:
+        processed, completed = commit_with_retries(lambda: run_batch(query, batch_size))
+
+    except Exception as e:
+        current_app.logger.error(str(e))
+        processed, completed = 0, []
+
+        for (request_id,) in query.with_entities(TransferRequests.id).limit(batch_size).all():
+            single = queued_in(partition).filter(TransferRequests.id == request_id)
+
+            try:
+                count, done = commit_with_retries(lambda: run_batch(single, 1))
+
+            except Exception as e:
+                current_app.logger.error(str(e))
+                fail(request_id)
+                count, done = 1, []
+
+            processed += count
+            completed.extend(done)
+
+    cache.invalidate(*[key for customer_id, from_account_id, to_account_id in completed
+                       for key in (account_key(customer_id, from_account_id),
+                                   account_key(customer_id, to_account_id),
+                                   accounts_key(customer_id))])
+
+    return processed
+
+
+def work(partitions, batch_size, poll_interval, drain=False):
+    """
+    Drains batches from the given partitions of every shard in turn, sleeping
+    poll_interval seconds whenever they are all empty. With drain it returns
+    once they are all empty instead.
+    """
+    while True:
+        processed = 0
+
+        for shard in shards.names():
+            with shards.use(shard):
+                processed += sum([drain_batch(partition, batch_size) for partition in partitions])
+
+        if not processed:
+            if drain:
+                return
+
+            time.sleep(poll_interval)
+
+
+def worker_process(app, index, workers, batch_size, poll_interval, drain):
+    with app.app_context():
+        # Connections inherited from the parent process can't be shared
+        for shard in shards.names():
+            db.get_engine(bind=shard).dispose()
+
+        partitions = [partition for partition in range(current_app.config['TRANSFER_QUEUE_PARTITIONS'])
+                      if partition % workers == index]
+        work(partitions, batch_size, poll_interval, drain)
+
+
+def run_workers(workers, batch_size, poll_interval, drain=False):
+    """
+    Starts workers processes, each owning every workers-th partition, and
+    waits for them to finish. Workers are forked so they get the app as is.
+    """
+    app = current_app._get_current_object()
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=worker_process,
+                                 args=(app, index, workers, batch_size, poll_interval, drain))
+                 for index in range(workers)]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
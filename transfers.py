@@ -0,0 +1,314 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the transfer engine. It moves money between two accounts
+         owned by the same customer in a single short transaction that is
+         safe to run concurrently against the same accounts.
+"""
+
+import math
+import random
+import time
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import case
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm.exc import StaleDataError
+
+from extensions import db, cache, shards
+from cache import account_key, accounts_key
+from models import Accounts, Ledger
+from rollups import record_activity
+
+# SQLSTATE codes for serialization failures and deadlocks. A transaction that
+# fails with one of these did nothing and is safe to run again.
+RETRYABLE_SQLSTATES = ("40001", "40P01")
+
+
+class TransferError(Exception):
+    """
+    Raised when a transfer is rejected. status_code is the HTTP status the
+    controllers should respond with.
+    """
+    status_code = 400
+
+    def __init__(self, message):
+        super(TransferError, self).__init__(message)
+        self.message = message
+
+
+class AccountNotFound(TransferError):
+    status_code = 404
+
+
+def is_retryable(error):
+    """
+    Returns True if the database error is a serialization failure or deadlock,
+    or an account's version changed since it was read.
+    """
+    if isinstance(error, StaleDataError):
+        return True
+
+    return getattr(getattr(error, "orig", None), "pgcode", None) in RETRYABLE_SQLSTATES
+
+
+def check_amount(amount):
+    """
+    Raises TransferError unless amount is a finite number greater than 0. NaN
+    compares false with everything, so it would pass every other check.
+    """
+    if not math.isfinite(amount):
+        raise TransferError("Amount must be a finite number")
+
+    if amount <= 0:
+        raise TransferError("Amount must be greater than 0")
+
+
+def check_transfer(from_account, to_account, amount):
+    """
+    Applies the rules every transfer has to pass. Raises TransferError if the
+    transfer is not allowed.
+    """
+    check_amount(amount)
+
+    if from_account.id == to_account.id:
+        raise TransferError("To and from accounts must be different")
+
+    if not from_account.status == "opened" or not from_account.active \
+            or not to_account.status == "opened" or not to_account.active:
+        raise TransferError("Both to and from accounts must be open")
+
+    if from_account.balance - amount < 0:
+        raise TransferError("Insufficient in from account")
+
+
+def lock_accounts(account_ids, customer_id=None):
+    """
+    Loads the given accounts with SELECT ... FOR UPDATE in one query, optionally
+    only those owned by customer_id. Rows are locked in ascending id order so two
+    transfers touching the same accounts always take their locks in the same
+    order and can't deadlock. Accounts already in the session are refreshed
+    so a transaction running several transfers sees their current balances.
+    Returns a dict of account id to account.
+    """
+    query = Accounts.query.filter(Accounts.id.in_(set(account_ids)))
+
+    if customer_id is not None:
+        query = query.filter(Accounts.customer_id == customer_id)
+
+    accounts = query.order_by(Accounts.id).with_for_update().populate_existing().all()
+
+    return {account.id: account for account in accounts}
+
+
+def ledger_rows(from_account_id, to_account_id, amount):
+    """
+    Returns the pair of Ledger rows that record a transfer.
+    """
+    now = datetime.now()
+
+    return [
+        {
+            "account_id": to_account_id,
+            "transaction_type": "credit",
+            "amount": amount,
+            "details": "transfer_in",
+            "created_at": now,
+        },
+        {
+            "account_id": from_account_id,
+            "transaction_type": "debit",
+            "amount": amount,
+            "details": "transfer_away",
+            "created_at": now,
+        },
+    ]
+
+
+def apply_transfer(customer_id, from_account_id, to_account_id, amount):
+    """
+    Runs one transfer inside the current transaction without committing.
+    Both balances change in one UPDATE and both Ledger rows are written with
+    one multi-row INSERT. The activity rollups are updated in the same
+    transaction.
+    """
+    accounts = lock_accounts((from_account_id, to_account_id), customer_id)
+
+    if from_account_id not in accounts or to_account_id not in accounts:
+        raise AccountNotFound("Customer with id {} does not own accounts {} and {}"
+                              .format(customer_id, from_account_id, to_account_id))
+
+    check_transfer(accounts[from_account_id], accounts[to_account_id], amount)
+
+    db.session.execute(
+        Accounts.__table__.update()
+        .where(Accounts.id.in_([from_account_id, to_account_id]))
+        .values(balance=Accounts.balance + case(
+                    [(Accounts.id == to_account_id, amount)], else_=-amount),
+                version=Accounts.version + 1)
+    )
+
+    rows = ledger_rows(from_account_id, to_account_id, amount)
+    db.session.execute(Ledger.__table__.insert().values(rows))
+    record_activity(rows)
+
+
+def parse_transfer(item):
+    """
+    Normalizes one transfer of a batch request. Raises TransferError if it is
+    missing a field or has a field of the wrong type.
+    """
+    try:
+        return {
+            "customer_id": int(item["customer_id"]),
+            "from_account_id": int(item["from_account_id"]),
+            "to_account_id": int(item["to_account_id"]),
+            "amount": float(item["amount"]),
+        }
+
+    except (KeyError, TypeError, ValueError):
+        raise TransferError("Transfer must have integer customer_id, from_account_id and "
+                            "to_account_id and a numeric amount")
+
+
+def apply_batch(transfers):
+    """
+    Runs a chunk of parsed transfers inside the current transaction without
+    committing. Every account involved is locked with one query and transfers
+    are checked in order against the running balances, so a transfer sees the
+    effect of the ones before it. All Ledger rows are written with one multi-row
+    INSERT and added to the activity rollups together. Returns a result dict
+    per transfer.
+    """
+    account_ids = set()
+    for item in transfers:
+        account_ids.update((item["from_account_id"], item["to_account_id"]))
+
+    accounts = lock_accounts(account_ids)
+    results = []
+    rows = []
+
+    for item in transfers:
+        from_account = accounts.get(item["from_account_id"])
+        to_account = accounts.get(item["to_account_id"])
+
+        try:
+            if from_account is None or to_account is None \
+                    or from_account.customer_id != item["customer_id"] \
+                    or to_account.customer_id != item["customer_id"]:
+                raise AccountNotFound("Customer with id {} does not own accounts {} and {}"
+                                      .format(item["customer_id"], item["from_account_id"],
+                                              item["to_account_id"]))
+
+            check_transfer(from_account, to_account, item["amount"])
+
+        except TransferError as e:
+            results.append({"status": "error", "error": e.message})
+            continue
+
+        from_account.balance = from_account.balance - item["amount"]
+        to_account.balance = to_account.balance + item["amount"]
+        rows.extend(ledger_rows(from_account.id, to_account.id, item["amount"]))
+        results.append({"status": "ok"})
+
+    if rows:
+        db.session.execute(Ledger.__table__.insert().values(rows))
+        record_activity(rows)
+
+    return results
+
+
+def commit_with_retries(work):
+    """
+    Calls work() and commits. Serialization failures, deadlocks and stale
+    account versions roll back and call work() again with a short jittered
+    backoff, up to TRANSFER_MAX_RETRIES times. Any other error rolls back and is
+    raised. Returns what work() returned.
+    """
+    attempt = 0
+
+    while True:
+        try:
+            result = work()
+            db.session.commit()
+            return result
+
+        except (DBAPIError, StaleDataError) as e:
+            db.session.rollback()
+
+            if not is_retryable(e) or attempt >= current_app.config['TRANSFER_MAX_RETRIES']:
+                raise
+
+            attempt += 1
+            time.sleep(random.uniform(0, current_app.config['TRANSFER_RETRY_BACKOFF'] * attempt))
+
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def transfer(customer_id, from_account_id, to_account_id, amount):
+    """
+    Transfers amount from one account to another and commits. Raises
+    TransferError if the transfer is rejected.
+    """
+    commit_with_retries(lambda: apply_transfer(customer_id, from_account_id, to_account_id, amount))
+
+
+def transfer_batch(items, chunk_size):
+    """
+    Applies a list of raw transfer dicts in chunks of chunk_size, one
+    transaction per chunk. A rejected transfer doesn't stop the others. A chunk
+    that fails outright is rolled back and its transfers are reported as failed
+    while earlier chunks stay committed. Returns a result dict per item in the
+    order given. Transfers are run on their customer's shard, one shard after
+    another.
+    """
+    results = [None] * len(items)
+    parsed = []
+
+    for index, item in enumerate(items):
+        try:
+            parsed.append((index, parse_transfer(item)))
+        except TransferError as e:
+            results[index] = {"index": index, "status": "error", "error": e.message}
+
+    groups, rejected = shards.group(parsed, lambda indexed: indexed[1]["customer_id"])
+
+    for (index, _), error in rejected:
+        results[index] = {"index": index, "status": "error", "error": error}
+
+    for shard, grouped in groups.items():
+        with shards.use(shard):
+            transfer_chunks(grouped, chunk_size, results)
+
+    return results
+
+
+def transfer_chunks(parsed, chunk_size, results):
+    """
+    Runs (index, parsed transfer) pairs in chunks of chunk_size, one
+    transaction per chunk, and stores each one's result at its index.
+    """
+    for start in range(0, len(parsed), chunk_size):
+        chunk = parsed[start:start + chunk_size]
+        transfers = [item for _, item in chunk]
+
+        try:
+            chunk_results = commit_with_retries(lambda: apply_batch(transfers))
+
+        except Exception as e:
+            current_app.logger.error(str(e))
+            chunk_results = [{"status": "error", "error": "Internal Server Error"}] * len(chunk)
+
+        for (index, _), result in zip(chunk, chunk_results):
+            results[index] = dict(result, index=index)
+
+        cache.invalidate(*[key for (_, item), result in zip(chunk, chunk_results) if result["status"] == "ok"
+                           for key in (account_key(item["customer_id"], item["from_account_id"]),
+                                       account_key(item["customer_id"], item["to_account_id"]),
+                                       accounts_key(item["customer_id"]))])
@@ -0,0 +1,19 @@
+"""
+Author: Tyler Puleo
+License: GPL
+Version: 0.0.1
+Maintainer: Tyler Puleo
+Status: Production
+Summary: This is the entry point for WSGI servers, e.g.
+
+             gunicorn -c gunicorn.conf.py wsgi:app
+
+         The app is created for the config named by ACORNS_CONFIG and warmed,
+         so with gunicorn's preload_app the master does it once and every
+         worker is forked ready to serve.
+"""
+
+from app import create_app, warm
+
+app = create_app()
+warm(app)